@@ -0,0 +1,132 @@
+import logging
+import math
+import os
+from heapq import merge
+
+from data_store import list_files, load_file_as_json, store_json_file
+from readings import METRIC_KEYS, device_of
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+ANOMALIES_FOLDER = os.getenv('ANOMALIES_FOLDER', 'anomalies')
+# Number of readings the rolling mean and variance are computed over (approximately, see _update_metric_stats)
+ANOMALY_WINDOW = int(os.getenv('ANOMALY_WINDOW', '360'))
+# Smoothing factor of the EWMA, higher values follow the readings more closely
+ANOMALY_EWMA_ALPHA = float(os.getenv('ANOMALY_EWMA_ALPHA', '0.1'))
+# Number of standard deviations from the rolling mean at which a reading is flagged as a spike, and at which the EWMA
+# is flagged as having shifted away from it
+ANOMALY_SPIKE_THRESHOLD = float(os.getenv('ANOMALY_SPIKE_THRESHOLD', '4'))
+ANOMALY_SHIFT_THRESHOLD = float(os.getenv('ANOMALY_SHIFT_THRESHOLD', '2'))
+# Readings of a device and metric needed before anything is flagged
+ANOMALY_MIN_READINGS = int(os.getenv('ANOMALY_MIN_READINGS', '30'))
+# Maximum number of anomalies kept per device and day, the oldest are dropped first
+MAX_ANOMALIES_PER_DAY = 1000
+# Lower bound of the standard deviation of each metric so that noise on a very steady metric isn't flagged
+MIN_STD = {'tmp': 0.2, 'hum': 0.5, 'pr': 0.2}
+
+
+# Flags anomalous readings as they are ingested. A small state object per device holds, for each metric, a rolling
+# mean and variance (updated with Welford's algorithm) and an EWMA of the readings, e.g.
+#   {"tmp": {"n": 360, "mean": 21.3, "var": 1.2, "ewma": 21.9, "t": 1712345678000, "shifted": false}}
+# so every batch is processed in O(batch) without reading the day's data file. Two kinds of anomalies are flagged:
+# - spike: a reading far from the rolling mean, e.g. a failing sensor
+# - shift: the EWMA moving away from the rolling mean, e.g. the heating coming on. Only the start of a shift is flagged.
+# Anomalies are stored in a compact object per device and day, {"entries": [{"t": ..., "device": ..., "m": "tmp",
+# "v": 35.2, "z": 6.1, "k": "spike"}, ...]}, in the order they were flagged.
+#
+# The state and anomalies are split by device so that workers ingesting the readings of different devices at the same
+# time don't overwrite each other's updates, and are loaded with raise_errors so that a failed load isn't mistaken for
+# a new device and its state reset. Returns the anomalies flagged.
+def update_anomaly_detection(readings, file_key):
+    readings_by_device = {}
+    for reading in readings:
+        readings_by_device.setdefault(device_of(reading), []).append(reading)
+
+    anomalies = []
+    for device, device_readings in readings_by_device.items():
+        anomalies.extend(_update_device_anomaly_detection(device, device_readings, file_key))
+    if anomalies:
+        log.info(f"Flagged {len(anomalies)} anomalous readings")
+    return anomalies
+
+
+def load_anomaly_state(device):
+    return load_file_as_json(get_anomaly_state_file_key(device), raise_errors=True)
+
+
+# Loads the anomalies of the day, those of the given device or of every device merged by time
+def load_anomalies(file_key, device=None):
+    if device:
+        return load_file_as_json(get_anomalies_file_key(file_key, device))
+    anomalies_by_device = [(load_file_as_json(device_file_key) or {'entries': []})['entries']
+                           for device_file_key in list_files(f'{ANOMALIES_FOLDER}/{file_key}/', '/')]
+    return {'entries': list(merge(*anomalies_by_device, key=lambda anomaly: anomaly['t']))} \
+        if anomalies_by_device else None
+
+
+def get_anomaly_state_file_key(device):
+    return f'{ANOMALIES_FOLDER}/state/{device}.json'
+
+
+def get_anomalies_file_key(file_key, device):
+    return f'{ANOMALIES_FOLDER}/{file_key}/{device}.json'
+
+
+def _update_device_anomaly_detection(device, readings, file_key):
+    device_state = load_anomaly_state(device) or {}
+    anomalies = []
+    for reading in sorted(readings, key=lambda reading: reading['t']):
+        for metric_key in METRIC_KEYS:
+            if reading.get(metric_key) is None:
+                continue
+            metric_stats = device_state.setdefault(metric_key, {'n': 0, 'mean': 0.0, 'var': 0.0, 'ewma': None,
+                                                                't': None, 'shifted': False})
+            # Readings at or before the last one seen (e.g. redelivered ones) were already counted
+            if metric_stats['t'] is not None and reading['t'] <= metric_stats['t']:
+                continue
+            anomalies.extend(dict(anomaly, t=reading['t'], device=device, m=metric_key)
+                             for anomaly in _update_metric_stats(metric_stats, metric_key, reading[metric_key],
+                                                                 reading['t']))
+
+    store_json_file(get_anomaly_state_file_key(device), device_state)
+    if anomalies:
+        _store_anomalies(anomalies, file_key, device)
+    return anomalies
+
+
+# Checks the value against the statistics of the readings before it, then adds it to them. Welford's update of the
+# variance is used with the count capped at the window, which turns it into an exponentially weighted mean and
+# variance over roughly the last ANOMALY_WINDOW readings. Returns the anomalies the value is flagged with.
+def _update_metric_stats(stats, metric_key, value, t):
+    anomalies = []
+    std = max(math.sqrt(stats['var']), MIN_STD.get(metric_key, 0))
+    warmed_up = stats['n'] >= ANOMALY_MIN_READINGS
+    z = (value - stats['mean']) / std
+    if warmed_up and abs(z) >= ANOMALY_SPIKE_THRESHOLD:
+        anomalies.append({'v': value, 'z': round(z, 2), 'k': 'spike'})
+
+    # Values are clamped to the spike threshold before going into the EWMA so that a single wild reading can't move it
+    # far enough to look like a shift, while a sustained change still does
+    ewma_value = stats['mean'] + max(-ANOMALY_SPIKE_THRESHOLD, min(ANOMALY_SPIKE_THRESHOLD, z)) * std
+    stats['ewma'] = value if stats['ewma'] is None else \
+        stats['ewma'] + ANOMALY_EWMA_ALPHA * (ewma_value - stats['ewma'])
+    shift_z = (stats['ewma'] - stats['mean']) / std
+    shifted = warmed_up and abs(shift_z) >= ANOMALY_SHIFT_THRESHOLD
+    if shifted and not stats['shifted']:
+        anomalies.append({'v': value, 'z': round(shift_z, 2), 'k': 'shift'})
+    stats['shifted'] = shifted
+
+    stats['n'] = min(stats['n'] + 1, ANOMALY_WINDOW)
+    delta = value - stats['mean']
+    stats['mean'] += delta / stats['n']
+    stats['var'] += (delta * (value - stats['mean']) - stats['var']) / stats['n']
+    stats['t'] = t
+    return anomalies
+
+
+def _store_anomalies(anomalies, file_key, device):
+    anomalies_file_key = get_anomalies_file_key(file_key, device)
+    stored = load_file_as_json(anomalies_file_key, raise_errors=True) or {'entries': []}
+    stored['entries'] = (stored['entries'] + anomalies)[-MAX_ANOMALIES_PER_DAY:]
+    store_json_file(anomalies_file_key, stored)
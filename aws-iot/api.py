@@ -2,76 +2,225 @@ import json
 import logging
 import os
 import re
-import boto3
-from datetime import datetime
-
-from data_store import load_file_as_json, append_data_as_json, EMPTY_JSON_ARRAY
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from archive import load_daily_file
+from anomaly_detection import load_anomalies, update_anomaly_detection
+from aws_clients import get_client
+from data_store import append_data_as_json, EMPTY_JSON_ARRAY
+from dedup_index import load_dedup_index, filter_new_readings, store_dedup_index
+from device_registry import find_devices, get_device
+from forecast_accuracy import load_forecast_accuracy, summarize_accuracy, update_forecast_accuracy
+from latest_readings import update_latest_readings, load_latest_reading, load_fleet_summary
+from packaged_requirements import import_requirements
+from perf_metrics import handler_metrics, add_metrics
+from profiling import profiled
+from readings import METRIC_KEYS, unpack_data_points, fill_forward
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
-SQS = boto3.client('sqs')
 QUEUE_URL = os.getenv('QUEUE_URL')
+# Limits of a single SendMessageBatch call. The byte limit also applies to the total size of the batch.
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_MESSAGE_BYTES = 256 * 1024
+MAX_DEVICES_PAGE_SIZE = 1000
+MAX_METRICS_PAGE_SIZE = 10000
+MAX_STATS_RANGE_DAYS = 92
+# The parsed (and filled in) entries of the days fetched are kept so that the following pages of a day don't load and
+# parse the whole day again, up to this many days (least recently used are dropped first). Today's entries are
+# reloaded by requests for the first page and once they are older than the TTL, so the pages of today that follow see
+# the same entries as the first page.
+METRICS_PAGE_CACHE_MAX_DAYS = int(os.getenv('METRICS_PAGE_CACHE_MAX_DAYS', '8'))
+METRICS_PAGE_CACHE_TODAY_TTL_SECS = int(os.getenv('METRICS_PAGE_CACHE_TODAY_TTL_SECS', '300'))
+
+# Entries of the days being paged through, by file key: (time loaded, entries)
+_entries_cache = OrderedDict()
 
 
 # Internal Lambda Functions
+# Accepts a single event or a list of events (e.g. from a batching IoT rule action). Each event is forwarded to the
+# queue as a message, using as few send_message_batch calls as the SQS limits allow. Batched payloads are forwarded
+# as a single message, or split into several if they are too big for one, and unpacked by data_appender.
+@profiled
+@handler_metrics
 def event_receiver(event, context):
     log.debug('Got an event_receiver event')
     log.debug(f'Event is: {event}')
-    if not event:
+    events = event if isinstance(event, list) else [event]
+    events = [e for e in events if e and _has_data_points(e)]
+    if not events:
         return _default_response(400, {'message': 'No event data was found'})
 
     try:
-        SQS.send_message(QueueUrl=QUEUE_URL, MessageBody=json.dumps(event))
-        return _default_response(200, {'message': 'data received'})
+        message_bodies = [body for e in events for body in _build_message_bodies(e)]
+        failed = _send_messages(message_bodies)
     except Exception as e:
         log.exception('Sending message to SQS queue failed!')
         return _default_response(500, {'error': str(e)})
 
+    if not failed:
+        return _default_response(200, {'message': 'data received'})
+
+    log.error(f'{len(failed)} of {len(message_bodies)} messages could not be sent to the SQS queue: {failed}')
+    status = 500 if len(failed) == len(message_bodies) else 207
+    return _default_response(status, {'message': 'Some data could not be queued', 'failed': failed})
+
 
+# Malformed events (e.g. a truncated binary payload) are dropped on their own so that the valid events sent with them
+# are still queued
+def _has_data_points(event):
+    try:
+        return bool(unpack_data_points(event))
+    except ValueError as e:
+        log.error(f"Dropping an event that could not be read: {e}")
+        return False
+
+
+def _build_message_bodies(event):
+    body = json.dumps(event)
+    if len(body.encode('utf-8')) <= SQS_MAX_MESSAGE_BYTES or not event.get('entries'):
+        return [body]
+    if len(event['entries']) == 1:
+        raise ValueError('A single data point is larger than the maximum SQS message size')
+
+    # Split the batch in half until each part fits in a message
+    middle = len(event['entries']) // 2
+    return (_build_message_bodies(dict(event, entries=event['entries'][:middle]))
+            + _build_message_bodies(dict(event, entries=event['entries'][middle:])))
+
+
+# Sends the messages in batches of at most 10 messages and 256 KB. Returns the entries that failed, if any.
+def _send_messages(message_bodies):
+    failed = []
+    for batch in _batch_messages(message_bodies):
+        response = _sqs().send_message_batch(QueueUrl=QUEUE_URL, Entries=batch)
+        failed.extend({'id': entry['Id'], 'code': entry.get('Code'), 'message': entry.get('Message')}
+                      for entry in response.get('Failed', []))
+    return failed
+
+
+# The client is created on first use and shared for the lifetime of the container, so handlers that don't send
+# messages don't pay for it on cold start
+def _sqs():
+    return get_client('sqs')
+
+
+def _batch_messages(message_bodies):
+    batch = []
+    batch_bytes = 0
+    for i, body in enumerate(message_bodies):
+        body_bytes = len(body.encode('utf-8'))
+        if batch and (len(batch) == SQS_MAX_BATCH_ENTRIES or batch_bytes + body_bytes > SQS_MAX_MESSAGE_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append({'Id': str(i), 'MessageBody': body})
+        batch_bytes += body_bytes
+    if batch:
+        yield batch
+
+
+# Appends the data points of every SQS record to today's data file. Returns the ids of the records that could not be
+# processed as batchItemFailures so that only those are retried (the SQS event source reports partial batch failures).
+# Readings that have already been stored are dropped, see dedup_index.py.
+@profiled
+@handler_metrics
 def data_appender(event, context):
     log.debug('Got a data appender event')
-    data_points = [json.loads(record['body']) for record in event['Records']]
+    data_points = []
+    data_point_message_ids = []
+    failed_message_ids = []
+    for record in event['Records']:
+        try:
+            record_data_points = unpack_data_points(json.loads(record['body']))
+        except Exception as e:
+            log.error(f"Unable to read the data points in message {record.get('messageId')}: {e}")
+            failed_message_ids.append(record.get('messageId'))
+            continue
+
+        data_points.extend(record_data_points)
+        data_point_message_ids.append(record.get('messageId'))
+
     if not len(data_points):
         log.debug("No data points contained in event data, skipping")
-        return
+        return _batch_item_failures(failed_message_ids)
 
     # Could use the time in the data to decide which file to append to, but for now we'll just use the current date
     file_key = datetime.now().strftime("%Y-%m-%d")
-    log.debug(f'Appending {len(data_points)} data points to file with key {file_key}')
     try:
-        append_data_as_json(data_points, file_key)
+        dedup_index = load_dedup_index(file_key)
+        new_data_points, new_keys = filter_new_readings(dedup_index, data_points)
+        if new_data_points:
+            log.debug(f'Appending {len(new_data_points)} data points to file with key {file_key}')
+            append_data_as_json(new_data_points, file_key, sort_key='t')
+            store_dedup_index(file_key, dedup_index, new_keys)
+        add_metrics('Readings', Records=len(new_data_points), Duplicates=len(data_points) - len(new_data_points))
     except Exception as e:
         log.error(f"An error occurred while appending data to file with key {file_key}: {e}")
+        failed_message_ids.extend(data_point_message_ids)
+        return _batch_item_failures(failed_message_ids)
+
+    # The latest readings, anomalies and forecast accuracy are derived from the stored data so failing to update them
+    # doesn't fail the messages
+    try:
+        if new_data_points:
+            update_latest_readings(new_data_points)
+    except Exception as e:
+        log.error(f"An error occurred while updating the latest readings: {e}")
+    try:
+        if new_data_points:
+            update_anomaly_detection(new_data_points, file_key)
+    except Exception as e:
+        log.error(f"An error occurred while checking readings for anomalies: {e}")
+    try:
+        if new_data_points:
+            update_forecast_accuracy(new_data_points)
+    except Exception as e:
+        log.error(f"An error occurred while scoring readings against their predictions: {e}")
+
+    return _batch_item_failures(failed_message_ids)
+
+
+def _batch_item_failures(message_ids):
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in message_ids]}
 
 
 # Public API Lambda Functions
+# Lists devices from the cached device registry. Supports the optional query string parameters "type" and "prefix"
+# to filter devices by type and name prefix, and "limit" and "nextToken" to page through them. The response only
+# contains a nextToken if there are more devices.
+@profiled
+@handler_metrics
 def fetch_devices(event, context):
-    iot = boto3.client('iot')
     log.debug('Fetching all devices')
+    query_string_params = event.get('queryStringParameters') or {}
+    try:
+        limit = _int_param(query_string_params, 'limit', 1, MAX_DEVICES_PAGE_SIZE)
+        start = _int_param(query_string_params, 'nextToken', 0) or 0
+    except ValueError as e:
+        return _default_cors_response(400, {'message': str(e)})
 
     try:
-        response = iot.list_things()
+        devices, next_start = find_devices(query_string_params.get('type'), query_string_params.get('prefix'),
+                                           limit, start)
     except Exception:
         log.error(f"An error occurred", exc_info=True)
         return _default_cors_response(500, {'message': 'An error occurred while listing devices.'})
 
-    things = response['things']
-    if not things:
-        return _default_cors_response(200, {"devices": []})
-
-    result = {"devices": []}
-    for thing in things:
-        result["devices"].append({
-            "name": thing['thingName'],
-            "version": thing['version'],
-            "type": thing['thingTypeName']
-        })
+    result = {"devices": devices}
+    if next_start is not None:
+        result['nextToken'] = str(next_start)
 
-    log.info(f"Devices fetched successfully: {result}")
+    log.info(f"{len(devices)} devices fetched successfully")
     return _default_cors_response(200, result)
 
 
+@profiled
+@handler_metrics
 def fetch_device(event, context):
     path_params = event.get('pathParameters', {})
     device_id = path_params.get('deviceId')
@@ -80,75 +229,323 @@ def fetch_device(event, context):
         return _default_cors_response(400, {'message': 'No device ID provided'})
 
     log.debug(f'Fetching data for device with ID {device_id}')
-    iot = boto3.client('iot')
-
     try:
-        thing = iot.describe_thing(thingName=device_id)
-    except iot.exceptions.ResourceNotFoundException:
-        thing = None
+        device = get_device(device_id)
+    except Exception:
+        log.error(f"An error occurred", exc_info=True)
+        return _default_cors_response(500, {'message': 'An error occurred while fetching the device.'})
 
-    if not thing:
+    if not device:
         return _default_cors_response(404, {'message': 'Device not found'})
 
-    return _default_cors_response(200, {
-        'name': thing['thingName'],
-        'version': thing['version'],
-        'type': thing['thingTypeName']
-    })
+    return _default_cors_response(200, device)
+
+
+# Serves the latest reading of the device given by the deviceId path parameter or, without one, the latest reading of
+# every device. Only reads the small objects maintained by data_appender so the cost doesn't depend on how much data
+# has come in today.
+@profiled
+@handler_metrics
+def fetch_current_conditions(event, context):
+    path_params = event.get('pathParameters') or {}
+    device_id = path_params.get('deviceId')
+    log.debug(f"Fetching current conditions for {f'device {device_id}' if device_id else 'all devices'}")
+
+    try:
+        if not device_id:
+            return _default_cors_response(200, load_fleet_summary() or {'devices': {}})
+
+        latest_reading = load_latest_reading(device_id)
+    except Exception as e:
+        log.error(f"An error occurred while fetching current conditions: {e}")
+        return _default_cors_response(500, {'message': 'An error occurred while fetching current conditions.'})
+
+    if not latest_reading:
+        return _default_cors_response(404, {'message': 'No readings found for device'})
+    return _default_cors_response(200, latest_reading)
 
 
 # HTTP accessible Lambda Functions
+# The metrics and predictions endpoints support the following optional query string parameters:
+# - date: the day to fetch, defaults to today
+# - fields: comma separated metrics to return (tmp, hum, pr), e.g. "fields=tmp". Entries always include their time
+#   and device, along with the min/max of the requested metrics for summary readings.
+# - limit: maximum number of entries to return. If there are more, the response includes a nextCursor.
+# - cursor: the nextCursor of the previous page. Entries are stored in time order so the page is found with a binary
+#   search on time rather than by scanning.
+@profiled
+@handler_metrics
 def fetch_metrics(event, context):
     # IMPROVEMENT: This function now receives a deviceId parameter when called which can be used to retrieve
     # data for a specific device.
     log.debug('Got a fetch_data event')
-    query_string_params = event.get('queryStringParameters', {})
-    date_param = '' if not query_string_params else query_string_params.get('date', '')
+    query_string_params = event.get('queryStringParameters') or {}
+    date_param = query_string_params.get('date', '')
     if date_param and not _date_valid(date_param):
         return _default_cors_response(400, {'message': 'Invalid date parameter'})
 
-    return _fetch_metrics_for_date(date_param)
+    try:
+        page_params = _page_params(query_string_params)
+    except ValueError as e:
+        return _default_cors_response(400, {'message': str(e)})
+
+    return _fetch_metrics_for_date(date_param, page_params)
 
 
+# Only the predictions of the device given by the deviceId path parameter are returned, along with fleet-wide
+# predictions (those without a device) as the endpoint models don't predict per device.
+@profiled
+@handler_metrics
 def fetch_predictions(event, context):
-    # IMPROVEMENT: This function now receives a deviceId parameter when called which can be used to retrieve
-    # data for a specific device.
     log.debug('Got a fetch_predictions event')
-    query_string_params = event.get('queryStringParameters', {})
-    date_param = '' if not query_string_params else query_string_params.get('date', '')
+    query_string_params = event.get('queryStringParameters') or {}
+    path_params = event.get('pathParameters') or {}
+    date_param = query_string_params.get('date', '')
     if date_param and not _date_valid(date_param):
         return _default_cors_response(400, {'message': 'Invalid date parameter'})
 
-    return _fetch_predictions_for_date(date_param)
+    try:
+        page_params = _page_params(query_string_params)
+    except ValueError as e:
+        return _default_cors_response(400, {'message': str(e)})
+
+    return _fetch_predictions_for_date(date_param, page_params, path_params.get('deviceId'))
+
+
+# Serves the anomalies flagged while the readings of a day were ingested (see anomaly_detection.py), optionally only
+# those of the device given by the deviceId path parameter. Supports the following optional query string parameters:
+# - date: the day to fetch, defaults to today
+# - fields: comma separated metrics (tmp, hum, pr) to return anomalies of, defaults to every metric
+# - kind: "spike" or "shift" to only return anomalies of that kind
+@profiled
+@handler_metrics
+def fetch_anomalies(event, context):
+    log.debug('Got a fetch_anomalies event')
+    query_string_params = event.get('queryStringParameters') or {}
+    path_params = event.get('pathParameters') or {}
+    date_param = query_string_params.get('date', '')
+    if date_param and not _date_valid(date_param):
+        return _default_cors_response(400, {'message': 'Invalid date parameter'})
+    kind = query_string_params.get('kind')
+    if kind and kind not in ('spike', 'shift'):
+        return _default_cors_response(400, {'message': 'Invalid kind parameter'})
+    try:
+        fields = _page_params(query_string_params)['fields']
+    except ValueError as e:
+        return _default_cors_response(400, {'message': str(e)})
+
+    file_key = date_param or datetime.now().strftime("%Y-%m-%d")
+    device_id = path_params.get('deviceId')
+    try:
+        anomalies = (load_anomalies(file_key, device_id) or {'entries': []})['entries']
+    except Exception as e:
+        log.error(f"An error occurred while fetching the anomalies of {file_key}: {e}")
+        return _default_cors_response(500, {'message': 'An error occurred while fetching anomalies.'})
+
+    anomalies = [anomaly for anomaly in anomalies
+                 if (not device_id or anomaly['device'] == device_id) and (not fields or anomaly['m'] in fields)
+                 and (not kind or anomaly['k'] == kind)]
+    add_metrics('Entries', Records=len(anomalies))
+    return _default_cors_response(200, {'entries': anomalies})
+
+
+# Serves the accuracy of the forecasts against the readings that have come in so far (see forecast_accuracy.py): the
+# count, MAE, RMSE and bias of each metric by model version and horizon day, optionally only those of the readings of
+# the device given by the deviceId path parameter. Supports the following optional query string parameters:
+# - versions: comma separated model versions to return, defaults to every version
+# - fields: comma separated metrics (tmp, hum, pr) to return, defaults to every metric
+@profiled
+@handler_metrics
+def fetch_forecast_accuracy(event, context):
+    log.debug('Got a fetch_forecast_accuracy event')
+    query_string_params = event.get('queryStringParameters') or {}
+    path_params = event.get('pathParameters') or {}
+    versions = [version for version in query_string_params.get('versions', '').split(',') if version]
+    try:
+        fields = _page_params(query_string_params)['fields']
+    except ValueError as e:
+        return _default_cors_response(400, {'message': str(e)})
+
+    try:
+        summary = load_forecast_accuracy(path_params.get('deviceId')) or {'versions': {}}
+    except Exception as e:
+        log.error(f"An error occurred while fetching the forecast accuracy: {e}")
+        return _default_cors_response(500, {'message': 'An error occurred while fetching forecast accuracy.'})
+
+    return _default_cors_response(200, {'versions': summarize_accuracy(summary, versions, fields)})
+
+
+# Computes statistics over a range of days server side so that clients don't have to download every reading to do it.
+# Supports the following optional query string parameters:
+# - start, end: the first and last day of the range, default to today and to the start day respectively
+# - devices: comma separated devices to include, defaults to every device (the deviceId path parameter takes precedence)
+# - fields: comma separated metrics to compute statistics for (tmp, hum, pr), defaults to every metric
+# - percentiles: comma separated percentiles to compute, e.g. "percentiles=50,95"
+# - daily: "true" to include the mean of each metric for each day
+# - compare: "predictions" to include the error of the predictions against the actual readings
+@profiled
+@handler_metrics
+def fetch_stats(event, context):
+    log.debug('Got a fetch_stats event')
+    query_string_params = event.get('queryStringParameters') or {}
+    path_params = event.get('pathParameters') or {}
+    try:
+        start_date, end_date = _stats_range_params(query_string_params)
+        fields = _page_params(query_string_params)['fields'] or list(METRIC_KEYS)
+        percentiles = _percentiles_param(query_string_params)
+    except ValueError as e:
+        return _default_cors_response(400, {'message': str(e)})
+
+    device_id = path_params.get('deviceId')
+    devices = [device_id] if device_id else \
+        [device for device in query_string_params.get('devices', '').split(',') if device]
+
+    # numpy is only needed here so it is imported lazily to keep it out of the cold start of the other handlers
+    import_requirements()
+    import metrics_index
+    try:
+        actuals = metrics_index.filter_devices(metrics_index.load_columns(start_date, end_date), devices)
+        stats = {
+            'start': start_date.strftime('%Y-%m-%d'),
+            'end': end_date.strftime('%Y-%m-%d'),
+            'count': len(actuals.t),
+            'metrics': metrics_index.compute_stats(actuals, fields, percentiles)
+        }
+        if query_string_params.get('daily') == 'true':
+            stats['daily'] = metrics_index.compute_daily_means(actuals, fields)
+        if query_string_params.get('compare') == 'predictions':
+            predictions = metrics_index.load_columns(start_date, end_date, source='predictions')
+            stats['predictionErrors'] = metrics_index.compare_with_predictions(actuals, predictions, fields)
+    except Exception as e:
+        log.error(f"An error occurred while computing stats: {e}")
+        return _default_cors_response(500, {'message': 'An error occurred while computing stats.'})
 
+    return _default_cors_response(200, stats)
 
-def _fetch_metrics_for_date(date_str):
+
+def _stats_range_params(query_string_params):
+    start_param = query_string_params.get('start', '')
+    end_param = query_string_params.get('end', '')
+    for name, value in (('start', start_param), ('end', end_param)):
+        if value and not _date_valid(value):
+            raise ValueError(f'Invalid {name} parameter')
+
+    start_date = datetime.strptime(start_param, '%Y-%m-%d').date() if start_param else datetime.now().date()
+    end_date = datetime.strptime(end_param, '%Y-%m-%d').date() if end_param else start_date
+    if end_date < start_date or end_date - start_date >= timedelta(days=MAX_STATS_RANGE_DAYS):
+        raise ValueError(f'Invalid range, end must be within {MAX_STATS_RANGE_DAYS} days after start')
+    return start_date, end_date
+
+
+def _percentiles_param(query_string_params):
+    percentiles = []
+    for percentile in filter(None, query_string_params.get('percentiles', '').split(',')):
+        if not re.match(r'^\d+(\.\d+)?$', percentile) or float(percentile) > 100:
+            raise ValueError('Invalid percentiles parameter')
+        percentiles.append(float(percentile))
+    return percentiles
+
+
+def _fetch_metrics_for_date(date_str, page_params):
     # default to today's date if date provided is empty which is different from it being invalid
     file_key = date_str or datetime.now().strftime("%Y-%m-%d")
-    return _fetch_metrics_from_file(file_key)
+    # Deadband readings are filled in so that clients always see every metric on every reading
+    return _fetch_metrics_from_file(file_key, page_params, fill_forward)
 
 
-def _fetch_predictions_for_date(date_str):
+def _fetch_predictions_for_date(date_str, page_params, device_id=None):
     # default to today's date if date provided is empty which is different from it being invalid
     file_key = (date_str or datetime.now().strftime("%Y-%m-%d")) + '-predictions'
-    return _fetch_metrics_from_file(file_key)
+    return _fetch_metrics_from_file(file_key, page_params, device_id=device_id)
 
 
-def _fetch_metrics_from_file(file_key):
+# With a device id only the entries of that device and those without a device are returned. Filtering keeps the
+# entries in time order, so cursors of the filtered pages are found the same way.
+def _fetch_metrics_from_file(file_key, page_params, transform_entries=None, device_id=None):
     log.debug(f'Fetching data for file with key {file_key}')
     try:
-        json_data = load_file_as_json(file_key)
-        if not json_data:
-            json_data = json.loads(EMPTY_JSON_ARRAY)
-
-        log.debug(f"File \'{file_key}\' fetched {'successfully' if json_data else 'unsuccessfully'}.")
-        return _default_cors_response(200, json_data)
+        entries = _load_entries(file_key, transform_entries, bool(page_params['cursor']))
+        if device_id:
+            entries = [entry for entry in entries if entry.get('device', device_id) == device_id]
+        page = _page_entries(entries, **page_params)
+        add_metrics('Entries', Records=len(page['entries']))
+        return _default_cors_response(200, page)
 
     except Exception as e:
         log.error(f"An error occurred while fetching file with key {file_key}: {e}")
         return _default_cors_response(500, str(e))
 
 
+# Returns the entries of the day, from the cache unless it is today's first page or today's entries are stale (see
+# METRICS_PAGE_CACHE_MAX_DAYS). The entries are shared with later requests so they must not be modified.
+def _load_entries(file_key, transform_entries, is_next_page):
+    is_today = file_key.startswith(datetime.now().strftime("%Y-%m-%d"))
+    cached = _entries_cache.get(file_key)
+    if cached and (not is_today or (is_next_page and time.time() - cached[0] < METRICS_PAGE_CACHE_TODAY_TTL_SECS)):
+        _entries_cache.move_to_end(file_key)
+        return cached[1]
+
+    json_data = load_daily_file(file_key) or json.loads(EMPTY_JSON_ARRAY)
+    entries = transform_entries(json_data['entries']) if transform_entries else json_data['entries']
+    _entries_cache[file_key] = (time.time(), entries)
+    _entries_cache.move_to_end(file_key)
+    while len(_entries_cache) > METRICS_PAGE_CACHE_MAX_DAYS:
+        _entries_cache.popitem(last=False)
+    return entries
+
+
+def _page_params(query_string_params):
+    fields = [field for field in query_string_params.get('fields', '').split(',') if field]
+    if any(field not in METRIC_KEYS for field in fields):
+        raise ValueError('Invalid fields parameter')
+
+    cursor = query_string_params.get('cursor')
+    if cursor and not re.match(r'^\d+\.\d+$', cursor):
+        raise ValueError('Invalid cursor parameter')
+
+    return {
+        'fields': fields,
+        'limit': _int_param(query_string_params, 'limit', 1, MAX_METRICS_PAGE_SIZE),
+        'cursor': cursor
+    }
+
+
+# Returns the page of time ordered entries after the cursor, projected to the requested fields. Cursors are of the form
+# "<time>.<number of entries at that time already returned>" so that entries sharing a time (e.g. from different
+# devices) are never skipped or repeated.
+def _page_entries(entries, fields, limit, cursor):
+    start = 0
+    if cursor:
+        cursor_time, cursor_offset = cursor.split('.')
+        start = bisect_left(entries, int(cursor_time), key=lambda entry: entry['t']) + int(cursor_offset)
+
+    end = start + limit if limit else len(entries)
+    page = {'entries': [_project_entry(entry, fields) for entry in entries[start:end]] if fields
+            else entries[start:end]}
+
+    if end < len(entries):
+        last_time = entries[end - 1]['t']
+        same_time_count = end - bisect_left(entries, last_time, key=lambda entry: entry['t'])
+        page['nextCursor'] = f'{last_time}.{same_time_count}'
+    return page
+
+
+# Keeps the time, device and summary fields (w and n) of the entry along with the requested metrics and their min/max
+def _project_entry(entry, fields):
+    return {key: value for key, value in entry.items()
+            if key in ('t', 'device', 'w', 'n') or key.split('_')[0] in fields}
+
+
+# Parses an optional integer query string parameter, raising a ValueError if it is invalid or out of range
+def _int_param(query_string_params, name, minimum, maximum=None):
+    value = query_string_params.get(name)
+    if value is None or value == '':
+        return None
+    if not re.match(r'^\d+$', value) or int(value) < minimum or (maximum and int(value) > maximum):
+        raise ValueError(f'Invalid {name} parameter')
+    return int(value)
+
+
 def _date_valid(date_str):
     if not date_str:
         return False
@@ -0,0 +1,252 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from heapq import merge
+from itertools import groupby
+
+from data_store import load_file_as_json, load_file_as_bytes, load_file_range, store_file, list_files, delete_files
+from perf_metrics import handler_metrics, add_metrics
+from profiling import profiled
+from readings import device_of
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+ARCHIVE_FOLDER = os.getenv('ARCHIVE_FOLDER', 'archive')
+DAILY_FILE_KEY_PATTERN = re.compile(r'^(\d{4}-\d{2})-\d{2}(-predictions|-keys)?$')
+READINGS = 'readings'
+PREDICTIONS = 'predictions'
+# Number of ranged GETs made at the same time when reading the archive objects of several series
+ARCHIVE_READ_CONCURRENCY = 8
+
+
+# Daily files are compacted once their month is over. Each month gets one archive object per device (and one for the
+# predictions) holding the readings sorted by time, written as a gzip member per hour of JSON lines. Gzip members can
+# be decompressed on their own or concatenated, so any range of hours can be read with a single ranged GET.
+#
+# The month's index lists the archive objects along with the offset, length and number of readings of each hour:
+# {"month": "2023-05", "series": {"readings/<device>": {"key": ..., "hours": {"2023-05-01T00": [offset, length, count],
+# ...}}, "predictions": {...}}}
+#
+# Each day in the month's archive objects also gets an index of its own, with the byte range of the day in each of them,
+# so that reading a single day (see load_daily_file) doesn't load the index of the whole fleet for the month:
+# {"date": "2023-05-01", "series": {"readings/<device>": [key, offset, length, count], ...}}
+#
+# Readings are archived by the hour they were taken in, in the archive of the month they arrived in (i.e. the month of
+# the daily file they were stored in), so the readings taken late in a month can be in the following month's archive.
+# Readers look up both. Archive objects are never overwritten, a month that is compacted again (e.g. because late
+# readings arrived after it was compacted) gets new objects and the indexes are replaced last, the month's index after
+# the day indexes, so readers always see a consistent index.
+
+# Lambda function that compacts the daily files of every complete month and deletes them once they are archived.
+# Returns the compacted months.
+@profiled
+@handler_metrics
+def compact_daily_files(event, context):
+    current_month = datetime.datetime.now().strftime('%Y-%m')
+    daily_file_keys_by_month = {}
+    for file_key in list_files(delimiter='/'):
+        match = DAILY_FILE_KEY_PATTERN.match(file_key)
+        if match and match.group(1) < current_month:
+            daily_file_keys_by_month.setdefault(match.group(1), []).append(file_key)
+
+    compacted_months = []
+    for month, daily_file_keys in sorted(daily_file_keys_by_month.items()):
+        try:
+            compact_month(month, daily_file_keys)
+            compacted_months.append(month)
+        except Exception as e:
+            log.error(f"An error occurred while compacting {month}, its daily files were kept: {e}")
+    return compacted_months
+
+
+# Merges the daily files into the month's archive, then deletes them
+def compact_month(month, daily_file_keys):
+    index = load_archive_index(month) or {'month': month, 'series': {}}
+    entries_by_series = {series: _load_series(archive) for series, archive in index['series'].items()}
+    for file_key in daily_file_keys:
+        if file_key.endswith('-keys'):
+            continue
+        json_data = load_file_as_json(file_key)
+        if json_data is None:
+            raise IOError(f'Unable to load {file_key}')
+        for entry in json_data['entries']:
+            series = PREDICTIONS if file_key.endswith('-predictions') else f'{READINGS}/{device_of(entry)}'
+            entries_by_series.setdefault(series, []).append(entry)
+
+    generation = int(time.time() * 1000)
+    updated_index = {'month': month, 'series': {}}
+    for series, entries in sorted(entries_by_series.items()):
+        archive_key = f'{ARCHIVE_FOLDER}/{month}/{series}-{generation}.jsonl.gz'
+        content, hours = _compress_by_hour(_unique_by_device_and_time(entries))
+        add_metrics('Archived', Records=len(entries), BytesWritten=len(content))
+        store_file(archive_key, content)
+        updated_index['series'][series] = {'key': archive_key, 'hours': hours}
+        log.info(f"Archived {sum(hour[2] for hour in hours.values())} entries in {archive_key} ({len(content)} bytes)")
+
+    for date, day_index in sorted(_index_by_day(updated_index).items()):
+        store_file(get_day_index_file_key(month, date), json.dumps(day_index).encode('utf-8'))
+    store_file(get_archive_index_file_key(month), json.dumps(updated_index).encode('utf-8'))
+    archive_keys = {archive['key'] for archive in updated_index['series'].values()}
+    replaced_keys = [archive['key'] for archive in index['series'].values() if archive['key'] not in archive_keys]
+    failed_keys = delete_files(daily_file_keys + replaced_keys)
+    if failed_keys:
+        log.warning(f"Unable to delete {len(failed_keys)} archived files, they will be compacted again: {failed_keys}")
+
+
+def get_archive_index_file_key(month):
+    return f'{ARCHIVE_FOLDER}/{month}/index.json'
+
+
+def get_day_index_file_key(month, date):
+    return f'{ARCHIVE_FOLDER}/{month}/days/{date}.json'
+
+
+# Returns None if the month wasn't archived. Errors loading the index are raised so that a month isn't compacted again
+# without the entries it already archived.
+def load_archive_index(month):
+    return load_file_as_json(get_archive_index_file_key(month), raise_errors=True)
+
+
+# Loads the archived entries taken between the start and end dates (inclusive), either readings or predictions,
+# sorted by time. Only the hours in the range are read, with one ranged GET per device per month (including the month
+# following the range, see above).
+def load_archived_entries(start_date, end_date, kind=READINGS):
+    first_hour = start_date.strftime('%Y-%m-%dT00')
+    last_hour = end_date.strftime('%Y-%m-%dT23')
+    ranges = []
+    for month in _archived_months(_months_between(start_date, end_date)):
+        index = load_archive_index(month)
+        if not index:
+            continue
+
+        for series, archive in index['series'].items():
+            if series.split('/')[0] != kind:
+                continue
+            hours = [offsets for hour, offsets in archive['hours'].items() if first_hour <= hour <= last_hour]
+            if hours:
+                ranges.append([archive['key']] + _span(hours))
+
+    return _load_ranges(ranges)
+
+
+# Drop in replacement for data_store.load_file_as_json for daily files ("YYYY-MM-DD" and "YYYY-MM-DD-predictions")
+# that falls back to the archive once the daily file has been compacted. The archive is read through the day's
+# indexes, the day's byte range of each series being read concurrently.
+def load_daily_file(file_key):
+    json_data = load_file_as_json(file_key)
+    match = re.match(r'^(\d{4}-\d{2}-\d{2})(-predictions)?$', file_key)
+    if json_data is not None or not match or match.group(1)[:7] >= datetime.datetime.now().strftime('%Y-%m'):
+        return json_data
+
+    date = match.group(1)
+    kind = PREDICTIONS if match.group(2) else READINGS
+    ranges = []
+    for month in _archived_months([date[:7]]):
+        day_index = load_file_as_json(get_day_index_file_key(month, date), raise_errors=True) or {'series': {}}
+        ranges.extend(archive_range for series, archive_range in day_index['series'].items()
+                      if series.split('/')[0] == kind)
+    entries = _load_ranges(ranges)
+    return {'entries': entries} if entries else None
+
+
+# Reads the [key, offset, length, ...] ranges of the archive objects and merges their entries by time
+def _load_ranges(ranges):
+    if len(ranges) <= 1:
+        entries_by_series = [_load_range(archive_range) for archive_range in ranges]
+    else:
+        with ThreadPoolExecutor(max_workers=ARCHIVE_READ_CONCURRENCY) as executor:
+            entries_by_series = list(executor.map(_load_range, ranges))
+    return list(merge(*entries_by_series, key=lambda entry: entry['t']))
+
+
+def _load_range(archive_range):
+    file_key, offset, length = archive_range[:3]
+    content = load_file_range(file_key, offset, length)
+    if content is None:
+        raise IOError(f'Unable to load {file_key}')
+    return _decompress_entries(content)
+
+
+# The [offset, length, count] of the given hours of an archive object. The hours are stored in order so they are
+# contiguous.
+def _span(hours):
+    start = min(offset for offset, length, count in hours)
+    end = max(offset + length for offset, length, count in hours)
+    return [start, end - start, sum(count for offset, length, count in hours)]
+
+
+def _index_by_day(index):
+    day_indexes = {}
+    for series, archive in index['series'].items():
+        hours_by_day = {}
+        for hour, offsets in archive['hours'].items():
+            hours_by_day.setdefault(hour[:len('YYYY-MM-DD')], []).append(offsets)
+        for date, hours in hours_by_day.items():
+            day_index = day_indexes.setdefault(date, {'date': date, 'series': {}})
+            day_index['series'][series] = [archive['key']] + _span(hours)
+    return day_indexes
+
+
+def _load_series(archive):
+    content = load_file_as_bytes(archive['key'])
+    if content is None:
+        raise IOError(f"Unable to load {archive['key']}")
+    return _decompress_entries(content)
+
+
+def _compress_by_hour(entries):
+    content = bytearray()
+    hours = {}
+    for hour, hour_entries in groupby(entries, key=_hour_of):
+        lines = [json.dumps(entry) for entry in hour_entries]
+        member = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'), mtime=0)
+        hours[hour] = [len(content), len(member), len(lines)]
+        content += member
+    return bytes(content), hours
+
+
+def _decompress_entries(content):
+    return [json.loads(line) for line in gzip.decompress(content).decode('utf-8').splitlines()]
+
+
+# Sorts the entries by time, keeping the first of any entries with the same device and time (i.e. an entry archived
+# again). Predictions of every device share a series, so entries with the same time but another device are kept.
+def _unique_by_device_and_time(entries):
+    seen = set()
+    unique_entries = []
+    for entry in sorted(entries, key=lambda entry: entry['t']):
+        if (entry.get('device'), entry['t']) not in seen:
+            seen.add((entry.get('device'), entry['t']))
+            unique_entries.append(entry)
+    return unique_entries
+
+
+def _hour_of(entry):
+    return datetime.datetime.fromtimestamp(entry['t'] / 1000, datetime.timezone.utc).strftime('%Y-%m-%dT%H')
+
+
+# The months whose archives can hold entries of the given months: those months and the ones following them, as long as
+# they are complete (the current month isn't archived yet)
+def _archived_months(months):
+    current_month = datetime.datetime.now().strftime('%Y-%m')
+    following_months = [_following_month(month) for month in months]
+    return [month for month in sorted(set(months + following_months)) if month < current_month]
+
+
+def _following_month(month):
+    return (datetime.datetime.strptime(month, '%Y-%m') + datetime.timedelta(days=32)).strftime('%Y-%m')
+
+
+def _months_between(start_date, end_date):
+    months = []
+    month = start_date.replace(day=1)
+    while month <= end_date:
+        months.append(month.strftime('%Y-%m'))
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return months
@@ -0,0 +1,31 @@
+import threading
+import boto3
+from botocore.config import Config
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# Returns a boto3 client for the given service that is created once per container and reused on subsequent calls.
+# Clients are thread safe once created, but creating them is not, so creation is guarded by a lock. Any extra keyword
+# arguments are passed through to botocore's Config (e.g. max_pool_connections, retries).
+def get_client(service_name, region_name=None, **config_options):
+    cache_key = (service_name, region_name, repr(sorted(config_options.items())))
+    client = _clients.get(cache_key)
+    if client:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if not client:
+            config = Config(**config_options) if config_options else None
+            client = boto3.client(service_name, region_name=region_name, config=config)
+            _clients[cache_key] = client
+    return client
+
+
+# Drops all cached clients so that the next call to get_client creates new ones. Mostly useful for tests which change
+# the environment (region, credentials, mocks) between runs.
+def reset_clients():
+    with _clients_lock:
+        _clients.clear()
@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# Measures what each Lambda handler module costs on cold start: the time to import it in a fresh interpreter and the
+# memory it takes once imported. Exits with an error if a handler module goes over its import time budget or imports
+# one of the heavy dependencies, which should only be imported by the functions that need them.
+#
+# Usage (from aws-iot/): python benchmarks/cold_start.py [--repeat 5] [--budget-ms 400] [--json]
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HEAVY_MODULES = ['pandas', 'numpy', 'sklearn', 'unzip_requirements']
+DEFAULT_BUDGET_MS = 400
+
+# Run in a fresh interpreter for each measurement so that nothing is already imported
+MEASURE_IMPORT = """
+import importlib, json, resource, sys, time
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+import_ms = (time.perf_counter() - start) * 1000
+rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'import_ms': import_ms, 'rss_kb': rss_after, 'import_rss_kb': rss_after - rss_before,
+                  'modules': sorted(sys.modules)}))
+"""
+
+
+def main():
+    args = _parse_args()
+    results = [measure(module, args.repeat) for module in _handler_modules()]
+    failures = [result for result in results if _check(result, args.budget_ms)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'module':<16}{'import ms':>12}{'import MB':>12}{'total MB':>12}  handlers / heavy modules")
+        for result in results:
+            print(f"{result['module']:<16}{result['import_ms']:>12.1f}{result['import_rss_kb'] / 1024:>12.1f}"
+                  f"{result['rss_kb'] / 1024:>12.1f}  {', '.join(result['handlers'])}"
+                  f"{' / ' + ', '.join(result['heavy_modules']) if result['heavy_modules'] else ''}")
+
+    for result in failures:
+        print(f"{result['module']}: {_check(result, args.budget_ms)}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+# Imports the module in a fresh interpreter repeat times, reporting the median import time and memory
+def measure(module, repeat):
+    environment = dict(os.environ, S3_BUCKET=os.getenv('S3_BUCKET', 'cold-start-bucket'),
+                       AWS_DEFAULT_REGION=os.getenv('AWS_DEFAULT_REGION', 'us-west-1'))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', MEASURE_IMPORT, module], cwd=SERVICE_DIR, env=environment,
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output))
+
+    return {
+        'module': module,
+        'handlers': sorted(_handler_modules()[module]),
+        'import_ms': statistics.median(run['import_ms'] for run in runs),
+        'import_rss_kb': statistics.median(run['import_rss_kb'] for run in runs),
+        'rss_kb': statistics.median(run['rss_kb'] for run in runs),
+        'heavy_modules': [name for name in HEAVY_MODULES if name in runs[0]['modules']]
+    }
+
+
+# Returns the handler modules declared in serverless.yml along with their handler functions
+def _handler_modules():
+    with open(os.path.join(SERVICE_DIR, 'serverless.yml')) as serverless_file:
+        handlers = re.findall(r'^\s*handler:\s*(\w+)\.(\w+)', serverless_file.read(), re.MULTILINE)
+    modules = {}
+    for module, function in handlers:
+        modules.setdefault(module, set()).add(function)
+    return modules
+
+
+def _check(result, budget_ms):
+    if result['heavy_modules']:
+        return f"imports {', '.join(result['heavy_modules'])} at module level"
+    if result['import_ms'] > budget_ms:
+        return f"import took {result['import_ms']:.1f}ms, over the {budget_ms}ms budget"
+    return None
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Reports the cold start import time and memory of each handler')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh imports to take the median of')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Maximum import time of a handler module')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
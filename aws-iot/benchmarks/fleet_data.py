@@ -0,0 +1,52 @@
+import datetime
+import math
+import random
+
+# Synthetic sensor data for benchmarks. Each device follows a daily cycle (warmest and driest in the afternoon) around
+# its own baseline, with a slow pressure drift and some noise, so that the data looks enough like real readings for
+# the models to have something to fit.
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def device_names(device_count):
+    return [f'bench-device-{i:05d}' for i in range(device_count)]
+
+
+# Yields (day, readings_by_device) for each of the days ending today (UTC), readings_by_device holding every device's
+# readings of the day taken every interval_secs
+def generate_fleet_days(device_count, days, interval_secs, seed=0):
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    devices = create_devices(device_count, seed)
+    for day_offset in range(days - 1, -1, -1):
+        day = today - datetime.timedelta(days=day_offset)
+        day_start = int(datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc).timestamp())
+        readings_by_device = {device.name: [device.read(day_start + secs)
+                                            for secs in range(0, SECONDS_PER_DAY, int(interval_secs))]
+                              for device in devices}
+        yield day, readings_by_device
+
+
+# Devices that can be read at any time, each with its own baseline and random number generator
+def create_devices(device_count, seed=0):
+    return [SyntheticDevice(name, random.Random(f'{seed}-{name}')) for name in device_names(device_count)]
+
+
+class SyntheticDevice:
+
+    def __init__(self, name, rng):
+        self.name = name
+        self.rng = rng
+        self.temperature = rng.uniform(15, 25)
+        self.humidity = rng.uniform(40, 60)
+        self.pressure = rng.uniform(1000, 1025)
+
+    def read(self, epoch_secs):
+        daily_cycle = math.sin(2 * math.pi * ((epoch_secs % SECONDS_PER_DAY) / SECONDS_PER_DAY - 0.375))
+        drift = math.sin(2 * math.pi * epoch_secs / (5 * SECONDS_PER_DAY))
+        return {
+            't': epoch_secs * 1000,
+            'tmp': round(self.temperature + 4 * daily_cycle + self.rng.gauss(0, 0.2), 2),
+            'hum': round(self.humidity - 8 * daily_cycle + self.rng.gauss(0, 0.5), 2),
+            'pr': round(self.pressure + 3 * drift + self.rng.gauss(0, 0.1), 2)
+        }
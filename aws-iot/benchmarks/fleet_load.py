@@ -0,0 +1,333 @@
+import argparse
+import base64
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import time
+
+import numpy as np
+
+# Importing the pipeline benchmark configures the handlers and puts them on the path
+from pipeline import CountingBackend, RESULTS_DIR, create_storage, git_commit, quiet
+import api
+import data_store
+from fleet_data import create_devices
+
+DEVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'iot-device'))
+SQS_LAMBDA_BATCH_SIZE = 10
+
+
+# The payloads are built with the device code itself. Its wire_format module shares its name with the decoder in
+# aws-iot so the device modules are loaded under their own names.
+def _load_device_module(name):
+    spec = importlib.util.spec_from_file_location(f'device_{name}', os.path.join(DEVICE_DIR, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+device_payloads = _load_device_module('payloads')
+device_wire_format = _load_device_module('wire_format')
+
+
+# Simulates a fleet of devices publishing to the ingest path, to see how it behaves with many more devices than the
+# one Pi. Time is simulated, the handlers run as fast as they can:
+#
+# - every device takes a reading every --sample-interval seconds (+/- --jitter of it) and publishes its readings in
+#   batches of --batch-size, as JSON or in the binary wire format, the way DataEndpoint does
+# - devices go offline (on average --outage-rate times per hour for about --outage-secs) and buffer their readings
+#   while they are, then drain the backlog in bursts of up to --drain-batch-size readings at --drain-rate batches per
+#   second like the publish daemon
+# - published payloads go through event_receiver into a local queue, which data_appender consumes in SQS sized batches
+#   every --tick seconds (at most --consumer-batches per tick if set, to model limited consumer concurrency)
+#
+# Reports the sustained ingest throughput (readings stored per second of handler time), the delay from a reading being
+# taken until fetch_metrics returns it (for the readings of --probe-devices devices, in simulated seconds), how long
+# messages wait in the queue and the storage write amplification (bytes written to storage per byte of readings
+# stored), e.g.
+#
+#   python benchmarks/fleet_load.py --devices 1000 --duration 3600 --batch-size 10
+def main():
+    args = _parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    storage = CountingBackend(create_storage(args.storage))
+    data_store.set_backend(storage)
+
+    with quiet():
+        results = run_fleet_load(args, storage)
+    results.update({
+        'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': vars(args)
+    })
+    _print_results(results)
+    output_path = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}-fleet-{args.devices}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Results written to {output_path}')
+
+
+def run_fleet_load(args, storage):
+    start = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0).timestamp()
+    devices = [_FleetDevice(device, args, start) for device in create_devices(args.devices, args.seed)]
+    probes = {device.name: set() for device in devices[:args.probe_devices]}
+    queue = LocalQueue()
+    api._sqs = lambda: queue
+    receiver_latencies = []
+    appender_latencies = []
+    delays = []
+    stored_days = set()
+
+    for now in np.arange(start + args.tick, start + args.duration + args.tick / 2, args.tick).tolist():
+        for device in devices:
+            for event, readings in device.advance(now):
+                if device.name in probes:
+                    probes[device.name].update(reading['t'] for reading in readings)
+                queue.clock = now
+                receiver_latencies.append(_call(api.event_receiver, event,
+                                                lambda response: response['statusCode'] == 200))
+
+        api.datetime = _clock_at(now)
+        stored_days.add(datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d'))
+        for records in queue.receive(now, args.consumer_batches):
+            appender_latencies.append(_call(api.data_appender, {'Records': records},
+                                            lambda response: not response['batchItemFailures']))
+        delays.extend(_probe(probes, now, storage))
+
+    storage_usage = storage.snapshot()
+    published_readings = sum(device.published for device in devices)
+    stored_readings, stored_bytes = _stored_readings(stored_days)
+    handler_secs = sum(receiver_latencies) + sum(appender_latencies)
+    return {
+        'published': {
+            'readings': published_readings,
+            'payloads': len(receiver_latencies),
+            'buffered_at_end': sum(len(device.backlog) for device in devices),
+            'bytes': sum(device.published_bytes for device in devices)
+        },
+        'ingest': {
+            'readings_stored': stored_readings,
+            'readings_per_sec': round(stored_readings / handler_secs, 1) if handler_secs else None,
+            'event_receiver': _handler_stats(receiver_latencies),
+            'data_appender': _handler_stats(appender_latencies),
+            'messages': queue.sent,
+            'max_queue_depth': queue.max_depth,
+            'queued_at_end': len(queue.messages)
+        },
+        'delay_secs': _percentiles(delays, 1),
+        'queue_wait_secs': _percentiles(queue.waits, 1),
+        'storage': {
+            'requests': storage_usage['requests'],
+            'bytes_written': storage_usage['bytes_written'],
+            'readings_bytes': stored_bytes,
+            'write_amplification': round(storage_usage['bytes_written'] / stored_bytes, 1) if stored_bytes else None
+        }
+    }
+
+
+# Calls the handler and returns how long it took, failing the run if the response isn't successful
+def _call(handler, event, succeeded):
+    started = time.perf_counter()
+    response = handler(event, None)
+    latency = time.perf_counter() - started
+    if not succeeded(response):
+        raise RuntimeError(f'{handler.__name__} failed: {response}')
+    return latency
+
+
+# Queries fetch_metrics for the probed readings that were not returned yet and returns how long ago the ones it now
+# returns were taken. Only the entries after the oldest outstanding reading are fetched (with a cursor) to keep the
+# responses small. The probes bypass the counting backend so that their reads are
+# left out of the storage figures.
+def _probe(probes, now, storage):
+    outstanding = [t for readings in probes.values() for t in readings]
+    if not outstanding:
+        return []
+
+    data_store.set_backend(storage.backend)
+    try:
+        response = api.fetch_metrics({'queryStringParameters': {
+            'date': datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d'), 'cursor': f'{min(outstanding)}.0'}},
+            None)
+    finally:
+        data_store.set_backend(storage)
+
+    delays = []
+    for entry in json.loads(response['body'])['entries']:
+        if entry['t'] in probes.get(entry.get('device'), ()):
+            probes[entry['device']].remove(entry['t'])
+            delays.append(now - entry['t'] / 1000)
+    return delays
+
+
+def _stored_readings(days):
+    readings = [reading for day in sorted(days) for reading in (data_store.load_file_as_json(day) or {})['entries']]
+    return len(readings), sum(len(json.dumps(reading)) for reading in readings)
+
+
+def _handler_stats(latencies):
+    return {'calls': len(latencies), 'secs': round(sum(latencies), 3),
+            'latency_ms': _percentiles([latency * 1000 for latency in latencies], 3)}
+
+
+def _percentiles(values, digits):
+    if not values:
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99]).tolist()
+    return {'p50': round(p50, digits), 'p90': round(p90, digits), 'p99': round(p99, digits),
+            'max': round(max(values), digits)}
+
+
+# A simulated device taking readings with jitter, going through outages and draining its backlog afterwards
+class _FleetDevice:
+
+    def __init__(self, device, args, start):
+        self.device = device
+        self.name = device.name
+        self.args = args
+        self.rng = random.Random(f'{args.seed}-{device.name}-behaviour')
+        self.next_reading = start + self.rng.uniform(0, args.sample_interval)
+        self.offline_until = None
+        self.backlog = []
+        self.next_drain = start
+        self.published = 0
+        self.published_bytes = 0
+
+    # Takes the readings due by now and returns the (event, readings) payloads published
+    def advance(self, now):
+        while self.next_reading <= now:
+            self._reconnect_if_due(self.next_reading)
+            if not self.offline_until and self.rng.random() < self.args.outage_rate * self.args.sample_interval / 3600:
+                self.offline_until = self.next_reading + self.args.outage_secs * self.rng.uniform(0.5, 1.5)
+            self.backlog.append(self.device.read(round(self.next_reading)))
+            jitter = self.rng.uniform(-self.args.jitter, self.args.jitter)
+            self.next_reading += self.args.sample_interval * (1 + jitter)
+
+        self._reconnect_if_due(now)
+        if self.offline_until:
+            return []
+        return self._publish(now)
+
+    def _reconnect_if_due(self, now):
+        if self.offline_until and now >= self.offline_until:
+            self.offline_until = None
+            self.next_drain = now
+
+    # Batches of batch_size are published as soon as they are full. A backlog larger than a batch is drained in
+    # batches of up to drain_batch_size, no faster than drain_rate of them per second.
+    def _publish(self, now):
+        payloads = []
+        while len(self.backlog) >= self.args.batch_size:
+            if len(self.backlog) > self.args.batch_size:
+                if self.next_drain > now:
+                    break
+                self.next_drain += 1 / self.args.drain_rate
+            batch_size = max(self.args.batch_size, min(len(self.backlog), self.args.drain_batch_size))
+            readings, self.backlog = self.backlog[:batch_size], self.backlog[batch_size:]
+            payloads.append((self._build_event(readings), readings))
+            self.published += len(readings)
+        self.next_drain = max(self.next_drain, now)
+        return payloads
+
+    # Builds the event that the IoT rule would pass to event_receiver, which base64 encodes binary payloads. Like
+    # DataEndpoint, readings that the binary format can't represent are sent as JSON.
+    def _build_event(self, readings):
+        if self.args.wire_format == 'binary':
+            try:
+                payload = device_wire_format.encode_readings(readings, self.name)
+                self.published_bytes += len(payload)
+                return {'bin': base64.b64encode(payload).decode('ascii')}
+            except ValueError:
+                pass
+
+        event = device_payloads.build_batch_payload(self.name, readings)
+        self.published_bytes += len(json.dumps(event))
+        return event
+
+
+# Stands in for SQS, keeping the messages sent along with the simulated time they were sent at
+class LocalQueue:
+
+    def __init__(self):
+        self.messages = []
+        self.clock = None
+        self.sent = 0
+        self.max_depth = 0
+        self.waits = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.messages.extend((self.clock, entry['MessageBody']) for entry in Entries)
+        self.sent += len(Entries)
+        self.max_depth = max(self.max_depth, len(self.messages))
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    # Yields up to max_batches (all of them if not set) batches of SQS records at the simulated time now, oldest
+    # messages first
+    def receive(self, now, max_batches=None):
+        batches = 0
+        while self.messages and (not max_batches or batches < max_batches):
+            batch, self.messages = self.messages[:SQS_LAMBDA_BATCH_SIZE], self.messages[SQS_LAMBDA_BATCH_SIZE:]
+            self.waits.extend(now - sent_at for sent_at, body in batch)
+            batches += 1
+            yield [{'messageId': str(self.sent + i), 'body': body} for i, (sent_at, body) in enumerate(batch)]
+
+
+def _clock_at(epoch_secs):
+    now = datetime.datetime.fromtimestamp(epoch_secs)
+
+    class SimulatedDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now if tz is None else now.astimezone(tz)
+    return SimulatedDatetime
+
+
+def _print_results(results):
+    ingest = results['ingest']
+    print(f"Published {results['published']['readings']} readings in {results['published']['payloads']} payloads, "
+          f"stored {ingest['readings_stored']}")
+    print(f"Ingest throughput: {ingest['readings_per_sec']} readings/s "
+          f"(event_receiver {ingest['event_receiver']['secs']}s, data_appender {ingest['data_appender']['secs']}s, "
+          f"max queue depth {ingest['max_queue_depth']})")
+    for name in ('delay_secs', 'queue_wait_secs'):
+        print(f"{name}: " + ', '.join(f'{key} {value}' for key, value in results[name].items()))
+    storage = results['storage']
+    print(f"Storage: {sum(storage['requests'].values())} requests, {storage['bytes_written'] / 2 ** 20:.1f} MB written "
+          f"for {storage['readings_bytes'] / 2 ** 20:.1f} MB of readings "
+          f"(write amplification {storage['write_amplification']}x)")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Simulates a fleet of devices publishing to the ingest path')
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=3600, help='Simulated seconds to run for')
+    parser.add_argument('--sample-interval', type=float, default=60, help='Seconds between the readings of a device')
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help='Maximum deviation of the sample interval, as a fraction of it')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of readings a device publishes together')
+    parser.add_argument('--wire-format', type=str, default='json', choices=['json', 'binary'])
+    parser.add_argument('--outage-rate', type=float, default=0.1, help='Average outages per device per hour')
+    parser.add_argument('--outage-secs', type=float, default=600, help='Average length of an outage')
+    parser.add_argument('--drain-batch-size', type=int, default=device_payloads.MAX_BATCH_SIZE,
+                        help='Maximum number of readings in a batch of backlog')
+    parser.add_argument('--drain-rate', type=float, default=2, help='Batches of backlog published per second')
+    parser.add_argument('--tick', type=float, default=10, help='Simulated seconds between polls of the queue')
+    parser.add_argument('--consumer-batches', type=int, default=0,
+                        help='Maximum SQS batches consumed per tick, 0 consumes the whole queue')
+    parser.add_argument('--probe-devices', type=int, default=5,
+                        help='Number of devices whose readings are looked for with fetch_metrics')
+    parser.add_argument('--storage', type=str, default='memory', choices=['memory', 'local'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='Path of the results file, defaults to benchmarks/results')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
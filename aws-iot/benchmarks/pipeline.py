@@ -0,0 +1,394 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SAGEMAKER_DIR = os.path.abspath(os.path.join(SERVICE_DIR, '..', 'sagemaker'))
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+# The handlers read their configuration when they are imported
+os.environ.setdefault('S3_BUCKET', 'benchmark-bucket')
+os.environ.setdefault('AGGREGATES_FOLDER', 'aggregates')
+os.environ.setdefault('QUEUE_URL', 'benchmark-queue')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-1')
+
+import api  # noqa: E402
+import data_store  # noqa: E402
+import endpoint_invoker  # noqa: E402
+import predict  # noqa: E402
+import prepare  # noqa: E402
+from fleet_data import generate_fleet_days  # noqa: E402
+from forecast_features import FORECAST_HORIZON_DAYS, FORECAST_RESOLUTION_SECS, SECONDS_PER_DAY  # noqa: E402
+from model_types import MODEL_TYPES  # noqa: E402
+from storage_backends import create_backend, LocalFileBackend  # noqa: E402
+
+DAYS_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+MODEL_BUNDLE_KEY = 'models/benchmark-forecast-models.npz'
+SQS_LAMBDA_BATCH_SIZE = 10
+
+
+# Runs the whole pipeline on synthetic fleet data against local stand-ins for S3 (a data_store backend), SQS (a list)
+# and the SageMaker runtime (models fit locally with least squares, like the LinearRegression in sagemaker/train.py):
+#
+#   ingest:  devices publish batches of readings to event_receiver, which queues them
+#   append:  data_appender consumes the queue in SQS sized batches, one simulated day at a time
+#   prepare: generate_csv_from_daily_data aggregates the last 30 days into the training CSV
+#   fit:     with --models bundle (the default), the per device models are fit on the CSV with the training script's
+#            fit_device_models. With --models endpoints, a global model per metric is fit instead.
+#   predict: predict_daily_atmospheric_metrics scores the forecast horizon of every device against the model bundle,
+#            or of the fleet against the endpoints
+#
+# Each stage reports its wall time, throughput, call latency percentiles, storage requests, bytes read and written and
+# peak (Python) memory. Results are written as JSON to benchmarks/results so that runs can be compared, e.g.
+#
+#   python benchmarks/pipeline.py --devices 10 --days 7 --interval 60
+#   python benchmarks/pipeline.py --devices 10 --days 7 --interval 60 --baseline benchmarks/results/<earlier>.json
+def main():
+    args = _parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    storage = CountingBackend(create_storage(args.storage))
+    data_store.set_backend(storage)
+    queue = []
+    models = {}
+    api._sqs = lambda: FakeSqs(queue)
+    endpoint_invoker._get_runtime_client = lambda concurrency: FakeRuntime(models, args.endpoint_latency_ms / 1000)
+
+    stages = []
+    with quiet():
+        stages.append(_ingest(args, storage, queue))
+        stages.append(_append(storage, queue))
+        prepare_stage, aggregate_file_key = _prepare(storage)
+        stages.append(prepare_stage)
+        if args.models == 'bundle':
+            stages.append(_fit_bundle(storage, aggregate_file_key, args.min_device_rows))
+            stages.append(_predict_with_bundle(storage, aggregate_file_key, args.devices))
+        else:
+            stages.append(_fit(storage, aggregate_file_key, models))
+            stages.append(_predict(storage, aggregate_file_key, models))
+
+    results = {
+        'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'stages': stages
+    }
+    _print_results(results, _load_baseline(args.baseline))
+    output_path = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}-{args.devices}x{args.days}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Results written to {output_path}')
+
+
+def _ingest(args, storage, queue):
+    readings_count = 0
+    calls = []
+    for day, readings_by_device in generate_fleet_days(args.devices, args.days, args.interval, args.seed):
+        for device, readings in readings_by_device.items():
+            readings_count += len(readings)
+            for i in range(0, len(readings), args.batch_size):
+                calls.append(_event_receiver_call(day, device, readings[i:i + args.batch_size]))
+    stage = _run_stage('ingest', storage, calls)
+    stage['records'] = readings_count
+    stage['messages'] = len(queue)
+    return _with_throughput(stage)
+
+
+def _event_receiver_call(day, device, readings):
+    def call():
+        _simulated_day['day'] = day
+        response = api.event_receiver({'device': device, 'entries': readings}, None)
+        if response['statusCode'] != 200:
+            raise RuntimeError(f'event_receiver failed: {response}')
+    return call
+
+
+# data_appender stores readings in the file of the day they arrive, so the clock is set to each simulated day in turn
+def _append(storage, queue):
+    calls = []
+    for i in range(0, len(queue), SQS_LAMBDA_BATCH_SIZE):
+        records = [{'messageId': str(i + j), 'body': body}
+                   for j, (day, body) in enumerate(queue[i:i + SQS_LAMBDA_BATCH_SIZE])]
+        calls.append(_data_appender_call(queue[i][0], records))
+    stage = _run_stage('append', storage, calls)
+    stage['records'] = sum(len(json.loads(body)['entries']) for day, body in queue)
+    return _with_throughput(stage)
+
+
+def _data_appender_call(day, records):
+    def call():
+        api.datetime = _clock_at(day)
+        response = api.data_appender({'Records': records}, None)
+        if response['batchItemFailures']:
+            raise RuntimeError(f'data_appender failed: {response}')
+    return call
+
+
+def _prepare(storage):
+    aggregate_file_keys = []
+    stage = _run_stage('prepare', storage,
+                       [lambda: aggregate_file_keys.append(prepare.generate_csv_from_daily_data({}, None))])
+    stage['records'] = len(data_store.load_file_as_string(aggregate_file_keys[0]).splitlines()) - 1
+    return _with_throughput(stage), aggregate_file_keys[0]
+
+
+def _fit(storage, aggregate_file_key, models):
+    def fit():
+        rows = data_store.load_file_as_string(aggregate_file_key).splitlines()[1:]
+        columns = list(zip(*(row.split(',') for row in rows)))
+        metrics = {metric_type: np.array(columns[i + 2], dtype=np.float64) for i, metric_type in enumerate(MODEL_TYPES)}
+        time_of_day = np.array(columns[1], dtype=np.float64)
+        days_of_week = np.array([[day == day_of_week for day_of_week in DAYS_OF_WEEK] for day in columns[0]],
+                                dtype=np.float64)
+        for metric_type in MODEL_TYPES:
+            features = np.column_stack([time_of_day] + [metrics[other] for other in MODEL_TYPES if other != metric_type]
+                                       + [days_of_week, np.ones(len(rows))])
+            models[metric_type] = np.linalg.lstsq(features, metrics[metric_type], rcond=None)[0]
+        fit.records = len(rows)
+    stage = _run_stage('fit', storage, [fit])
+    stage['records'] = fit.records
+    return _with_throughput(stage)
+
+
+def _fit_bundle(storage, aggregate_file_key, min_device_rows):
+    sys.path.insert(0, SAGEMAKER_DIR)
+    import pandas as pd
+    import train
+
+    def fit():
+        aggregate_df = pd.read_csv(io.StringIO(data_store.load_file_as_string(aggregate_file_key)))
+        bundle = train.fit_device_models(aggregate_df, min_device_rows)
+        data_store.store_file(MODEL_BUNDLE_KEY, train.build_model_bundle_bytes(bundle))
+        fit.records = len(aggregate_df)
+    stage = _run_stage('fit', storage, [fit])
+    stage['records'] = fit.records
+    return _with_throughput(stage)
+
+
+def _predict_with_bundle(storage, aggregate_file_key, device_count):
+    stage = _run_stage('predict', storage, [lambda: predict.predict_daily_atmospheric_metrics(
+        {'aggregateFileKey': aggregate_file_key, 'modelBundleKey': MODEL_BUNDLE_KEY}, None)])
+    stage['records'] = device_count * len(MODEL_TYPES) * FORECAST_HORIZON_DAYS * SECONDS_PER_DAY \
+        // FORECAST_RESOLUTION_SECS
+    return _with_throughput(stage)
+
+
+def _predict(storage, aggregate_file_key, models):
+    endpoints = {f'{model_type}-endpoint': model_type for model_type in MODEL_TYPES}
+    stage = _run_stage('predict', storage, [lambda: predict.predict_daily_atmospheric_metrics(
+        {'aggregateFileKey': aggregate_file_key, 'endpoints': endpoints}, None)])
+    latencies = FakeRuntime.latencies
+    stage['records'] = len(latencies)
+    stage['endpoint_latency_ms'] = _percentiles(latencies)
+    return _with_throughput(stage)
+
+
+# Runs the calls one after another, measuring each of them along with the whole stage
+def _run_stage(name, storage, calls):
+    storage.reset()
+    tracemalloc.start()
+    latencies = []
+    started = time.perf_counter()
+    for call in calls:
+        call_started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_started)
+    duration = time.perf_counter() - started
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'stage': name,
+        'duration_secs': round(duration, 3),
+        'calls': len(calls),
+        'latency_ms': _percentiles(latencies),
+        'storage': storage.snapshot(),
+        'peak_memory_mb': round(peak_memory / 2 ** 20, 1)
+    }
+
+
+def _with_throughput(stage):
+    stage['records_per_sec'] = round(stage['records'] / stage['duration_secs'], 1) if stage['duration_secs'] else None
+    return stage
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return {}
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99]).tolist()
+    return {'p50': round(p50, 3), 'p90': round(p90, 3), 'p99': round(p99, 3), 'max': round(max(latencies) * 1000, 3)}
+
+
+# Wraps a data_store backend, counting the requests made and bytes moved
+class CountingBackend:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def snapshot(self):
+        return {'requests': dict(self.requests), 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written}
+
+    def load(self, file_key):
+        return self._read('load', self.backend.load(file_key))
+
+    def load_range(self, file_key, offset, length):
+        return self._read('load_range', self.backend.load_range(file_key, offset, length))
+
+    def store(self, file_key, content):
+        content = content.read() if hasattr(content, 'read') else content
+        content = content.encode('utf-8') if isinstance(content, str) else content
+        self._count('store')
+        self.bytes_written += len(content)
+        self.backend.store(file_key, content)
+
+    def delete(self, file_keys):
+        self._count('delete')
+        return self.backend.delete(file_keys)
+
+    def list(self, prefix='', delimiter=None):
+        self._count('list')
+        return self.backend.list(prefix, delimiter)
+
+    def location(self):
+        return self.backend.location()
+
+    def _read(self, operation, content):
+        self._count(operation)
+        self.bytes_read += len(content or b'')
+        return content
+
+    def _count(self, operation):
+        self.requests[operation] = self.requests.get(operation, 0) + 1
+
+
+# Stands in for SQS, keeping the body of every message sent along with the simulated day it was sent on
+class FakeSqs:
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def send_message_batch(self, QueueUrl, Entries):
+        day = _current_day()
+        self.queue.extend((day, entry['MessageBody']) for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+# Stands in for the SageMaker runtime, scoring requests with the locally fit models after an optional simulated
+# network latency
+class FakeRuntime:
+    latencies = []
+
+    def __init__(self, models, latency_secs):
+        self.models = models
+        self.latency_secs = latency_secs
+
+    def invoke_endpoint(self, EndpointName, ContentType, Body):
+        started = time.perf_counter()
+        if self.latency_secs:
+            time.sleep(self.latency_secs)
+        features = json.loads(Body)['features']
+        prediction = float(np.dot(self.models[EndpointName], features + [1.0]))
+        FakeRuntime.latencies.append(time.perf_counter() - started)
+        return {'Body': io.BytesIO(json.dumps([prediction]).encode('utf-8'))}
+
+
+_simulated_day = {'day': None}
+
+
+def _current_day():
+    return _simulated_day['day']
+
+
+def _clock_at(day):
+    now = datetime.datetime.combine(day, datetime.time(12))
+
+    class SimulatedDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now if tz is None else now.replace(tzinfo=tz)
+    return SimulatedDatetime
+
+
+def create_storage(name):
+    if name == 'local':
+        return LocalFileBackend(tempfile.mkdtemp(prefix='pipeline-benchmark-'))
+    return create_backend(name)
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVICE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def _load_baseline(path):
+    if not path:
+        return {}
+    with open(path) as baseline_file:
+        return {stage['stage']: stage for stage in json.load(baseline_file)['stages']}
+
+
+def _print_results(results, baseline):
+    print(f"{'stage':<10}{'secs':>10}{'records/s':>14}{'p50 ms':>10}{'p99 ms':>10}{'requests':>10}"
+          f"{'MB read':>10}{'MB written':>12}{'peak MB':>10}{'vs baseline':>13}")
+    for stage in results['stages']:
+        baseline_stage = baseline.get(stage['stage'])
+        change = (f"{(stage['duration_secs'] / baseline_stage['duration_secs'] - 1) * 100:+.1f}%"
+                  if baseline_stage and baseline_stage['duration_secs'] else '')
+        print(f"{stage['stage']:<10}{stage['duration_secs']:>10.3f}{stage.get('records_per_sec') or 0:>14.1f}"
+              f"{stage['latency_ms'].get('p50', 0):>10.2f}{stage['latency_ms'].get('p99', 0):>10.2f}"
+              f"{sum(stage['storage']['requests'].values()):>10}{stage['storage']['bytes_read'] / 2 ** 20:>10.1f}"
+              f"{stage['storage']['bytes_written'] / 2 ** 20:>12.1f}{stage['peak_memory_mb']:>10.1f}{change:>13}")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the ingest, prepare and predict pipeline end to end')
+    parser.add_argument('--devices', type=int, default=5)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between the readings of a device')
+    parser.add_argument('--batch-size', type=int, default=60, help='Number of readings a device publishes together')
+    parser.add_argument('--storage', type=str, default='memory', choices=['memory', 'local'])
+    parser.add_argument('--models', type=str, default='bundle', choices=['bundle', 'endpoints'],
+                        help='Predict with per device models or with global models served by endpoints')
+    parser.add_argument('--min-device-rows', type=int, default=100,
+                        help='Devices with fewer rows of training data use the global models')
+    parser.add_argument('--endpoint-latency-ms', type=float, default=0,
+                        help='Simulated latency of each endpoint request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='Path of the results file, defaults to benchmarks/results')
+    parser.add_argument('--baseline', type=str, help='Results file of an earlier run to compare with')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
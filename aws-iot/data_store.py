@@ -1,103 +1,195 @@
 import json
-import boto3
 import os
 import logging
-from botocore.exceptions import ClientError
+import threading
 from io import BytesIO
 
-S3_BUCKET = os.getenv('S3_BUCKET')
+from perf_metrics import timed
+from storage_backends import create_backend
+
+# Where files are stored, see storage_backends.py. Defaults to S3 (the S3_BUCKET bucket).
+STORAGE_BACKEND = 's3'
 # IMPROVEMENT: Might make more sense for this default value to go in api instead of here
 EMPTY_JSON_ARRAY = '{"entries":[]}'
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
+_backend = {'name': None, 'instance': None}
+_backend_lock = threading.Lock()
+
+
+# Returns the storage backend named by the STORAGE_BACKEND environment variable. The backend is created once and
+# reused unless the variable changes or another backend was set with set_backend.
+def get_backend():
+    name = os.getenv('STORAGE_BACKEND', STORAGE_BACKEND)
+    if _backend['instance'] is None or _backend['name'] != name:
+        with _backend_lock:
+            if _backend['instance'] is None or _backend['name'] != name:
+                _backend.update({'name': name, 'instance': create_backend(name)})
+    return _backend['instance']
+
+
+# Uses the given backend instead of the one named by STORAGE_BACKEND, e.g. a MemoryBackend that was filled with data
+# up front. Passing None goes back to STORAGE_BACKEND.
+def set_backend(backend):
+    with _backend_lock:
+        _backend.update({'name': os.getenv('STORAGE_BACKEND', STORAGE_BACKEND) if backend else None,
+                         'instance': backend})
 
-# Loads the file from S3 and returns it as JSON. Returns None if the file does not exist.
-def load_file_as_json(file_key):
-    file_obj = _safe_load_file(file_key)
-    log.debug(f'File object {"exists" if file_obj else "does not exist"}')
-    if not file_obj:
+
+# Loads the file and returns it as JSON. Returns None if the file does not exist. Other errors are only raised with
+# raise_errors, which callers that store the file again after changing it must use so that a failed load isn't
+# mistaken for a missing file and the file overwritten.
+def load_file_as_json(file_key, raise_errors=False):
+    file_content = _load(file_key) if raise_errors else _safe_load_file(file_key)
+    log.debug(f'File object {"exists" if file_content is not None else "does not exist"}')
+    if file_content is None:
         return None
 
-    file_content = file_obj['Body'].read().decode('utf-8')
-    json_data = json.loads(file_content)
+    json_data = json.loads(file_content.decode('utf-8'))
     return json_data
 
 
-# Appends the data to the JSON file in S3 under the "entries" key which is an array.
-# If the file does not exist, it will be created.
+# Appends the data to the JSON file under the "entries" key which is an array.
+# If the file does not exist, it will be created. If a sort key is given the entries are kept sorted by it, which is
+# cheap as the existing entries and the new ones are each already sorted (or close to it). Unlike the other methods in
+# this file, errors loading or storing the file are raised so that callers can retry, otherwise a failed load could
+# overwrite the existing data.
 #
 # IMPROVEMENT: Implementation is specific to the JSON structure of the data points whereas the other methods in this
 # file are generic. This method should be refactored to be more generic. Pull the JSON structure specific code out?
-def append_data_as_json(data_points, file_key):
-    json_data = load_file_as_json(file_key) or json.loads(EMPTY_JSON_ARRAY)
-    json_data['entries'].extend(data_points)
-    _store_json_file(file_key, json_data)
-    print(f"File '{file_key}' in bucket '{S3_BUCKET}' updated successfully.")
+def append_data_as_json(data_points, file_key, sort_key=None):
+    file_content = _load(file_key)
+    json_data = json.loads(file_content.decode('utf-8')) if file_content is not None else json.loads(EMPTY_JSON_ARRAY)
+    entries = json_data['entries']
+    existing_count = len(entries)
+    entries.extend(data_points)
+    if sort_key and entries[existing_count:] and not _is_sorted(entries[max(0, existing_count - 1):], sort_key):
+        entries.sort(key=lambda entry: entry[sort_key])
+    _store(file_key, json.dumps(json_data).encode('utf-8'))
+    print(f"File '{file_key}' in '{get_backend().location()}' updated successfully.")
+
 
+# Stores a file with the given key and content. Unlike store_file_stream, errors are raised so that callers can tell
+# whether the file was stored, e.g. before deleting the data it replaces.
+def store_file(file_key, file_content):
+    _store(file_key, file_content)
 
-# Stores a file in S3 with the given key and content.
+
+# Stores a file with the given key and content.
 def store_file_stream(file_key, file_content):
     try:
-        s3 = boto3.client('s3')
-        s3.put_object(Bucket=S3_BUCKET, Key=file_key, Body=file_content)
+        _store(file_key, file_content)
     except Exception as e:
-        log.error(f"An error occurred while storing file {file_key} in {S3_BUCKET}: {e}")
+        log.error(f"An error occurred while storing file {file_key} in {get_backend().location()}: {e}")
+
 
+# Loads a file and returns its content as bytes. Returns None if the file does not exist, other errors are only
+# raised with raise_errors (see load_file_as_json).
+def load_file_as_bytes(file_key, raise_errors=False):
+    return _load(file_key) if raise_errors else _safe_load_file(file_key)
 
-# Loads a file from S3 and returns it as a string. Returns None if the file does not exist.
+
+# Loads length bytes of a file starting at offset (a ranged GET in S3), so that a small part of a large file can be
+# read without downloading the rest of it. Returns None if the file does not exist, any other error is raised.
+def load_file_range(file_key, offset, length):
+    return _load_range(file_key, offset, length)
+
+
+# Loads a file and returns it as a string. Returns None if the file does not exist.
 def load_file_as_string(file_key):
-    file_obj = _safe_load_file(file_key)
-    if not file_obj:
-        log.error(f'Failed to load file {file_key} from S3')
+    file_content = _safe_load_file(file_key)
+    if file_content is None:
+        log.error(f'Failed to load file {file_key} from {get_backend().location()}')
         return None
-    env_content = file_obj['Body'].read().decode('utf-8')
-    return env_content
+    return file_content.decode('utf-8')
 
 
-# Attempts to delete the file from S3. Outputs appropriate warnings/errors if the file does not exist or if an error.
+# Attempts to delete the file. Outputs appropriate warnings/errors if the file does not exist or if an error.
 # Does not throw any errors if the file could not be deleted.
 def delete_file(file_key):
-    s3 = boto3.client('s3')
+    log.info(f"Preparing to delete file {file_key} from {get_backend().location()}")
+    if delete_files([file_key]):
+        # IMPROVEMENT: raise the exception?
+        log.error(f"Unable to delete file {file_key}")
+        return
+    log.info(f"Deleted {file_key} successfully.")
+
+
+# Deletes the files in batches (of up to 1000 with a single request per batch in S3). Returns the keys of the files
+# that could not be deleted, errors are logged rather than raised.
+def delete_files(file_keys):
     try:
-        log.info(f"Preparing to delete file {file_key} from S3")
-        file_params = {'Bucket': S3_BUCKET, 'Key': file_key}
-        s3.head_object(**file_params)
-        s3.delete_object(**file_params)
-        log.info(f"Deleted {file_key} successfully.")
-    except s3.exceptions.NoSuchKey:
-        log.warning(f'File {file_key} does not exist in {S3_BUCKET}')
+        failed_keys = _delete(file_keys)
     except Exception as e:
-        # IMPROVEMENT: raise the exception?
-        log.error(f"An error occurred while deleting file {file_key} from {S3_BUCKET}: {e}")
+        log.error(f"An error occurred while deleting {len(file_keys)} files from {get_backend().location()}: {e}")
+        return list(file_keys)
+
+    log.info(f"Deleted {len(file_keys) - len(failed_keys)} of {len(file_keys)} files from {get_backend().location()}")
+    return failed_keys
+
 
+# Lists the keys of the files whose keys start with the prefix. With a delimiter, files "below" the prefix (e.g. in sub
+# folders when the delimiter is "/") are left out.
+def list_files(prefix='', delimiter=None):
+    return _list(prefix, delimiter)
 
-# Updates the JSON file in S3 with the given key and json data. Input json data should be in object form and not string.
-def _store_json_file(file_key, json_data):
+
+# Creates or replaces the JSON file with the given key and json data. Input json data should be in object form and not string.
+def store_json_file(file_key, json_data):
     updated_file_content = json.dumps(json_data).encode('utf-8')
     store_file_stream(file_key, BytesIO(updated_file_content))
 
 
-# Attempts to load the file from S3. Returns None if the file does not exist or if an error occurs.
+# Attempts to load the file. Returns None if the file does not exist or if an error occurs.
 def _safe_load_file(file_key):
-    s3 = boto3.client('s3')
-    log.debug(f"Checking if file {file_key} exists in {S3_BUCKET}")
-    file_params = {'Bucket': S3_BUCKET, 'Key': file_key}
-
     try:
-        s3.head_object(**file_params)
-        log.debug(f"File {file_key} exists in {S3_BUCKET}.")
-        return s3.get_object(**file_params)
-    except ClientError as e:
-        error_code = e.response['Error']['Code']
-        if error_code == '404' or error_code == 'NoSuchKey':
-            log.debug(f"File {file_key} does not exist in {S3_BUCKET}.")
-        else:
-            log.debug(f"An error occurred while safe loading file {file_key} from {S3_BUCKET}: {e}")
-
-        return None
+        return _load(file_key)
     except Exception as e:
-        log.debug(f"An error occurred while safe loading file {file_key} from {S3_BUCKET}: {e}")
+        log.debug(f"An error occurred while safe loading file {file_key} from {get_backend().location()}: {e}")
         return None
 
+
+def _is_sorted(entries, sort_key):
+    return all(entries[i][sort_key] <= entries[i + 1][sort_key] for i in range(len(entries) - 1))
+
+
+# Every storage request goes through these so that its duration and the bytes moved are measured, see perf_metrics.py
+def _load(file_key):
+    with timed('StorageLoad') as measurement:
+        content = get_backend().load(file_key)
+        measurement.add(BytesRead=len(content) if content else 0)
+    return content
+
+
+def _load_range(file_key, offset, length):
+    with timed('StorageLoadRange') as measurement:
+        content = get_backend().load_range(file_key, offset, length)
+        measurement.add(BytesRead=len(content) if content else 0)
+    return content
+
+
+def _store(file_key, file_content):
+    with timed('StorageStore') as measurement:
+        get_backend().store(file_key, file_content)
+        measurement.add(BytesWritten=_content_length(file_content))
+
+
+def _delete(file_keys):
+    with timed('StorageDelete') as measurement:
+        measurement.add(Records=len(file_keys))
+        return get_backend().delete(file_keys)
+
+
+def _list(prefix, delimiter):
+    with timed('StorageList') as measurement:
+        file_keys = get_backend().list(prefix, delimiter)
+        measurement.add(Records=len(file_keys))
+    return file_keys
+
+
+def _content_length(file_content):
+    if isinstance(file_content, BytesIO):
+        return file_content.getbuffer().nbytes
+    return len(file_content) if isinstance(file_content, (bytes, bytearray, str)) else 0
@@ -0,0 +1,86 @@
+import hashlib
+import logging
+from array import array
+from bisect import bisect_left
+
+from data_store import load_file_as_bytes, store_file
+from readings import device_of
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+
+# Devices publish with MQTT QoS 1 and SQS delivers at least once, so the same reading can arrive more than once. Each
+# daily data file has a sidecar index holding a sorted array of 64 bit keys, one per stored reading, keyed on the
+# device and the reading time. This takes 8 bytes per reading (well under 1 MB for a day of readings every second)
+# instead of loading and scanning the data file itself, and membership checks are binary searches.
+#
+# The index is stored after the readings are appended to the data file, so that readings are never recorded in the
+# index without having been stored. The other way around isn't guaranteed: if storing the index fails after the append,
+# the batch is retried and its readings are appended again. Duplicates are therefore rare rather than impossible.
+
+# Returns a key that identifies the reading by its device and time
+def reading_key(reading):
+    key_source = f"{device_of(reading)}|{reading['t']}".encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key_source, digest_size=8).digest(), 'little')
+
+
+def get_dedup_index_file_key(file_key):
+    return f'{file_key}-keys'
+
+
+# Loads the sorted keys of the readings already stored in the file. Errors are raised, an index that failed to load
+# must not be taken for an empty one as it would be stored again with only the new keys.
+def load_dedup_index(file_key):
+    index = array('Q')
+    index_bytes = load_file_as_bytes(get_dedup_index_file_key(file_key), raise_errors=True)
+    if index_bytes:
+        index.frombytes(index_bytes)
+    return index
+
+
+# Returns the readings that are not in the index (and not repeated within the readings themselves) along with their
+# keys, in the same order as the readings
+def filter_new_readings(index, readings):
+    new_readings = []
+    new_keys = []
+    seen_keys = set()
+    for reading in readings:
+        key = reading_key(reading)
+        if key in seen_keys or _contains(index, key):
+            continue
+        seen_keys.add(key)
+        new_readings.append(reading)
+        new_keys.append(key)
+
+    if len(new_readings) != len(readings):
+        log.info(f"Dropped {len(readings) - len(new_readings)} duplicate readings")
+    return new_readings, new_keys
+
+
+# Adds the keys to the index and stores it. Should only be called once the readings have been stored. Errors are
+# raised so that the batch fails and is retried (appending its readings again, see above) rather than its readings
+# being left out of the index, where later redeliveries wouldn't be recognized as duplicates.
+def store_dedup_index(file_key, index, new_keys):
+    if not new_keys:
+        return
+    store_file(get_dedup_index_file_key(file_key), _merge_keys(index, new_keys).tobytes())
+
+
+# Merges the (few) new keys into the sorted index by copying the runs of the index between them, rather than sorting
+# the whole index again
+def _merge_keys(index, new_keys):
+    merged = array('Q')
+    start = 0
+    for key in sorted(new_keys):
+        position = bisect_left(index, key, start)
+        merged.extend(index[start:position])
+        merged.append(key)
+        start = position
+    merged.extend(index[start:])
+    return merged
+
+
+def _contains(index, key):
+    position = bisect_left(index, key)
+    return position < len(index) and index[position] == key
@@ -0,0 +1,80 @@
+import logging
+import os
+import time
+
+from aws_clients import get_client
+from data_store import load_file_as_json, store_json_file
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# How long the list of devices is served from memory or from the S3 snapshot before IoT is asked again. Keeps the
+# device endpoints fast and well under the IoT control plane rate limits as the fleet grows.
+DEVICE_REGISTRY_TTL_SECS = int(os.getenv('DEVICE_REGISTRY_TTL_SECS', '300'))
+DEVICE_REGISTRY_FILE_KEY = os.getenv('DEVICE_REGISTRY_FILE_KEY', 'registry/devices.json')
+
+_cache = {'devices': None, 'updated': 0}
+
+
+# Returns every registered device as a list of {"name", "version", "type"} sorted by name. Devices are cached in
+# memory for the lifetime of the container and in an S3 snapshot shared between containers, both for
+# DEVICE_REGISTRY_TTL_SECS.
+def list_devices():
+    now = time.time()
+    if _cache['devices'] is not None and now - _cache['updated'] < DEVICE_REGISTRY_TTL_SECS:
+        return _cache['devices']
+
+    snapshot = load_file_as_json(DEVICE_REGISTRY_FILE_KEY)
+    if snapshot and now - snapshot['updated'] < DEVICE_REGISTRY_TTL_SECS:
+        log.debug(f"Loaded {len(snapshot['devices'])} devices from the registry snapshot")
+    else:
+        snapshot = {'devices': _list_things(), 'updated': now}
+        store_json_file(DEVICE_REGISTRY_FILE_KEY, snapshot)
+
+    _cache.update(snapshot)
+    return _cache['devices']
+
+
+# Returns the device with the given name or None if there is no such device. Devices registered since the registry was
+# cached are looked up directly.
+def get_device(name):
+    for device in list_devices():
+        if device['name'] == name:
+            return device
+
+    iot = get_client('iot')
+    try:
+        return _to_device(iot.describe_thing(thingName=name))
+    except iot.exceptions.ResourceNotFoundException:
+        return None
+
+
+# Filters the devices by type and name prefix and returns a page of at most limit devices starting at the given
+# position, along with the position of the next page (None if this is the last page).
+def find_devices(device_type=None, name_prefix=None, limit=None, start=0):
+    devices = [device for device in list_devices()
+               if (not device_type or device['type'] == device_type)
+               and (not name_prefix or device['name'].startswith(name_prefix))]
+    end = start + limit if limit else len(devices)
+    return devices[start:end], (end if end < len(devices) else None)
+
+
+def clear_cache():
+    _cache.update({'devices': None, 'updated': 0})
+
+
+def _list_things():
+    iot = get_client('iot')
+    devices = []
+    for page in iot.get_paginator('list_things').paginate():
+        devices.extend(_to_device(thing) for thing in page['things'])
+    log.info(f"Listed {len(devices)} devices from IoT")
+    return sorted(devices, key=lambda device: device['name'])
+
+
+def _to_device(thing):
+    return {
+        "name": thing['thingName'],
+        "version": thing['version'],
+        "type": thing.get('thingTypeName')
+    }
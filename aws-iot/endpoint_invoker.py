@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+from aws_clients import get_client
+from perf_metrics import timed
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+SAGEMAKER_REGION = 'us-west-1'
+# Number of requests that are in flight against the endpoints at any one time. Should be tuned against the capacity
+# of the endpoints (instance type and count) rather than the size of the Lambda.
+PREDICT_MAX_CONCURRENCY = int(os.getenv('PREDICT_MAX_CONCURRENCY', '16'))
+PREDICT_MAX_RETRIES = int(os.getenv('PREDICT_MAX_RETRIES', '5'))
+PREDICT_RETRY_BASE_DELAY_SECS = float(os.getenv('PREDICT_RETRY_BASE_DELAY_SECS', '0.25'))
+PREDICT_RETRY_MAX_DELAY_SECS = 10
+RETRYABLE_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailable',
+                         'ModelNotReadyException'}
+RETRYABLE_STATUS_CODES = {429, 503}
+
+
+# Invokes the endpoints for each of the given (endpoint_name, features) requests using a bounded thread pool and a
+# single shared sagemaker-runtime client. Results are returned in the same order as the requests. Throttled requests
+# are retried with exponential backoff and jitter, any other failure is raised to the caller.
+def invoke_endpoints(requests, max_concurrency=None):
+    if not requests:
+        return []
+
+    concurrency = max(1, min(max_concurrency or PREDICT_MAX_CONCURRENCY, len(requests)))
+    log.info(f'Invoking endpoints for {len(requests)} requests with a concurrency of {concurrency}')
+    client = _get_runtime_client(concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda request: _invoke_with_retries(client, *request), requests))
+
+
+def _get_runtime_client(concurrency):
+    # Retries are handled here rather than by botocore so that the backoff can be tuned for the endpoint's capacity
+    return get_client('sagemaker-runtime', region_name=SAGEMAKER_REGION, max_pool_connections=concurrency,
+                      retries={'mode': 'standard', 'total_max_attempts': 1})
+
+
+def _invoke_with_retries(client, endpoint_name, features):
+    payload = json.dumps({"features": features})
+    attempt = 0
+    with timed('EndpointInvoke') as measurement:
+        while True:
+            try:
+                response = client.invoke_endpoint(
+                    EndpointName=endpoint_name,
+                    ContentType='application/json',
+                    Body=payload
+                )
+                measurement.add(Retries=attempt)
+                return json.loads(response['Body'].read().decode('utf-8'))[0]
+            except ClientError as e:
+                if not _is_retryable(e) or attempt >= PREDICT_MAX_RETRIES:
+                    raise
+
+                delay = _backoff_delay(attempt)
+                log.info(f'Request to endpoint {endpoint_name} was throttled, retrying in {delay:.2f}s')
+                time.sleep(delay)
+                attempt += 1
+
+
+def _is_retryable(error):
+    error_code = error.response.get('Error', {}).get('Code')
+    status_code = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return error_code in RETRYABLE_ERROR_CODES or status_code in RETRYABLE_STATUS_CODES
+
+
+# "Full jitter" exponential backoff so that throttled workers don't all retry at the same moment
+def _backoff_delay(attempt):
+    return random.uniform(0, min(PREDICT_RETRY_MAX_DELAY_SECS, PREDICT_RETRY_BASE_DELAY_SECS * (2 ** attempt)))
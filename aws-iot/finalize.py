@@ -1,53 +1,111 @@
 import logging
-import boto3
-import datetime
 import os
-from predict import MODEL_TYPES
-from data_store import delete_file
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_clients import get_client
+from data_store import delete_files, list_files
+from model_types import MODEL_TYPES
+from perf_metrics import handler_metrics, timed
+from profiling import profiled
+from run_manifest import RESOURCE_TYPES, delete_run_manifest, get_aggregate_run_id, get_run_id, load_run_manifests, \
+    store_run_manifest
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
+MODELS_FOLDER = os.getenv('MODELS_FOLDER', 'models')
+AGGREGATES_FOLDER = os.getenv('AGGREGATES_FOLDER', 'aggregates')
+# Manifests of other runs are only cleaned up once they are this old, so that the resources of a run that is still in
+# progress are left alone. Runs take well under an hour.
+STALE_RUN_MANIFEST_SECS = int(os.getenv('STALE_RUN_MANIFEST_SECS', str(6 * 60 * 60)))
+# Number of SageMaker delete requests made at the same time
+CLEANUP_MAX_CONCURRENCY = 8
+
 
-# IMPROVEMENT: This ought to take parameters to indicate which resources to clean up so that the step functions can
-# pass in the appropriate names/ids of resources to clean up rather than inferring the names based on the current date.
+# Cleans up after a run of the prediction state machine, the run being that of the event (see run_manifest.py). The
+# resources recorded in the manifests of the run and of any earlier run that wasn't fully cleaned up are deleted, so
+# cleanup is idempotent and a failed or skipped cleanup is caught up on by the next one. The function is also run on a
+# schedule, without a run, to stop forgotten endpoints from running for long.
+# - endpoints are deleted concurrently, then their endpoint configs and models
+# - files (model artifacts, prediction caches, the run's model bundle, and aggregate data files up to the run's) are
+#   deleted in batches, each a single request
+# Resources that couldn't be deleted are kept in their manifest for the next cleanup to retry.
+@profiled
+@handler_metrics
 def cleanup_resources(event, context):
-    log.info("Cleaning up models, endpoint configs, endpoints")
-    _cleanup_inference_resources()
-    _cleanup_model_artifacts()
-    # IMPROVEMENT: Clean up aggregate data file?
-
-
-def _cleanup_inference_resources():
-    sagemaker = boto3.client('sagemaker')
-    date_today = datetime.datetime.now().strftime('%Y-%m-%d')
-
-    for model_type in MODEL_TYPES:
-        model_name = f'{date_today}-{model_type}-model'
-        endpoint_config_name = f'{date_today}-{model_type}-endpoint-config'
-        endpoint_name = f'{model_name}-endpoint'
-
-        try:
-            sagemaker.delete_endpoint(EndpointName=endpoint_name)
-            log.info(f"Deleted endpoint: {endpoint_name}")
-        except Exception as e:
-            log.info(f"Unable to delete endpoint {endpoint_name}: {e}")
-
-        try:
-            sagemaker.delete_endpoint_config(EndpointConfigName=endpoint_config_name)
-            log.info(f"Deleted endpoint config: {endpoint_config_name}")
-        except Exception as e:
-            log.info(f"Unable to delete endpoint config {endpoint_config_name}: {e}")
-
-        try:
-            sagemaker.delete_model(ModelName=model_name)
-            log.info(f"Deleted model: {model_name}")
-        except Exception as e:
-            log.info(f"Unable to delete model {model_name}: {e}")
-
-
-def _cleanup_model_artifacts():
-    date_today = datetime.datetime.now().strftime('%Y-%m-%d')
-    for model_type in MODEL_TYPES:
-        model_file_key = f'{date_today}-{model_type}-model.tar.gz'
-        delete_file(model_file_key)
+    run_id = get_run_id(event) if (event or {}).get('aggregateFileKey') else None
+    manifests = [manifest for manifest in load_run_manifests()
+                 if manifest['run'] == run_id or time.time() - manifest.get('created', 0) >= STALE_RUN_MANIFEST_SECS]
+    log.info(f"Cleaning up the resources of runs {[manifest['run'] for manifest in manifests]}")
+
+    with timed('InferenceResourcesCleanup'):
+        for manifest in manifests:
+            _cleanup_inference_resources(manifest)
+    files = [file_key for manifest in manifests for file_key in manifest['files']]
+    if run_id:
+        files.extend(_get_run_files(event, run_id))
+    with timed('FilesCleanup') as measurement:
+        failed_files = set(delete_files(sorted(set(files)))) if files else set()
+        measurement.add(Records=len(files))
+
+    remaining = 0
+    for manifest in manifests:
+        manifest['files'] = [file_key for file_key in manifest['files'] if file_key in failed_files]
+        manifest_remaining = sum(len(manifest[key]) for key in RESOURCE_TYPES + ('files',))
+        if manifest_remaining:
+            # The manifest keeps listing the resources that were deleted, which the next cleanup finds already gone
+            try:
+                store_run_manifest(manifest)
+            except Exception as e:
+                log.error(f"Unable to update the manifest of run {manifest['run']}: {e}")
+        else:
+            delete_run_manifest(manifest['run'])
+        remaining += manifest_remaining
+    if failed_files:
+        log.error(f"Unable to delete {len(failed_files)} files: {sorted(failed_files)}")
+    return {'runs': [manifest['run'] for manifest in manifests], 'remaining': remaining}
+
+
+# Deletes the manifest's endpoints, then its endpoint configs and models, each type concurrently. The manifest is left
+# with the resources that couldn't be deleted.
+def _cleanup_inference_resources(manifest):
+    sagemaker = get_client('sagemaker', max_pool_connections=CLEANUP_MAX_CONCURRENCY)
+    delete_functions = {
+        'endpoints': lambda name: sagemaker.delete_endpoint(EndpointName=name),
+        'endpointConfigs': lambda name: sagemaker.delete_endpoint_config(EndpointConfigName=name),
+        'models': lambda name: sagemaker.delete_model(ModelName=name)
+    }
+    with ThreadPoolExecutor(max_workers=CLEANUP_MAX_CONCURRENCY) as executor:
+        for resource_type in RESOURCE_TYPES:
+            names = manifest[resource_type]
+            deleted = list(executor.map(lambda name: _delete_resource(delete_functions[resource_type], name), names))
+            manifest[resource_type] = [name for name, was_deleted in zip(names, deleted) if not was_deleted]
+
+
+def _delete_resource(delete_function, name):
+    try:
+        delete_function(name)
+        log.info(f"Deleted {name}")
+        return True
+    except Exception as e:
+        # SageMaker responds with a validation error when the resource doesn't exist (anymore), i.e. it was deleted
+        error = getattr(e, 'response', {}).get('Error', {})
+        if error.get('Code') == 'ValidationException' and 'Could not find' in error.get('Message', ''):
+            log.info(f"{name} was already deleted")
+            return True
+        log.error(f"Unable to delete {name}: {e}")
+        return False
+
+
+# Files of the run that exist whether or not models were deployed: the global model artifacts written by the training
+# job, the model bundle, and the aggregate data files of this run and any before it
+def _get_run_files(event, run_id):
+    files = [f'{MODELS_FOLDER}/{run_id}-{model_type}-model.tar.gz' for model_type in MODEL_TYPES]
+    if event.get('modelBundleKey'):
+        files.append(event['modelBundleKey'])
+    for file_key in list_files(f'{AGGREGATES_FOLDER}/', '/'):
+        aggregate_run_id = get_aggregate_run_id(file_key)
+        if aggregate_run_id and aggregate_run_id <= run_id:
+            files.append(file_key)
+    return files
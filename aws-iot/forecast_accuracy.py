@@ -0,0 +1,170 @@
+import datetime
+import logging
+import math
+import os
+import time
+
+from data_store import list_files, load_file_as_json, store_json_file
+from readings import METRIC_KEYS, device_of
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+FORECAST_ACCURACY_FOLDER = os.getenv('FORECAST_ACCURACY_FOLDER', 'accuracy')
+# Predictions files are reloaded after this long in case the day was predicted again (e.g. a rerun of the forecast)
+PREDICTIONS_INDEX_TTL_SECS = int(os.getenv('PREDICTIONS_INDEX_TTL_SECS', '900'))
+# Spacing of predictions stored without it (see predict.py)
+DEFAULT_RESOLUTION_SECS = 600
+# Number of model versions kept in the summary, the oldest are dropped first. Models are retrained weekly.
+MAX_MODEL_VERSIONS = int(os.getenv('FORECAST_ACCURACY_MAX_VERSIONS', '12'))
+
+# Predictions of the days readings are being scored against, by predictions file key: (time loaded, index)
+_predictions_cache = {}
+
+
+# Scores the readings against the predictions made for them as they are ingested. Each reading is matched with the
+# prediction of the time bucket it is aligned to (the closest one, predictions being 10 minutes apart by default), from
+# its device's own predictions if there are any and from the fleet wide ones otherwise. The errors are accumulated
+# into a running summary per device by model version, horizon day (0 being the first day of the forecast) and metric,
+# e.g.
+#   {"versions": {"2024-05-05-forecast-models": {"0": {"tmp": {"n": 1440, "abs": 612.3, "sq": 401.2, "sum": -85.1}}}}}
+# holding the count and the sums of the absolute, squared and signed errors, from which the MAE, RMSE and bias are
+# derived (see summarize_accuracy). Every reading is scored exactly once (duplicates are dropped before they get here),
+# so history is never rescanned and the cost is that of the batch plus loading a day of predictions once per
+# container. Returns the number of errors accumulated.
+#
+# The summaries are split by device so that workers ingesting the readings of different devices at the same time don't
+# overwrite each other's updates, and are loaded with raise_errors so that a failed load isn't mistaken for a device
+# that hasn't been scored yet and its summary reset.
+def update_forecast_accuracy(readings):
+    readings_by_device = {}
+    for reading in readings:
+        readings_by_device.setdefault(device_of(reading), []).append(reading)
+
+    scored = sum(_update_device_forecast_accuracy(device, device_readings)
+                 for device, device_readings in readings_by_device.items())
+    if scored:
+        log.info(f"Scored {scored} readings against their predictions")
+    return scored
+
+
+# Loads the summary of the given device, or that of every device with the statistics of the devices added up
+def load_forecast_accuracy(device=None):
+    if device:
+        return load_file_as_json(get_forecast_accuracy_file_key(device), raise_errors=True)
+
+    summary = None
+    for file_key in list_files(f'{FORECAST_ACCURACY_FOLDER}/', '/'):
+        device_summary = load_file_as_json(file_key, raise_errors=True)
+        if device_summary is None:
+            continue
+        summary = summary or {'versions': {}}
+        for version, horizon_stats in device_summary['versions'].items():
+            for horizon, metric_stats in horizon_stats.items():
+                summed_stats = summary['versions'].setdefault(version, {}).setdefault(horizon, {})
+                for metric_key, stats in metric_stats.items():
+                    summed = summed_stats.setdefault(metric_key, {'n': 0, 'abs': 0.0, 'sq': 0.0, 'sum': 0.0})
+                    for stat in summed:
+                        summed[stat] += stats[stat]
+    return summary
+
+
+def get_forecast_accuracy_file_key(device):
+    return f'{FORECAST_ACCURACY_FOLDER}/{device}.json'
+
+
+# Derives the error statistics of the summary, optionally only those of the given model versions and metrics:
+#   {"2024-05-05-forecast-models": {"0": {"tmp": {"count": 1440, "mae": 0.43, "rmse": 0.53, "bias": -0.06}}}}
+def summarize_accuracy(summary, versions=None, metrics=None):
+    return {
+        version: {
+            horizon: {
+                metric: {
+                    'count': stats['n'],
+                    'mae': round(stats['abs'] / stats['n'], 3),
+                    'rmse': round(math.sqrt(stats['sq'] / stats['n']), 3),
+                    'bias': round(stats['sum'] / stats['n'], 3)
+                }
+                for metric, stats in metric_stats.items() if stats['n'] and (not metrics or metric in metrics)
+            }
+            for horizon, metric_stats in sorted(horizon_stats.items(), key=lambda item: int(item[0]))
+        }
+        for version, horizon_stats in summary['versions'].items() if not versions or version in versions
+    }
+
+
+def clear_cache():
+    _predictions_cache.clear()
+
+
+def _update_device_forecast_accuracy(device, readings):
+    readings_by_date = {}
+    for reading in readings:
+        date = datetime.datetime.fromtimestamp(reading['t'] / 1000, datetime.timezone.utc).strftime('%Y-%m-%d')
+        readings_by_date.setdefault(date, []).append(reading)
+
+    summary = None
+    scored = 0
+    for date, date_readings in readings_by_date.items():
+        predictions = _load_predictions_index(f'{date}-predictions')
+        if not predictions:
+            continue
+        if summary is None:
+            summary = load_forecast_accuracy(device) or {'versions': {}}
+        version_stats = summary['versions'].setdefault(predictions['v'], {})
+        horizon_stats = version_stats.setdefault(str(predictions['h']), {})
+        scored += _score_readings(date_readings, predictions, horizon_stats)
+
+    if scored:
+        # Dicts keep their insertion order, so the first versions are the oldest
+        for version in list(summary['versions'])[:-MAX_MODEL_VERSIONS]:
+            del summary['versions'][version]
+        store_json_file(get_forecast_accuracy_file_key(device), summary)
+    return scored
+
+
+def _score_readings(readings, predictions, horizon_stats):
+    resolution_ms = predictions['r'] * 1000
+    scored = 0
+    for reading in readings:
+        device_predictions = predictions['devices'].get(device_of(reading)) or predictions['devices'].get('')
+        if not device_predictions:
+            continue
+        predicted = device_predictions.get(int(round(reading['t'] / resolution_ms)) * resolution_ms)
+        if not predicted:
+            continue
+
+        for metric_key in METRIC_KEYS:
+            if reading.get(metric_key) is None or predicted.get(metric_key) is None:
+                continue
+            error = predicted[metric_key] - reading[metric_key]
+            stats = horizon_stats.setdefault(metric_key, {'n': 0, 'abs': 0.0, 'sq': 0.0, 'sum': 0.0})
+            stats['n'] += 1
+            stats['abs'] += abs(error)
+            stats['sq'] += error * error
+            stats['sum'] += error
+            scored += 1
+    return scored
+
+
+# Indexes a day's predictions by device ('' for the fleet wide ones) and time. Returns None if the day was not
+# predicted or the predictions don't say which forecast they belong to (i.e. were stored before that was recorded).
+def _load_predictions_index(file_key):
+    cached = _predictions_cache.get(file_key)
+    if cached and time.time() - cached[0] < PREDICTIONS_INDEX_TTL_SECS:
+        return cached[1]
+
+    json_data = load_file_as_json(file_key)
+    index = None
+    if json_data and 'v' in json_data and 'h' in json_data:
+        index = {'v': json_data['v'], 'h': json_data['h'], 'r': json_data.get('r') or DEFAULT_RESOLUTION_SECS,
+                 'devices': {}}
+        for entry in json_data['entries']:
+            index['devices'].setdefault(entry.get('device', ''), {})[entry['t']] = entry
+
+    # Only the days being ingested are kept, usually just today
+    for stale_key in [key for key, (loaded, _) in _predictions_cache.items()
+                      if time.time() - loaded >= PREDICTIONS_INDEX_TTL_SECS]:
+        del _predictions_cache[stale_key]
+    _predictions_cache[file_key] = (time.time(), index)
+    return index
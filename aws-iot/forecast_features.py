@@ -0,0 +1,128 @@
+import datetime
+import os
+from collections import namedtuple
+import numpy as np
+
+SECONDS_PER_DAY = 24 * 60 * 60
+# How far ahead and at what resolution forecasts are made. Cost grows linearly with the number of rows
+# (horizon days * seconds per day / resolution) so the feature matrix is always built in a single pass.
+FORECAST_HORIZON_DAYS = int(os.getenv('FORECAST_HORIZON_DAYS', '7'))
+FORECAST_RESOLUTION_SECS = int(os.getenv('FORECAST_RESOLUTION_SECS', '600'))
+# 'interpolate' linearly interpolates between the averaged time of day slots, 'nearest' uses the closest slot
+FORECAST_AVERAGES_METHOD = os.getenv('FORECAST_AVERAGES_METHOD', 'interpolate')
+# Readings that come in at slightly different times are averaged together in buckets of this many seconds
+AVERAGES_BUCKET_SECS = 100
+# Must match the order of the one-hot encoded day of week columns used when training the models
+DAYS_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# timestamps: epoch millis for each row, day_offsets: horizon day (0 = today) for each row,
+# features: array of shape (metric, row, feature) holding the feature vector for every metric model
+FeatureMatrix = namedtuple('FeatureMatrix', ['timestamps', 'day_offsets', 'features'])
+# slots: sorted seconds from midnight, averages: array of shape (slot, metric)
+TimeOfDayProfile = namedtuple('TimeOfDayProfile', ['slots', 'averages'])
+
+
+# Averages each metric by time of day. metric_columns is a list of arrays, one per metric, aligned with time_of_day.
+def build_time_of_day_profile(time_of_day, metric_columns, bucket_secs=AVERAGES_BUCKET_SECS):
+    buckets = (np.asarray(time_of_day, dtype=np.int64) // bucket_secs) * bucket_secs
+    slots, slot_indexes = np.unique(buckets, return_inverse=True)
+    counts = np.bincount(slot_indexes)
+    averages = np.column_stack([np.bincount(slot_indexes, weights=np.asarray(column, dtype=np.float64)) / counts
+                                for column in metric_columns])
+    return TimeOfDayProfile(slots, averages)
+
+
+# Looks up the profile's averages for each of the given times of day. The profile wraps around midnight so that times
+# before the first slot or after the last slot still get sensible values.
+def lookup_profile(profile, times_of_day, method=FORECAST_AVERAGES_METHOD):
+    if not len(profile.slots):
+        raise ValueError('Cannot look up averages in an empty time of day profile')
+
+    slots = np.concatenate([profile.slots[-1:] - SECONDS_PER_DAY, profile.slots, profile.slots[:1] + SECONDS_PER_DAY])
+    averages = np.concatenate([profile.averages[-1:], profile.averages, profile.averages[:1]])
+    times_of_day = np.asarray(times_of_day, dtype=np.float64)
+
+    if method == 'nearest':
+        right = np.clip(np.searchsorted(slots, times_of_day), 1, len(slots) - 1)
+        left = right - 1
+        nearest = np.where(times_of_day - slots[left] <= slots[right] - times_of_day, left, right)
+        return averages[nearest]
+    elif method == 'interpolate':
+        return np.column_stack([np.interp(times_of_day, slots, averages[:, i]) for i in range(averages.shape[1])])
+
+    raise ValueError(f'Unknown averages lookup method: {method}')
+
+
+# Builds the feature matrix for every forecast row and every metric model in one pass. Each metric's model is fed
+# [time_of_day, <averages of the other metrics in metric order>, <one-hot day of week>], matching sagemaker/train.py.
+def build_feature_matrix(profile, metric_types, start_date=None, horizon_days=FORECAST_HORIZON_DAYS,
+                         resolution_secs=FORECAST_RESOLUTION_SECS, method=FORECAST_AVERAGES_METHOD):
+    start_date = start_date or datetime.datetime.now(datetime.timezone.utc).date()
+    times_of_day = np.arange(0, SECONDS_PER_DAY, resolution_secs, dtype=np.int64)
+    slots_per_day = len(times_of_day)
+    row_count = horizon_days * slots_per_day
+
+    day_offsets = np.repeat(np.arange(horizon_days), slots_per_day)
+    row_times_of_day = np.tile(times_of_day, horizon_days)
+    start_of_horizon = int(datetime.datetime.combine(start_date, datetime.time(),
+                                                     tzinfo=datetime.timezone.utc).timestamp())
+    timestamps = (start_of_horizon + day_offsets * SECONDS_PER_DAY + row_times_of_day) * 1000
+
+    averages = np.tile(lookup_profile(profile, times_of_day, method), (horizon_days, 1))
+
+    days_of_week = np.zeros((row_count, len(DAYS_OF_WEEK)))
+    weekdays = (start_date.weekday() + day_offsets) % len(DAYS_OF_WEEK)
+    days_of_week[np.arange(row_count), weekdays] = 1
+
+    metric_count = len(metric_types)
+    features = np.empty((metric_count, row_count, metric_count + len(DAYS_OF_WEEK)))
+    for i in range(metric_count):
+        other_metrics = [j for j in range(metric_count) if j != i]
+        features[i, :, 0] = row_times_of_day
+        features[i, :, 1:metric_count] = averages[:, other_metrics]
+        features[i, :, metric_count:] = days_of_week
+
+    return FeatureMatrix(timestamps, day_offsets, features)
+
+
+# Builds the time of day profile of every device in one pass. Returns the devices (sorted) along with their profiles.
+def build_device_profiles(devices, time_of_day, metric_columns, bucket_secs=AVERAGES_BUCKET_SECS):
+    device_names, device_codes = np.unique(np.asarray(devices, dtype=str), return_inverse=True)
+    buckets = (np.asarray(time_of_day, dtype=np.int64) % SECONDS_PER_DAY // bucket_secs) * bucket_secs
+    keys, key_indexes = np.unique(device_codes.astype(np.int64) * SECONDS_PER_DAY + buckets, return_inverse=True)
+    counts = np.bincount(key_indexes)
+    averages = np.column_stack([np.bincount(key_indexes, weights=np.asarray(column, dtype=np.float64)) / counts
+                                for column in metric_columns])
+    boundaries = np.searchsorted(keys // SECONDS_PER_DAY, np.arange(len(device_names) + 1))
+    profiles = [TimeOfDayProfile(keys[start:end] - device * SECONDS_PER_DAY, averages[start:end])
+                for device, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:]))]
+    return device_names.tolist(), profiles
+
+
+# Forecasts every metric of every device with linear models, giving the same results as applying each device's models
+# to the rows of build_feature_matrix without building them. coefficients has shape (device, metric, feature) where the
+# features are those of build_feature_matrix followed by the intercept. Only the averages and the day of week differ
+# between rows, so each device and metric is scored once per time of day and the day of week term is added per day.
+# Yields (day_offset, timestamps, predictions) for each day of the horizon, predictions having shape
+# (device, metric, row), so that only a day of predictions is held at a time.
+def forecast_with_linear_models(coefficients, profiles, start_date=None, horizon_days=FORECAST_HORIZON_DAYS,
+                                resolution_secs=FORECAST_RESOLUTION_SECS, method=FORECAST_AVERAGES_METHOD):
+    start_date = start_date or datetime.datetime.now(datetime.timezone.utc).date()
+    times_of_day = np.arange(0, SECONDS_PER_DAY, resolution_secs, dtype=np.int64)
+    averages = np.stack([lookup_profile(profile, times_of_day, method) for profile in profiles])
+    metric_count = averages.shape[2]
+
+    by_time_of_day = np.empty((len(profiles), metric_count, len(times_of_day)))
+    for i in range(metric_count):
+        other_metrics = [j for j in range(metric_count) if j != i]
+        by_time_of_day[:, i] = (coefficients[:, i, :1] * times_of_day
+                                + np.einsum('dso,do->ds', averages[:, :, other_metrics],
+                                            coefficients[:, i, 1:metric_count])
+                                + coefficients[:, i, -1:])
+
+    start_of_horizon = int(datetime.datetime.combine(start_date, datetime.time(),
+                                                     tzinfo=datetime.timezone.utc).timestamp())
+    for day in range(horizon_days):
+        weekday = (start_date.weekday() + day) % len(DAYS_OF_WEEK)
+        timestamps = (start_of_horizon + day * SECONDS_PER_DAY + times_of_day) * 1000
+        yield day, timestamps, by_time_of_day + coefficients[:, :, metric_count + weekday, np.newaxis]
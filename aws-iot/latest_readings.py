@@ -0,0 +1,65 @@
+import logging
+import os
+
+from data_store import load_file_as_json, store_json_file
+from readings import METRIC_KEYS, device_of
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+LATEST_READINGS_FOLDER = os.getenv('LATEST_READINGS_FOLDER', 'latest')
+
+
+# Keeps a small object per device holding its latest reading, e.g. {"device": "RPi3BHome", "reading": {...}}, and a
+# fleet wide summary of the latest reading of every device, {"devices": {"RPi3BHome": {...}}}, so that current
+# conditions can be served without loading the day's data file. Readings older than the latest known reading (e.g. a
+# drained backlog) don't replace it, and metrics missing from deadband readings keep their last value.
+def update_latest_readings(readings):
+    latest_by_device = {}
+    for reading in readings:
+        latest_by_device.setdefault(device_of(reading), []).append(reading)
+
+    # A summary that failed to load must not be taken for a missing one, storing it would drop every other device
+    fleet_summary = load_file_as_json(get_fleet_summary_file_key(), raise_errors=True) or {'devices': {}}
+    updated_devices = {}
+    for device, device_readings in latest_by_device.items():
+        previous = fleet_summary['devices'].get(device)
+        latest = _merge_readings(previous, sorted(device_readings, key=lambda reading: reading['t']))
+        if latest is not previous:
+            updated_devices[device] = latest
+
+    for device, latest in updated_devices.items():
+        store_json_file(get_latest_reading_file_key(device), {'device': device, 'reading': latest})
+    if updated_devices:
+        fleet_summary['devices'].update(updated_devices)
+        store_json_file(get_fleet_summary_file_key(), fleet_summary)
+        log.info(f"Updated the latest readings of {len(updated_devices)} devices")
+
+
+def load_latest_reading(device):
+    return load_file_as_json(get_latest_reading_file_key(device))
+
+
+def load_fleet_summary():
+    return load_file_as_json(get_fleet_summary_file_key())
+
+
+def get_latest_reading_file_key(device):
+    return f'{LATEST_READINGS_FOLDER}/{device}.json'
+
+
+def get_fleet_summary_file_key():
+    return f'{LATEST_READINGS_FOLDER}/fleet.json'
+
+
+# Returns the previous reading unchanged if none of the readings are newer
+def _merge_readings(previous, readings_in_time_order):
+    latest = previous
+    for reading in readings_in_time_order:
+        if latest and reading['t'] <= latest['t']:
+            continue
+        merged = dict(reading)
+        if latest:
+            merged.update({key: latest[key] for key in METRIC_KEYS if key not in reading and key in latest})
+        latest = merged
+    return latest
@@ -0,0 +1,174 @@
+import datetime
+import logging
+import os
+import time
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+from archive import load_daily_file
+from forecast_features import FORECAST_RESOLUTION_SECS
+from readings import METRIC_KEYS, fill_forward, device_of
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# Past days don't change once they are over so they stay cached for the lifetime of the container, up to this many
+# days (least recently used are dropped first). Today's data is reloaded once it is older than the TTL.
+METRICS_INDEX_MAX_DAYS = int(os.getenv('METRICS_INDEX_MAX_DAYS', '90'))
+METRICS_INDEX_TODAY_TTL_SECS = int(os.getenv('METRICS_INDEX_TODAY_TTL_SECS', '60'))
+# Readings are only compared with a prediction within half the spacing of the predictions, i.e. of the time bucket they
+# are aligned to, so that readings of days without a forecast aren't compared with predictions of another day
+MAX_PREDICTION_DISTANCE_MS = FORECAST_RESOLUTION_SECS * 1000 // 2
+
+# Columnar form of a day's readings. t: epoch millis, devices: device of each reading, values/minimums/maximums: dict of
+# metric key -> float array with NaN where a reading doesn't have the metric. Minimums and maximums differ from the
+# values for summary readings only.
+DayColumns = namedtuple('DayColumns', ['t', 'devices', 'values', 'minimums', 'maximums'])
+
+_day_cache = OrderedDict()
+
+
+# Returns the columns for every reading between the start and end dates (inclusive) from either the metrics or the
+# predictions files
+def load_columns(start_date, end_date, source='metrics'):
+    days = []
+    date = start_date
+    while date <= end_date:
+        days.append(_load_day(date, source))
+        date += datetime.timedelta(days=1)
+
+    return DayColumns(
+        np.concatenate([day.t for day in days]),
+        np.concatenate([day.devices for day in days]),
+        *[{key: np.concatenate([getattr(day, field)[key] for day in days]) for key in METRIC_KEYS}
+          for field in ('values', 'minimums', 'maximums')]
+    )
+
+
+# Returns the columns with only the readings of the given devices (all devices if None)
+def filter_devices(columns, devices):
+    if not devices:
+        return columns
+    mask = np.isin(columns.devices, devices)
+    return DayColumns(columns.t[mask], columns.devices[mask],
+                      *[{key: values[key][mask] for key in METRIC_KEYS}
+                        for values in (columns.values, columns.minimums, columns.maximums)])
+
+
+# Computes count, min, max, mean, standard deviation and the given percentiles of each metric
+def compute_stats(columns, metrics, percentiles=()):
+    stats = {}
+    for key in metrics:
+        present = ~np.isnan(columns.values[key])
+        values = columns.values[key][present]
+        metric_stats = {'count': int(values.size)}
+        if values.size:
+            metric_stats.update({
+                'min': _round(np.min(columns.minimums[key][present])),
+                'max': _round(np.max(columns.maximums[key][present])),
+                'mean': _round(np.mean(values)),
+                'std': _round(np.std(values))
+            })
+            if percentiles:
+                metric_stats.update({f'p{p:g}': _round(value)
+                                     for p, value in zip(percentiles, np.percentile(values, percentiles))})
+        stats[key] = metric_stats
+    return stats
+
+
+# Computes the mean of each metric for each (UTC) day
+def compute_daily_means(columns, metrics):
+    days = columns.t // (24 * 60 * 60 * 1000)
+    unique_days, day_indexes = np.unique(days, return_inverse=True)
+    daily_means = {}
+    for key in metrics:
+        present = ~np.isnan(columns.values[key])
+        sums = np.bincount(day_indexes[present], weights=columns.values[key][present], minlength=len(unique_days))
+        counts = np.bincount(day_indexes[present], minlength=len(unique_days))
+        for day, total, count in zip(unique_days.tolist(), sums.tolist(), counts.tolist()):
+            if count:
+                date = datetime.datetime.fromtimestamp(day * 24 * 60 * 60, datetime.timezone.utc).strftime('%Y-%m-%d')
+                daily_means.setdefault(date, {})[key] = round(total / count, 2)
+    return daily_means
+
+
+# Compares actual readings with the prediction closest in time to each of them, returning the mean absolute error,
+# root mean squared error and bias (mean of predicted - actual) of each metric. Readings are compared with the
+# predictions of their own device when there are any (see the model bundle in predict.py), otherwise with the fleet wide
+# predictions.
+def compare_with_predictions(actuals, predictions, metrics):
+    errors = {key: [] for key in metrics}
+    prediction_devices = set(predictions.devices.tolist())
+    for device in sorted(set(actuals.devices.tolist())):
+        device_predictions = filter_devices(predictions, [device]) if device in prediction_devices else predictions
+        device_actuals = filter_devices(actuals, [device])
+        for key in metrics:
+            errors[key].append(_prediction_errors(device_actuals, device_predictions, key))
+
+    comparison = {}
+    for key in metrics:
+        metric_errors = np.concatenate(errors[key]) if errors[key] else np.empty(0)
+        comparison[key] = {'count': int(metric_errors.size)}
+        if metric_errors.size:
+            comparison[key].update({
+                'mae': _round(np.mean(np.abs(metric_errors))),
+                'rmse': _round(np.sqrt(np.mean(metric_errors ** 2))),
+                'bias': _round(np.mean(metric_errors))
+            })
+    return comparison
+
+
+def _prediction_errors(actuals, predictions, key):
+    order = np.argsort(predictions.t, kind='stable')
+    prediction_times = predictions.t[order]
+    present = ~np.isnan(actuals.values[key])
+    if not prediction_times.size or not present.any():
+        return np.empty(0)
+
+    actual_times = actuals.t[present]
+    right = np.clip(np.searchsorted(prediction_times, actual_times), 1, max(1, len(prediction_times) - 1))
+    left = np.maximum(right - 1, 0)
+    right = np.minimum(right, len(prediction_times) - 1)
+    nearest = np.where(actual_times - prediction_times[left] <= prediction_times[right] - actual_times, left, right)
+    errors = predictions.values[key][order][nearest] - actuals.values[key][present]
+    aligned = np.abs(prediction_times[nearest] - actual_times) <= MAX_PREDICTION_DISTANCE_MS
+    return errors[aligned & ~np.isnan(errors)]
+
+
+def clear_cache():
+    _day_cache.clear()
+
+
+def _load_day(date, source):
+    file_key = date.strftime('%Y-%m-%d') + ('-predictions' if source == 'predictions' else '')
+    is_today = date >= datetime.datetime.now().date()
+    cached = _day_cache.get(file_key)
+    if cached and (not is_today or time.time() - cached[0] < METRICS_INDEX_TODAY_TTL_SECS):
+        _day_cache.move_to_end(file_key)
+        return cached[1]
+
+    json_data = load_daily_file(file_key)
+    columns = _to_columns(fill_forward(json_data['entries']) if json_data else [])
+    _day_cache[file_key] = (time.time(), columns)
+    _day_cache.move_to_end(file_key)
+    while len(_day_cache) > METRICS_INDEX_MAX_DAYS:
+        _day_cache.popitem(last=False)
+    log.debug(f"Indexed {len(columns.t)} readings from {file_key}")
+    return columns
+
+
+def _to_columns(entries):
+    values = {key: np.array([entry.get(key, np.nan) for entry in entries], dtype=np.float64) for key in METRIC_KEYS}
+    minimums = {key: np.fmin(values[key], np.array([entry.get(f'{key}_min', np.nan) for entry in entries],
+                                                   dtype=np.float64)) for key in METRIC_KEYS}
+    maximums = {key: np.fmax(values[key], np.array([entry.get(f'{key}_max', np.nan) for entry in entries],
+                                                   dtype=np.float64)) for key in METRIC_KEYS}
+    return DayColumns(
+        np.array([entry['t'] for entry in entries], dtype=np.int64),
+        np.array([device_of(entry) for entry in entries], dtype=object),
+        values, minimums, maximums
+    )
+
+
+def _round(value):
+    return round(float(value), 2)
@@ -0,0 +1,39 @@
+import io
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from data_store import load_file_as_bytes
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# The per device models built by sagemaker/train.py (see fit_device_models there), stored together as a single
+# compressed NumPy archive:
+# - metric_types: the metrics, in the order of the models
+# - devices: the devices with models of their own, the model of devices[i] is at i + 1
+# - coefficients: array of shape (model, metric, feature), the features being those of forecast_features.py followed
+#   by the intercept. The first model is the global one, used for devices without enough data for a model of their own.
+# - rmse: training root mean squared error of each model, array of shape (model, metric)
+# - rows: number of rows each model was fit on
+ModelBundle = namedtuple('ModelBundle', ['metric_types', 'devices', 'coefficients', 'rmse', 'rows'])
+
+
+def load_model_bundle(file_key):
+    bundle_bytes = load_file_as_bytes(file_key)
+    if bundle_bytes is None:
+        raise ValueError(f'Model bundle {file_key} was not found')
+
+    with np.load(io.BytesIO(bundle_bytes), allow_pickle=False) as bundle:
+        return ModelBundle(bundle['metric_types'].tolist(), bundle['devices'].tolist(), bundle['coefficients'],
+                           bundle['rmse'], bundle['rows'])
+
+
+# Returns the coefficients of each of the devices' models, array of shape (device, metric, feature). Devices without a
+# model of their own get the global model.
+def device_coefficients(bundle, devices):
+    model_indexes = {device: i + 1 for i, device in enumerate(bundle.devices)}
+    indexes = [model_indexes.get(device, 0) for device in devices]
+    log.info(f"{sum(1 for index in indexes if index)} of {len(devices)} devices have models of their own")
+    return bundle.coefficients[indexes]
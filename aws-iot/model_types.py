@@ -0,0 +1,3 @@
+# The metrics that a model is trained and deployed for. Kept in its own module so that handlers which only need the
+# names (e.g. the deploy and clean up steps) don't import the prediction dependencies.
+MODEL_TYPES = ['temperature', 'humidity', 'pressure']
@@ -0,0 +1,8 @@
+# The heavy requirements (numpy, pandas) are packaged zipped (see serverless.yml) and only unzipped when a
+# handler first needs them, so that the handlers that don't need them don't pay for it on cold start. Call
+# import_requirements before importing any of them, or any module that does (e.g. metrics_index, forecast_features).
+def import_requirements():
+    try:
+        import unzip_requirements
+    except ImportError:
+        pass
@@ -0,0 +1,143 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# Lightweight performance metrics for the Lambda handlers. Handlers decorated with handler_metrics collect the metrics
+# recorded while they run and emit them as a single CloudWatch Embedded Metric Format (EMF) log line when they finish,
+# which CloudWatch turns into metrics with the handler as a dimension. Operations (S3 calls, endpoint requests,
+# waits) are measured with timed(), which records their count and duration along with any values added to it.
+# add_metrics records values without timing anything.
+#
+#   with timed('StorageLoad') as measurement:
+#       content = ...
+#       measurement.add(BytesRead=len(content))
+#
+# Emits e.g. {"Handler": "api.fetch_metrics", "HandlerDuration": 35.2, "StorageLoadCount": 1,
+# "StorageLoadDuration": 30.1, "StorageLoadBytesRead": 52311, "_aws": {...}}
+#
+# Metrics are only collected when PERF_METRICS_ENABLED is "true". Otherwise handlers are called directly and timed()
+# returns a shared object that does nothing, so the instrumentation costs a flag check per call.
+
+PERF_METRICS_ENABLED = os.getenv('PERF_METRICS_ENABLED', 'false').lower() == 'true'
+PERF_METRICS_NAMESPACE = os.getenv('PERF_METRICS_NAMESPACE', 'RpiAwsIot')
+
+UNITS = {
+    'Count': 'Count',
+    'Duration': 'Milliseconds',
+    'BytesRead': 'Bytes',
+    'BytesWritten': 'Bytes',
+    'Records': 'Count',
+    'Retries': 'Count',
+    'Duplicates': 'Count',
+    'Errors': 'Count'
+}
+
+# Lambda runs one invocation at a time per container, but operations may be measured from several threads (e.g. the
+# endpoint requests) so updates are guarded by a lock
+_invocation = {'metrics': None}
+_lock = threading.Lock()
+
+
+# Decorator for Lambda handlers that emits the metrics collected during each invocation
+def handler_metrics(handler):
+    handler_name = f'{handler.__module__}.{handler.__name__}'
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not PERF_METRICS_ENABLED:
+            return handler(event, context)
+
+        _invocation['metrics'] = {}
+        started = time.perf_counter()
+        errors = 0
+        try:
+            return handler(event, context)
+        except Exception:
+            errors = 1
+            raise
+        finally:
+            metrics = _invocation['metrics']
+            _invocation['metrics'] = None
+            _add(metrics, 'Handler', Duration=(time.perf_counter() - started) * 1000, Errors=errors)
+            emit(handler_name, metrics)
+    return wrapper
+
+
+# Measures an operation of the current invocation, see above
+def timed(operation):
+    if not PERF_METRICS_ENABLED or _invocation['metrics'] is None:
+        return _NO_MEASUREMENT
+    return _Measurement(operation, _invocation['metrics'])
+
+
+# Adds values (e.g. Records=10) to the metrics of an operation of the current invocation without timing it
+def add_metrics(operation, **values):
+    if PERF_METRICS_ENABLED and _invocation['metrics'] is not None:
+        _add(_invocation['metrics'], operation, **values)
+
+
+# Prints the metrics as an EMF log line. Printed rather than logged as EMF lines must not have a log prefix.
+def emit(handler_name, metrics):
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': PERF_METRICS_NAMESPACE,
+                'Dimensions': [['Handler']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in sorted(metrics.items())]
+            }]
+        },
+        'Handler': handler_name
+    }
+    document.update({name: round(value, 3) for name, (value, unit) in metrics.items()})
+    print(json.dumps(document), flush=True)
+
+
+def _add(metrics, operation, **values):
+    with _lock:
+        for name, value in values.items():
+            metric_name = f'{operation}{name}'
+            current_value = metrics.get(metric_name, (0, None))[0]
+            metrics[metric_name] = (current_value + value, UNITS.get(name, 'None'))
+
+
+class _Measurement:
+    __slots__ = ('operation', 'metrics', 'values', 'started')
+
+    def __init__(self, operation, metrics):
+        self.operation = operation
+        self.metrics = metrics
+        self.values = {'Count': 1}
+
+    def add(self, **values):
+        for name, value in values.items():
+            self.values[name] = self.values.get(name, 0) + value
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.values['Duration'] = (time.perf_counter() - self.started) * 1000
+        if exc_type:
+            self.values['Errors'] = 1
+        _add(self.metrics, self.operation, **self.values)
+        return False
+
+
+class _NoMeasurement:
+    __slots__ = ()
+
+    def add(self, **values):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_MEASUREMENT = _NoMeasurement()
@@ -1,51 +1,96 @@
-try:
-    import unzip_requirements
-except ImportError:
-    pass
-
-import boto3
 import datetime
+import hashlib
+import json
 import os
 import time
 import logging
-import json
 from io import StringIO
-import pandas as pd
 
-from data_store import load_file_as_string, append_data_as_json
+from aws_clients import get_client
+from data_store import load_file_as_bytes, load_file_as_string, store_file
+from endpoint_invoker import invoke_endpoints
+from model_types import MODEL_TYPES
+from packaged_requirements import import_requirements
+from perf_metrics import handler_metrics, timed, add_metrics
+from profiling import profiled
+from run_manifest import create_run_manifest, get_run_id, store_run_manifest
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 S3_BUCKET = os.getenv("S3_BUCKET")
 MODELS_PATH = os.getenv("MODELS_PATH")
-MODEL_TYPES = ['temperature', 'humidity', 'pressure']
-
-
+PREDICTION_CACHE_FOLDER = os.getenv('PREDICTION_CACHE_FOLDER', 'prediction-cache')
+# Keys used for each model type in the stored data points
+METRIC_KEYS = {'temperature': 'tmp', 'humidity': 'hum', 'pressure': 'pr'}
+# Number of endpoint requests made between each save of the prediction cache
+PREDICTION_CACHE_CHUNK_SIZE = int(os.getenv('PREDICTION_CACHE_CHUNK_SIZE', '500'))
+
+
+# Deploys an endpoint for each of the global models trained by the run. The resources are recorded in the run's
+# manifest before they are created so that cleanup (see finalize.py) finds them even if the deployment fails part way.
+# Besides the endpoint names, the id of the model behind each endpoint is returned (see _get_model_id).
+@profiled
+@handler_metrics
 def deploy_models(event, context):
     try:
-        _create_models()
-        _create_endpoint_configs()
-        endpoints = _create_endpoints()
+        run_id = get_run_id(event)
+        model_ids = {model_type: _get_model_id(run_id, model_type) for model_type in MODEL_TYPES}
+        _store_deployment_manifest(run_id, model_ids)
+        _create_models(run_id)
+        _create_endpoint_configs(run_id)
+        endpoints = _create_endpoints(run_id)
+        endpoints.update({f'{model_type}-model-id': model_id for model_type, model_id in model_ids.items()})
         return endpoints
     except Exception as e:
         log.error(f"An error occurred while deploying models: {e}")
         raise e
 
 
-def _create_models():
+# Resources are named after the run rather than the current date so that a deployment that runs past midnight, or is
+# retried the next day, still names every resource consistently
+def _get_resource_names(run_id, model_type):
+    model_name = f'{run_id}-{model_type}-model'
+    return model_name, f'{run_id}-{model_type}-endpoint-config', f'{model_name}-endpoint'
+
+
+# Identifies the model by the content of its artifact, unlike the model name it changes whenever the model is retrained
+# (e.g. a retrain and redeploy on the same day), so that predictions cached for an earlier model are never served
+def _get_model_id(run_id, model_type):
+    model_name = _get_resource_names(run_id, model_type)[0]
+    model_file_key = f'{MODELS_PATH}/{model_name}.tar.gz'
+    artifact = load_file_as_bytes(model_file_key)
+    if artifact is None:
+        raise ValueError(f'Model artifact {model_file_key} was not found')
+    return f'{model_name}-{hashlib.blake2b(artifact, digest_size=8).hexdigest()}'
+
+
+def _store_deployment_manifest(run_id, model_ids):
+    manifest = create_run_manifest(run_id)
+    for model_type in MODEL_TYPES:
+        model_name, endpoint_config_name, endpoint_name = _get_resource_names(run_id, model_type)
+        manifest['models'].append(model_name)
+        manifest['endpointConfigs'].append(endpoint_config_name)
+        manifest['endpoints'].append(endpoint_name)
+        # The model artifact and the predictions cached for the endpoint are of no use once the endpoint is gone
+        manifest['files'].append(f'{MODELS_PATH}/{model_name}.tar.gz')
+        manifest['files'].append(f'{PREDICTION_CACHE_FOLDER}/{model_ids[model_type]}.json')
+    store_run_manifest(manifest)
+    log.info(f"Stored the manifest of run {run_id}")
+
+
+def _create_models(run_id):
     for model_type in MODEL_TYPES:
-        _create_model(model_type)
+        _create_model(run_id, model_type)
 
 
-def _create_model(model_type):
+def _create_model(run_id, model_type):
     log.info(f'Creating model for type: {model_type}')
-    date_today = datetime.datetime.now().strftime('%Y-%m-%d')
-    model_name = f'{date_today}-{model_type}-model'
+    model_name = _get_resource_names(run_id, model_type)[0]
     model_file_key = f'{model_name}.tar.gz'
 
     log.info(f'Path to model files: s3://{S3_BUCKET}/{MODELS_PATH}/{model_file_key}')
 
-    sagemaker = boto3.client('sagemaker')
+    sagemaker = get_client('sagemaker')
     sagemaker.create_model(
         ModelName=model_name,
         PrimaryContainer={
@@ -65,18 +110,16 @@ def _create_model(model_type):
     log.info(f"Model created: {model_name}")
 
 
-def _create_endpoint_configs():
+def _create_endpoint_configs(run_id):
     for model_type in MODEL_TYPES:
-        _create_endpoint_config(model_type)
+        _create_endpoint_config(run_id, model_type)
 
 
-def _create_endpoint_config(model_type):
+def _create_endpoint_config(run_id, model_type):
     log.info(f'Creating endpoint config for {model_type}')
-    date_today = datetime.datetime.now().strftime('%Y-%m-%d')
-    endpoint_config_name = f'{date_today}-{model_type}-endpoint-config'
-    model_name = f'{date_today}-{model_type}-model'
+    model_name, endpoint_config_name, _ = _get_resource_names(run_id, model_type)
 
-    sagemaker = boto3.client('sagemaker')
+    sagemaker = get_client('sagemaker')
     sagemaker.create_endpoint_config(
         EndpointConfigName=endpoint_config_name,
         ProductionVariants=[
@@ -92,15 +135,16 @@ def _create_endpoint_config(model_type):
     log.info(f"Endpoint config created: {endpoint_config_name}")
 
 
-def _create_endpoints():
-    temp_endpoint_name = _create_endpoint('temperature')
-    humidity_endpoint_name = _create_endpoint('humidity')
-    pressure_endpoint_name = _create_endpoint('pressure')
+def _create_endpoints(run_id):
+    temp_endpoint_name = _create_endpoint(run_id, 'temperature')
+    humidity_endpoint_name = _create_endpoint(run_id, 'humidity')
+    pressure_endpoint_name = _create_endpoint(run_id, 'pressure')
 
-    if (not _wait_for_endpoint_creation(temp_endpoint_name)
-            or not _wait_for_endpoint_creation(humidity_endpoint_name)
-            or not _wait_for_endpoint_creation(pressure_endpoint_name)):
-        raise Exception("Endpoint creation failed.")
+    with timed('EndpointCreationWait'):
+        if (not _wait_for_endpoint_creation(temp_endpoint_name)
+                or not _wait_for_endpoint_creation(humidity_endpoint_name)
+                or not _wait_for_endpoint_creation(pressure_endpoint_name)):
+            raise Exception("Endpoint creation failed.")
 
     return {
         'temperature-endpoint': temp_endpoint_name,
@@ -109,13 +153,10 @@ def _create_endpoints():
     }
 
 
-def _create_endpoint(model_type):
+def _create_endpoint(run_id, model_type):
     log.info(f'Creating endpoint for {model_type}')
-    sagemaker = boto3.client('sagemaker')
-    date_today = datetime.datetime.now().strftime('%Y-%m-%d')
-    model_name = f'{date_today}-{model_type}-model'
-    endpoint_config_name = f'{date_today}-{model_type}-endpoint-config'
-    endpoint_name = f'{model_name}-endpoint'
+    sagemaker = get_client('sagemaker')
+    model_name, endpoint_config_name, endpoint_name = _get_resource_names(run_id, model_type)
 
     sagemaker.create_endpoint(
         EndpointName=endpoint_name,
@@ -127,7 +168,7 @@ def _create_endpoint(model_type):
 
 
 def _wait_for_endpoint_creation(endpoint_name):
-    sagemaker = boto3.client('sagemaker')
+    sagemaker = get_client('sagemaker')
     tries = 10
 
     log.info(f"Waiting for endpoint creation to complete for endpoint: {endpoint_name}")
@@ -155,96 +196,154 @@ def _wait_for_endpoint_creation(endpoint_name):
     return False
 
 
+# Forecasts the metrics with the bundle of per device models given by modelBundleKey if there is one (see
+# model_bundle.py), otherwise with the global models served by the endpoints
+@profiled
+@handler_metrics
 def predict_daily_atmospheric_metrics(event, context):
     if 'aggregateFileKey' not in event:
         raise ValueError('No aggregate file key was provided, aborting')
-    if 'endpoints' not in event:
-        raise ValueError('No model endpoint names were provided, aborting')
+    if not event.get('modelBundleKey') and 'endpoints' not in event:
+        raise ValueError('No model bundle or endpoint names were provided, aborting')
+
+    # numpy and pandas are only imported here so that deploy_models doesn't pay for them on cold start
+    import_requirements()
+    import numpy as np
+    import pandas as pd
+    from forecast_features import build_feature_matrix
 
     aggregate_data = load_file_as_string(event['aggregateFileKey'])
     aggregate_data_df = pd.read_csv(StringIO(aggregate_data))
-    metric_averages_by_time_of_day = _get_averages_by_time_of_day(aggregate_data_df)
+    start_date = datetime.datetime.now(datetime.timezone.utc).date()
+    model_version = _get_model_version(event)
+    if event.get('modelBundleKey'):
+        _predict_with_model_bundle(event['modelBundleKey'], aggregate_data_df, start_date, model_version)
+        return
 
-    for i in range(7):
-        log.info(f"Predicting atmospheric metrics for day {i}")
+    metric_averages_by_time_of_day = _get_averages_by_time_of_day(aggregate_data_df)
+    feature_matrix = build_feature_matrix(metric_averages_by_time_of_day, MODEL_TYPES, start_date)
+
+    predicted_values = _predict_with_cache(event, feature_matrix)
+    _store_predictions(feature_matrix, np.round(predicted_values, 2), start_date, model_version)
+
+
+# Scores every row of the feature matrix, only invoking the endpoints for rows that have not already been scored by
+# the same model. Predictions are cached by the id of the model behind the endpoint (see _get_model_id) as endpoint
+# names don't change when a model is retrained, without model ids nothing is cached. The cache is persisted after every
+# chunk so that a rerun after a partial failure only pays for the rows that are still missing.
+def _predict_with_cache(event, feature_matrix):
+    import numpy as np
+    from prediction_cache import feature_row_key, load_prediction_cache, store_prediction_cache
+    endpoint_names = [_get_endpoint_name(event, metric_type) for metric_type in MODEL_TYPES]
+    model_ids = [event['endpoints'].get(f'{metric_type}-model-id') for metric_type in MODEL_TYPES]
+    caches = [load_prediction_cache(model_id) if model_id else {} for model_id in model_ids]
+    row_keys = [[feature_row_key(row) for row in metric_features] for metric_features in feature_matrix.features]
+
+    missing = {}
+    for metric_index, metric_row_keys in enumerate(row_keys):
+        for row, row_key in enumerate(metric_row_keys):
+            if row_key not in caches[metric_index]:
+                missing.setdefault((metric_index, row_key), row)
+
+    log.info(f"{len(missing)} of {sum(len(keys) for keys in row_keys)} predictions are not cached")
+    missing = list(missing.items())
+    for chunk_start in range(0, len(missing), PREDICTION_CACHE_CHUNK_SIZE):
+        chunk = missing[chunk_start:chunk_start + PREDICTION_CACHE_CHUNK_SIZE]
+        # Every request for the chunk is built up front so that the invocation engine can keep the endpoints busy
+        # rather than waiting on each interval in turn. Results come back in the same order as the requests.
+        requests = [(endpoint_names[metric_index], feature_matrix.features[metric_index, row].tolist())
+                    for (metric_index, row_key), row in chunk]
+        for ((metric_index, row_key), row), value in zip(chunk, invoke_endpoints(requests)):
+            caches[metric_index][row_key] = value
+
+        for metric_index in {metric_index for (metric_index, row_key), row in chunk}:
+            if model_ids[metric_index]:
+                store_prediction_cache(model_ids[metric_index], caches[metric_index])
+
+    return np.array([[caches[metric_index][row_key] for row_key in metric_row_keys]
+                     for metric_index, metric_row_keys in enumerate(row_keys)], dtype=np.float64)
+
+
+# Scores every device with its own model (or the global one) in bulk, a day of the horizon at a time. The features of
+# each device are derived from its own averages by time of day. Predictions are stored with their device, in time
+# order.
+def _predict_with_model_bundle(model_bundle_key, aggregate_data_df, start_date, model_version):
+    import numpy as np
+    from forecast_features import build_device_profiles, forecast_with_linear_models
+    from model_bundle import device_coefficients, load_model_bundle
+
+    bundle = load_model_bundle(model_bundle_key)
+    if bundle.metric_types != MODEL_TYPES:
+        raise ValueError(f'The model bundle predicts {bundle.metric_types} rather than {MODEL_TYPES}')
+
+    devices = aggregate_data_df['device'].fillna('') if 'device' in aggregate_data_df.columns \
+        else [''] * len(aggregate_data_df)
+    metric_values = [aggregate_data_df[metric_type].to_numpy() for metric_type in MODEL_TYPES]
+    devices, profiles = build_device_profiles(devices, aggregate_data_df['time_of_day'].to_numpy(), metric_values)
+    log.info(f"Forecasting {len(devices)} devices with model bundle {model_bundle_key}")
+    coefficients = device_coefficients(bundle, devices)
+    metric_keys = [METRIC_KEYS[metric_type] for metric_type in MODEL_TYPES]
+    for day, timestamps, predicted_values in forecast_with_linear_models(coefficients, profiles, start_date):
         predictions_for_day = []
-        timestamp_today_offset_by_days = int(datetime.datetime.now().timestamp()) + (i * 24 * 60 * 60)
-
-        #  IMPROVEMENT: I can send a whole day's worth of predictions in one request by sending a 2D array of data
-        #  instead of sending a request for each 10 minute interval.
-        seconds_per_day = 24 * 60 * 60
-        seconds_per_10_min = 10 * 60
-        for time_of_day_seconds in range(0, seconds_per_day, seconds_per_10_min):  # seconds / day, seconds / 10 minutes
-            prediction_for_time = {}
-            prediction_for_time['t'] = (timestamp_today_offset_by_days + time_of_day_seconds) * 1000
-
-            prediction_for_time['tmp'] = round((
-                _predict_metric_for_day_and_time(
-                    metric_averages_by_time_of_day, 'temperature', i, time_of_day_seconds, event)), 2)
-
-            prediction_for_time['hum'] = round((
-                _predict_metric_for_day_and_time(
-                    metric_averages_by_time_of_day, 'humidity', i, time_of_day_seconds, event)), 2)
-
-            prediction_for_time['pr'] = round((
-                _predict_metric_for_day_and_time(
-                    metric_averages_by_time_of_day, 'pressure', i, time_of_day_seconds, event)), 2)
-
+        # Rows of (device, metric) values for each time
+        for t, values_by_device in zip(timestamps.tolist(), np.round(predicted_values, 2).transpose(2, 0, 1).tolist()):
+            for device, values in zip(devices, values_by_device):
+                prediction = {'t': t, **dict(zip(metric_keys, values))}
+                if device:
+                    prediction['device'] = device
+                predictions_for_day.append(prediction)
+
+        add_metrics('Predictions', Records=len(predictions_for_day))
+        date_today_plus_offset = (start_date + datetime.timedelta(days=day)).strftime('%Y-%m-%d')
+        _store_predictions_for_day(predictions_for_day, date_today_plus_offset, day, model_version)
+
+
+def _store_predictions(feature_matrix, predicted_values, start_date, model_version):
+    import numpy as np
+    metric_keys = [METRIC_KEYS[metric_type] for metric_type in MODEL_TYPES]
+    for day in np.unique(feature_matrix.day_offsets).tolist():
+        log.info(f"Storing predicted atmospheric metrics for day {day}")
+        rows = np.flatnonzero(feature_matrix.day_offsets == day)
+        predictions_for_day = []
+        for row in rows.tolist():
+            prediction_for_time = {'t': int(feature_matrix.timestamps[row])}
+            for metric_index, metric_key in enumerate(metric_keys):
+                prediction_for_time[metric_key] = float(predicted_values[metric_index, row])
             predictions_for_day.append(prediction_for_time)
 
-        date_today_plus_offset = (datetime.datetime.now() + datetime.timedelta(days=i)).strftime('%Y-%m-%d')
-        _store_predictions_for_day(predictions_for_day, date_today_plus_offset)
-
+        date_today_plus_offset = (start_date + datetime.timedelta(days=day)).strftime('%Y-%m-%d')
+        _store_predictions_for_day(predictions_for_day, date_today_plus_offset, day, model_version)
 
-def _predict_metric_for_day_and_time(metric_averages, metric_type, day, time_of_day, event):
-    endpoint_name = _get_endpoint_name(event, metric_type)
-    feature_types = MODEL_TYPES.copy()
-    feature_types.remove(metric_type)
 
-    averages_for_time_of_day = metric_averages.loc[time_of_day]
-    feature_data = [time_of_day,
-                    averages_for_time_of_day[feature_types[0]],
-                    averages_for_time_of_day[feature_types[1]],
-                    False, False, False, False, False, False, False]  # fill in values for one-hot encoded days of week
-    feature_data[day + 3] = True
-
-    data = {
-        "features": feature_data
-    }
-
-    payload = json.dumps(data)
-    sagemaker = boto3.client('sagemaker-runtime', region_name='us-west-1')
-    response = sagemaker.invoke_endpoint(
-        EndpointName=endpoint_name,
-        ContentType='application/json',
-        Body=payload
-    )
-    predicted_value = json.loads(response['Body'].read().decode('utf-8'))[0]
-    return predicted_value
-
-
-# Note that this changes the data in the data frame, specifically it updates time_of_day so that the values are
-# truncated
+# Averages the metrics by time of day (truncated to the nearest 100 seconds) so that readings that come in at
+# slightly different times can still be averaged together to generate prediction feature values
 def _get_averages_by_time_of_day(aggregate_data_df):
+    from forecast_features import build_time_of_day_profile
     log.info("Creating metric averages by time of day")
-    # Truncate the time of day to the nearest 100 seconds so that readings that come in at slightly different times
-    # can still be averaged together to generate prediction feature values
-    aggregate_data_df['time_of_day'] = (aggregate_data_df['time_of_day'] // 100) * 100
-    return aggregate_data_df.groupby(['time_of_day']).agg({
-        'temperature': 'mean',
-        'pressure': 'mean',
-        'humidity': 'mean'
-    })
+    return build_time_of_day_profile(aggregate_data_df['time_of_day'].to_numpy(),
+                                     [aggregate_data_df[metric_type].to_numpy() for metric_type in MODEL_TYPES])
 
 
-def _store_predictions_for_day(predictions, date):
+# Besides the predictions, the file records how many days ahead of the forecast's start the day was (h), the version
+# of the models that made them (v) and their spacing in seconds (r) so that their accuracy can be tracked per horizon
+# and model version as the actual readings come in, see forecast_accuracy.py. Errors are raised so that the run fails
+# (see the Catch of PredictNext7Days in serverless.yml) rather than silently leaving the day without a forecast.
+def _store_predictions_for_day(predictions, date, horizon_day, model_version):
+    # The spacing of the predictions, imported here like the rest of forecast_features as it needs numpy
+    from forecast_features import FORECAST_RESOLUTION_SECS
     file_key = f'{date}-predictions'
     log.info(f'Saving {len(predictions)} predictions to file with key {file_key}')
-    try:
-        append_data_as_json(predictions, file_key)
-    except Exception as e:
-        log.error(f"An error occurred while storing predictions in file with key {file_key}: {e}")
+    json_data = {'entries': predictions, 'h': horizon_day, 'v': model_version, 'r': FORECAST_RESOLUTION_SECS}
+    store_file(file_key, json.dumps(json_data).encode('utf-8'))
 
 
 def _get_endpoint_name(event, model_type):
     return event['endpoints'][f'{model_type}-endpoint']
+
+
+# The model bundle's name (e.g. "2024-05-05-forecast-models") or, for the global models served by endpoints, the date
+# of the models they serve (e.g. "2024-05-05-endpoint-models", see _create_endpoint)
+def _get_model_version(event):
+    if event.get('modelBundleKey'):
+        return os.path.splitext(os.path.basename(event['modelBundleKey']))[0]
+    return _get_endpoint_name(event, MODEL_TYPES[0])[:len('YYYY-MM-DD')] + '-endpoint-models'
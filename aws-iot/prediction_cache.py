@@ -0,0 +1,33 @@
+import hashlib
+import logging
+import os
+import numpy as np
+
+from data_store import load_file_as_json, store_json_file
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+PREDICTION_CACHE_FOLDER = os.getenv('PREDICTION_CACHE_FOLDER', 'prediction-cache')
+
+
+# Returns a key that identifies the feature row regardless of whether it was built as a list or a NumPy array
+def feature_row_key(feature_row):
+    row_bytes = np.asarray(feature_row, dtype=np.float64).tobytes()
+    return hashlib.blake2b(row_bytes, digest_size=12).hexdigest()
+
+
+# Loads the cached predictions for the model as a dict of feature row key -> predicted value. The model id must
+# change whenever the model artifact does, otherwise stale predictions would be served.
+def load_prediction_cache(model_id):
+    cache = load_file_as_json(get_prediction_cache_file_key(model_id))
+    log.info(f"Loaded {len(cache) if cache else 0} cached predictions for model {model_id}")
+    return cache or {}
+
+
+def store_prediction_cache(model_id, cache):
+    store_json_file(get_prediction_cache_file_key(model_id), cache)
+
+
+def get_prediction_cache_file_key(model_id):
+    return f'{PREDICTION_CACHE_FOLDER}/{model_id}.json'
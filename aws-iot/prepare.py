@@ -1,4 +1,3 @@
-import boto3
 import logging
 import datetime
 import io
@@ -6,13 +5,20 @@ import csv
 import time
 import os
 
-from data_store import load_file_as_json, store_file_stream
+from archive import load_archived_entries
+from aws_clients import get_client
+from data_store import list_files, load_file_as_json, store_file_stream
+from perf_metrics import handler_metrics, timed
+from profiling import profiled
+from readings import METRIC_KEYS, device_of, fill_forward
+from run_manifest import get_run_id
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
-s3 = boto3.client('s3')
 
 
+@profiled
+@handler_metrics
 def generate_csv_from_daily_data(event, context):
     log.info("Aggregating data from the last 30 days.")
     today = datetime.datetime.now()
@@ -26,16 +32,25 @@ def generate_csv_from_daily_data(event, context):
 def _convert_daily_reports_to_csv(end_date):
     csv_output = io.StringIO()
     csv_writer = _create_csv_writer(csv_output)
+    missing_dates = []
     for i in range(30):
         date = end_date - datetime.timedelta(days=i)
         file_key = date.strftime("%Y-%m-%d")
         data = load_file_as_json(file_key)
         if not data or not data['entries']:
             log.debug(f"No data found for {file_key}")
+            missing_dates.append(date.date())
             continue
 
         log.info(f"Appending data from file: {file_key}")
         _convert_rows_to_csv(data['entries'], csv_writer.writerow)
+
+    # Days from previous months may have been compacted, they are read from the archive in one go rather than a day
+    # at a time
+    if missing_dates:
+        archived_entries = load_archived_entries(min(missing_dates), max(missing_dates))
+        log.info(f"Appending {len(archived_entries)} archived readings")
+        _convert_rows_to_csv(archived_entries, csv_writer.writerow)
     return csv_output
 
 
@@ -45,23 +60,35 @@ def get_aggregate_dataset_file_key():
     return f'{aggregates_folder}/{date_today}-aggregate-data.csv'
 
 
+# The device column is last so that the models served by endpoints, which are fit on every device's data together,
+# can simply drop it
 def _create_csv_writer(csv_output):
-    field_names = ['day_of_week', 'time_of_day', 'temperature', 'humidity', 'pressure']
+    field_names = ['day_of_week', 'time_of_day', 'temperature', 'humidity', 'pressure', 'device']
     writer = csv.writer(csv_output, delimiter=',')
     writer.writerow(field_names)
     return writer
 
 
+# Deadband readings are filled in with the last values sent so that every row has all metrics, rows that still miss a
+# metric (i.e. from before the first full reading of the day) are skipped. Summary readings are converted like any
+# other reading using their mean values at the middle of the summarized window.
 def _convert_rows_to_csv(data_rows, row_callback):
-    for row in data_rows:
-        epoch_time = int(row['t'] / 1000)
-        dt_object = datetime.datetime.utcfromtimestamp(epoch_time)
-        midnight = dt_object.replace(hour=0, minute=0, second=0, microsecond=0)
-        seconds_elapsed_from_midnight = (dt_object - midnight).seconds
-        date_from_epoch_time = datetime.datetime.fromtimestamp(epoch_time)
-        day_of_week = date_from_epoch_time.strftime('%A')
-        csv_row = [day_of_week, seconds_elapsed_from_midnight, row['tmp'], row['hum'], row['pr']]
-        row_callback(csv_row)
+    with timed('CsvConversion') as measurement:
+        rows_converted = 0
+        for row in fill_forward(data_rows):
+            if any(key not in row for key in METRIC_KEYS):
+                continue
+            rows_converted += 1
+
+            epoch_time = int(row['t'] / 1000)
+            dt_object = datetime.datetime.utcfromtimestamp(epoch_time)
+            midnight = dt_object.replace(hour=0, minute=0, second=0, microsecond=0)
+            seconds_elapsed_from_midnight = (dt_object - midnight).seconds
+            date_from_epoch_time = datetime.datetime.fromtimestamp(epoch_time)
+            day_of_week = date_from_epoch_time.strftime('%A')
+            csv_row = [day_of_week, seconds_elapsed_from_midnight, row['tmp'], row['hum'], row['pr'], device_of(row)]
+            row_callback(csv_row)
+        measurement.add(Records=rows_converted)
 
 
 def _upload_csv_to_s3(csv_output, file_key):
@@ -70,20 +97,31 @@ def _upload_csv_to_s3(csv_output, file_key):
     log.info(f"File '{file_key}' stored in S3 bucket.")
 
 
+@profiled
+@handler_metrics
 def train_models(event, context):
     if 'aggregateFileKey' not in event:
         raise ValueError('No aggregate file key was provided, aborting')
 
     training_job_params = _get_training_job_params(event)
-    sagemaker = boto3.client('sagemaker')
+    sagemaker = get_client('sagemaker')
     sagemaker.create_training_job(**training_job_params)
     log.info("Building models, waiting for completion")
-    _wait_for_job_completion(training_job_params['TrainingJobName'])
+    with timed('TrainingJobWait'):
+        _wait_for_job_completion(training_job_params['TrainingJobName'])
     log.info("Finished model training")
 
+    # Besides the global models served by endpoints, the training job builds a bundle of per device models. Its key is
+    # returned when it was stored so that the predictions are made from it rather than by deploying the endpoints.
+    model_bundle_key = training_job_params['HyperParameters']['model_bundle_key']
+    if model_bundle_key in list_files(model_bundle_key):
+        return model_bundle_key
+    log.info(f"No model bundle was stored in {model_bundle_key}, predictions will be made with the endpoints")
+    return None
+
 
 def _wait_for_job_completion(job_name):
-    sagemaker = boto3.client('sagemaker')
+    sagemaker = get_client('sagemaker')
     status = 'InProgress'
     tries = 30
 
@@ -98,8 +136,17 @@ def _wait_for_job_completion(job_name):
         tries -= 1
 
 
+def get_model_bundle_file_key(run_id):
+    models_path = os.getenv('MODELS_PATH', 'models')
+    return f'{models_path}/{run_id}-forecast-models.npz'
+
+
+# The training job names the model artifacts after the run (see run_manifest.py), like the resources deploy_models
+# creates from them (see predict.py), so that a run that trains past midnight or is retried the next day deploys the
+# models it trained
 def _get_training_job_params(event):
     date_today = datetime.datetime.now().strftime('%Y-%m-%d')
+    run_id = get_run_id(event)
     training_job_name = f'{date_today}-train-models-job-{int(datetime.datetime.now().timestamp())}'
     base_s3_bucket = os.getenv('S3_BUCKET')
     aggregates_folder = os.getenv('AGGREGATES_FOLDER')
@@ -116,7 +163,12 @@ def _get_training_job_params(event):
             "sagemaker_submit_directory": f"s3://{base_s3_bucket}/{sagemaker_folder}/train.tar.gz",
             "sagemaker_region": "us-west-1",
             "s3_bucket": base_s3_bucket,
-            "aggregate_file_key": event['aggregateFileKey']
+            "aggregate_file_key": event['aggregateFileKey'],
+            "run_id": run_id,
+            "profile_sample_rate": os.getenv('TRAINING_PROFILE_SAMPLE_RATE', '0'),
+            "model_bundle_key": get_model_bundle_file_key(run_id),
+            # Devices with less data than this (about 2 weeks of readings every 10 minutes) use the global models
+            "min_device_rows": os.getenv('MIN_DEVICE_ROWS', '2000')
         },
         "RoleArn": "arn:aws:iam::904381544143:role/rpi-aws-iot-prototype-dev-us-west-1-lambdaRole",
         "OutputDataConfig": {
@@ -0,0 +1,117 @@
+import cProfile
+import datetime
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from data_store import store_file_stream
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# On demand profiling of the Lambda handlers. A sampled fraction of the invocations of handlers decorated with
+# profiled are run under cProfile and tracemalloc, and a report of the hottest functions and largest allocations is
+# stored through data_store (along with the raw cProfile stats for tools like snakeviz):
+#   {PROFILE_REPORTS_FOLDER}/{handler}/{time}-{request id}.txt and .prof
+#
+# The settings are read on every invocation so profiling can be turned on for a deployed function by changing its
+# environment, without deploying any code:
+# - PROFILE_SAMPLE_RATE: fraction of invocations to profile, 0 (the default) disables profiling
+# - PROFILE_HANDLERS: comma separated handlers to profile (e.g. "prepare.generate_csv_from_daily_data"), defaults to all
+# - PROFILE_TRACEMALLOC: "false" to only profile calls, tracing allocations slows the handler down a lot more
+PROFILE_REPORTS_FOLDER = os.getenv('PROFILE_REPORTS_FOLDER', 'profiles')
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 25
+PROFILE_TRACEMALLOC_FRAMES = 5
+
+
+def profiled(handler):
+    handler_name = f'{handler.__module__}.{handler.__name__}'
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not _should_profile(handler_name):
+            return handler(event, context)
+        return _profile(handler_name, handler, event, context)
+    return wrapper
+
+
+# Runs the function under cProfile (and tracemalloc) and returns its result. Once it has finished, even if it failed,
+# the report and the raw stats are passed to report_callback.
+def profile_call(report_callback, function, *args, trace_allocations=True, **kwargs):
+    if trace_allocations:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        duration = time.perf_counter() - started
+        snapshot = peak_memory = None
+        if trace_allocations:
+            snapshot = tracemalloc.take_snapshot()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        try:
+            report_callback(_build_report(profiler, duration, snapshot, peak_memory), _raw_stats(profiler))
+        except Exception as e:
+            log.error(f'Unable to report the profile of {function.__name__}: {e}')
+
+
+def _should_profile(handler_name):
+    sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE') or 0)
+    if sample_rate <= 0:
+        return False
+    handlers = [name.strip() for name in os.getenv('PROFILE_HANDLERS', '').split(',') if name.strip()]
+    return (not handlers or handler_name in handlers) and random.random() < sample_rate
+
+
+def _profile(handler_name, handler, event, context):
+    trace_allocations = os.getenv('PROFILE_TRACEMALLOC', 'true').lower() != 'false'
+    return profile_call(lambda report, raw_stats: _store_reports(handler_name, context, report, raw_stats),
+                        handler, event, context, trace_allocations=trace_allocations)
+
+
+def _build_report(profiler, duration, snapshot, peak_memory):
+    report = io.StringIO()
+    report.write(f'Duration: {duration:.3f}s\n')
+    if peak_memory is not None:
+        report.write(f'Peak traced memory: {peak_memory / 2 ** 20:.1f} MB\n')
+
+    report.write(f'\nTop {PROFILE_TOP_FUNCTIONS} functions by cumulative time\n')
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    report.write(f'\nTop {PROFILE_TOP_FUNCTIONS} functions by own time\n')
+    pstats.Stats(profiler, stream=report).sort_stats('tottime').print_stats(PROFILE_TOP_FUNCTIONS)
+
+    if snapshot:
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        report.write(f'\nTop {PROFILE_TOP_ALLOCATIONS} allocations still held at the end of the call\n')
+        for statistic in snapshot.statistics('traceback')[:PROFILE_TOP_ALLOCATIONS]:
+            report.write(f'{statistic.size / 1024:.1f} KiB in {statistic.count} blocks\n')
+            report.writelines(f'    {line}\n' for line in statistic.traceback.format())
+    return report.getvalue()
+
+
+def _raw_stats(profiler):
+    with tempfile.NamedTemporaryFile(suffix='.prof') as stats_file:
+        profiler.dump_stats(stats_file.name)
+        return stats_file.read()
+
+
+# Reports are stored after the handler has finished so the profiler doesn't count them
+def _store_reports(handler_name, context, report, raw_stats):
+    request_id = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S')
+    report_key = f'{PROFILE_REPORTS_FOLDER}/{handler_name}/{timestamp}-{request_id}'
+    store_file_stream(f'{report_key}.txt', report)
+    store_file_stream(f'{report_key}.prof', raw_stats)
+    log.info(f'Stored profile of {handler_name} in {report_key}.txt')
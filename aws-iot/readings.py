@@ -0,0 +1,56 @@
+# Helpers for the data points (readings) sent by devices. A device either sends a single reading, e.g.
+# {"t": 1712345678000, "tmp": 21.5, "hum": 40.2, "pr": 1013.2}, or a batch of readings in the form
+# {"device": "RPi3BHome", "entries": [<reading>, ...]}. Either can also be sent in the compact binary wire format,
+# see wire_format.py.
+#
+# Devices may also reduce their readings before sending them (see iot-device/reduction.py):
+# - Deadband readings only contain the metrics that changed, e.g. {"t": ..., "hum": 40.9}, with a full reading sent
+#   at least every heartbeat. Missing metrics carry the last value that was sent.
+# - Summary readings hold the mean of each metric over a window of w millis centered on t, the number of readings n
+#   and each metric's min and max, e.g. {"t": ..., "w": 60000, "n": 60, "tmp": 21.5, "tmp_min": 21.4, ...}
+
+import os
+
+from wire_format import is_binary_payload, decode_binary_payload
+
+METRIC_KEYS = ('tmp', 'hum', 'pr')
+# Readings sent without a device (i.e. single readings) are attributed to this device
+DEFAULT_DEVICE_ID = os.getenv('DEFAULT_DEVICE_ID', 'RPi3BHome')
+
+
+# Unpacks a payload received from a device into a list of individual readings. Readings in a batch are tagged with
+# the batch's device so that they can still be told apart once stored.
+def unpack_data_points(payload):
+    if not isinstance(payload, dict):
+        return []
+    if is_binary_payload(payload):
+        payload = decode_binary_payload(payload)
+    if 'entries' not in payload:
+        return [payload] if payload else []
+
+    device = payload.get('device')
+    entries = payload['entries'] or []
+    if not device:
+        return list(entries)
+    return [entry if 'device' in entry else dict(entry, device=device) for entry in entries]
+
+
+def device_of(reading):
+    return reading.get('device') or DEFAULT_DEVICE_ID
+
+
+# Returns the readings with any metrics missing from deadband readings filled in with the last value seen for that
+# metric from the same device. Readings before the first value of a metric has been seen are left as is. Expects
+# readings in time order.
+def fill_forward(readings):
+    last_values_by_device = {}
+    filled = []
+    for reading in readings:
+        last_values = last_values_by_device.setdefault(reading.get('device'), {})
+        missing_keys = [key for key in METRIC_KEYS if key not in reading]
+        if missing_keys:
+            reading = dict(reading)
+            reading.update({key: last_values[key] for key in missing_keys if key in last_values})
+        last_values.update({key: reading[key] for key in METRIC_KEYS if key in reading})
+        filled.append(reading)
+    return filled
@@ -0,0 +1,59 @@
+import datetime
+import json
+import logging
+import os
+import re
+import time
+
+from data_store import delete_file, list_files, load_file_as_json, store_file
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+RUN_MANIFESTS_FOLDER = os.getenv('RUN_MANIFESTS_FOLDER', 'manifests')
+# Resource types of a manifest, in the order they are deleted
+RESOURCE_TYPES = ('endpoints', 'endpointConfigs', 'models')
+
+
+# The resources created by a run of the prediction state machine are recorded in a manifest so that they are cleaned
+# up by name rather than by guessing them from the date cleanup runs on, e.g.
+#   {"run": "2024-05-05", "created": 1714874400, "endpoints": [...], "endpointConfigs": [...], "models": [...],
+#    "files": ["models/2024-05-05-temperature-model.tar.gz", ...]}
+# A run is identified by the day its data was aggregated on (see get_run_id), which every state of the state machine
+# knows about and which doesn't change if a later state runs after midnight or is retried the next day.
+def create_run_manifest(run_id):
+    manifest = {'run': run_id, 'created': int(time.time()), 'files': []}
+    manifest.update({resource_type: [] for resource_type in RESOURCE_TYPES})
+    return manifest
+
+
+# Errors are raised, resources must not be created unless the manifest that records them was stored
+def store_run_manifest(manifest):
+    store_file(get_run_manifest_file_key(manifest['run']), json.dumps(manifest).encode('utf-8'))
+
+
+# Loads every manifest that hasn't been cleaned up yet, oldest first
+def load_run_manifests():
+    manifests = [load_file_as_json(file_key) for file_key in sorted(list_files(f'{RUN_MANIFESTS_FOLDER}/', '/'))]
+    return [manifest for manifest in manifests if manifest]
+
+
+def delete_run_manifest(run_id):
+    delete_file(get_run_manifest_file_key(run_id))
+
+
+def get_run_manifest_file_key(run_id):
+    return f'{RUN_MANIFESTS_FOLDER}/{run_id}.json'
+
+
+# Returns the id of the run the state machine event belongs to, the date in its aggregate data file key (see
+# prepare.get_aggregate_dataset_file_key), falling back on today for events without one
+def get_run_id(event):
+    return get_aggregate_run_id((event or {}).get('aggregateFileKey') or '') or \
+        datetime.datetime.now().strftime('%Y-%m-%d')
+
+
+# Returns the id of the run that wrote the aggregate data file, None if the key isn't that of an aggregate data file
+def get_aggregate_run_id(file_key):
+    match = re.search(r'(\d{4}-\d{2}-\d{2})-aggregate-data\.csv$', file_key)
+    return match.group(1) if match else None
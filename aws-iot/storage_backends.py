@@ -0,0 +1,202 @@
+import mmap
+import os
+import tempfile
+import threading
+from botocore.exceptions import ClientError
+
+from aws_clients import get_client
+
+# Storage backends used by data_store. Each backend stores files as bytes under string keys and implements:
+# - load(file_key): the content of the file, None if it does not exist. Any other error is raised.
+# - load_range(file_key, offset, length): length bytes of the file starting at offset, None if it does not exist
+# - store(file_key, content): creates or replaces the file, content is bytes, a string or a file like object
+# - delete(file_keys): deletes the files, returning the keys of those that could not be deleted
+# - list(prefix, delimiter): the keys starting with the prefix, without those "below" the delimiter
+# - location(): a description of where files are stored, for log messages
+#
+# S3Backend is used in AWS. LocalFileBackend and MemoryBackend let the pipeline run at disk (or memory) speed locally,
+# e.g. for profiling or replaying large amounts of data, without going through an emulated S3.
+
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32'))
+
+
+class S3Backend:
+
+    # The bucket is read from the environment when it is used rather than when the backend is created so that it can
+    # be changed without reloading modules (e.g. in tests)
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+
+    def load(self, file_key):
+        try:
+            return self._s3().get_object(Bucket=self._bucket(), Key=file_key)['Body'].read()
+        except ClientError as e:
+            if _is_not_found(e):
+                return None
+            raise
+
+    def load_range(self, file_key, offset, length):
+        try:
+            return self._s3().get_object(Bucket=self._bucket(), Key=file_key,
+                                         Range=f'bytes={offset}-{offset + length - 1}')['Body'].read()
+        except ClientError as e:
+            if _is_not_found(e):
+                return None
+            raise
+
+    def store(self, file_key, content):
+        self._s3().put_object(Bucket=self._bucket(), Key=file_key, Body=content)
+
+    def delete(self, file_keys):
+        failed_keys = []
+        for i in range(0, len(file_keys), 1000):
+            batch = file_keys[i:i + 1000]
+            response = self._s3().delete_objects(Bucket=self._bucket(),
+                                                 Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            failed_keys.extend(error['Key'] for error in response.get('Errors', []))
+        return failed_keys
+
+    def list(self, prefix='', delimiter=None):
+        list_params = {'Bucket': self._bucket(), 'Prefix': prefix}
+        if delimiter:
+            list_params['Delimiter'] = delimiter
+
+        file_keys = []
+        for page in self._s3().get_paginator('list_objects_v2').paginate(**list_params):
+            file_keys.extend(file_obj['Key'] for file_obj in page.get('Contents', []))
+        return file_keys
+
+    def location(self):
+        return f's3://{self._bucket()}'
+
+    def _bucket(self):
+        return self.bucket or os.getenv('S3_BUCKET')
+
+    # A single client per container with a connection pool large enough for concurrent callers
+    @staticmethod
+    def _s3():
+        return get_client('s3', max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+
+
+# Stores each file under the root directory, keys with "/" map to sub directories. Files are read through mmap so
+# ranged reads only touch the pages they need, and written to a temporary file that replaces the old one so readers
+# never see a partially written file.
+class LocalFileBackend:
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def load(self, file_key):
+        return self._read(file_key, 0, None)
+
+    def load_range(self, file_key, offset, length):
+        return self._read(file_key, offset, length)
+
+    def store(self, file_key, content):
+        path = self._path(file_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                temp_file.write(_to_bytes(content))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def delete(self, file_keys):
+        failed_keys = []
+        for file_key in file_keys:
+            try:
+                os.remove(self._path(file_key))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                failed_keys.append(file_key)
+        return failed_keys
+
+    def list(self, prefix='', delimiter=None):
+        file_keys = []
+        for directory, sub_directories, file_names in os.walk(self.root):
+            relative_directory = os.path.relpath(directory, self.root)
+            key_prefix = '' if relative_directory == '.' else relative_directory.replace(os.sep, '/') + '/'
+            file_keys.extend(key_prefix + file_name for file_name in file_names if not file_name.startswith('.tmp-'))
+        return _filter_keys(file_keys, prefix, delimiter)
+
+    def location(self):
+        return self.root
+
+    def _read(self, file_key, offset, length):
+        try:
+            with open(self._path(file_key), 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                if size == 0:
+                    return b''
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                    return mapped_file[offset:size if length is None else offset + length]
+        except FileNotFoundError:
+            return None
+
+    def _path(self, file_key):
+        path = os.path.abspath(os.path.join(self.root, *file_key.split('/')))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f'Invalid file key {file_key}')
+        return path
+
+
+# Keeps files in a dictionary for the lifetime of the process
+class MemoryBackend:
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def load(self, file_key):
+        return self.files.get(file_key)
+
+    def load_range(self, file_key, offset, length):
+        content = self.files.get(file_key)
+        return None if content is None else content[offset:offset + length]
+
+    def store(self, file_key, content):
+        content = _to_bytes(content)
+        with self.lock:
+            self.files[file_key] = content
+
+    def delete(self, file_keys):
+        with self.lock:
+            for file_key in file_keys:
+                self.files.pop(file_key, None)
+        return []
+
+    def list(self, prefix='', delimiter=None):
+        return _filter_keys(list(self.files), prefix, delimiter)
+
+    def location(self):
+        return 'memory'
+
+
+# Creates the backend with the given name: "s3" (the default), "local" (under the STORAGE_ROOT directory) or "memory"
+def create_backend(name):
+    if name == 's3':
+        return S3Backend()
+    if name == 'local':
+        return LocalFileBackend(os.getenv('STORAGE_ROOT', 'data'))
+    if name == 'memory':
+        return MemoryBackend()
+    raise ValueError(f'Unknown storage backend {name}')
+
+
+def _filter_keys(file_keys, prefix, delimiter):
+    return sorted(key for key in file_keys
+                  if key.startswith(prefix) and not (delimiter and delimiter in key[len(prefix):]))
+
+
+def _to_bytes(content):
+    if hasattr(content, 'read'):
+        content = content.read()
+    return content.encode('utf-8') if isinstance(content, str) else bytes(content)
+
+
+def _is_not_found(error):
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey')
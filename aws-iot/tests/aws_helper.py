@@ -1,5 +1,7 @@
 import importlib
 
+from storage_backends import MemoryBackend
+
 S3_BUCKET = 'test-bucket'
 AWS_REGION = 'us-west-1'
 
@@ -26,3 +28,20 @@ def _setup_environment(monkeypatch, vars_to_set):
 
     import data_store
     importlib.reload(data_store)
+
+    # Shared clients created under a previous mock or environment are dropped
+    import aws_clients
+    aws_clients.reset_clients()
+
+
+# Memory backend whose loads of the failing keys raise, e.g. to simulate transient S3 errors
+class FlakyBackend(MemoryBackend):
+
+    def __init__(self):
+        super().__init__()
+        self.failing_keys = set()
+
+    def load(self, file_key):
+        if file_key in self.failing_keys:
+            raise Exception(f'Unable to load {file_key}')
+        return super().load(file_key)
@@ -1,10 +1,14 @@
 import boto3
-from api import fetch_device, fetch_devices, fetch_metrics, fetch_predictions
+from api import fetch_device, fetch_devices, fetch_metrics, fetch_predictions, fetch_current_conditions, \
+    data_appender, fetch_stats, fetch_anomalies, fetch_forecast_accuracy
 from moto import mock_aws
 import json
-from data_store import append_data_as_json
+from data_store import append_data_as_json, store_json_file
 from datetime import datetime
 import aws_helper
+import device_registry
+import forecast_accuracy
+import metrics_index
 
 S3_BUCKET = 'test-bucket'
 AWS_REGION = 'us-west-1'
@@ -34,6 +38,7 @@ def test_fetch_device():
 
 @mock_aws
 def test_fetch_devices():
+    device_registry.clear_cache()
     response = fetch_devices({}, None)
     assert response['statusCode'] == 200
     assert json.loads(response['body']) == {"devices": []}
@@ -44,12 +49,111 @@ def test_fetch_devices():
     iot.create_thing_type(thingTypeName=thing_type_name)
     iot.create_thing(thingName=device_name, thingTypeName=thing_type_name)
 
+    # Devices are cached so the new device only shows up once the cache expires
+    response = fetch_devices({}, None)
+    assert json.loads(response['body']) == {"devices": []}
+    device_registry.clear_cache()
+
     response = fetch_devices({}, None)
     assert response['statusCode'] == 200
     assert json.loads(response['body']) == {"devices": [{"name": "TestThing", "version": 1, "type": "TestDevice"}]}
     _assert_cors(response)
 
 
+@mock_aws
+def test_fetch_devices_filtering_and_paging(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    device_registry.clear_cache()
+    iot = boto3.client('iot')
+    iot.create_thing_type(thingTypeName='TestDevice')
+    iot.create_thing_type(thingTypeName='OtherDevice')
+    for i in range(5):
+        iot.create_thing(thingName=f'TestThing{i}', thingTypeName='TestDevice')
+    iot.create_thing(thingName='OtherThing', thingTypeName='OtherDevice')
+
+    response = fetch_devices({'queryStringParameters': {'type': 'TestDevice', 'limit': '2'}}, None)
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert [device['name'] for device in body['devices']] == ['TestThing0', 'TestThing1']
+
+    response = fetch_devices({'queryStringParameters': {'type': 'TestDevice', 'limit': '2',
+                                                        'nextToken': body['nextToken']}}, None)
+    body = json.loads(response['body'])
+    assert [device['name'] for device in body['devices']] == ['TestThing2', 'TestThing3']
+
+    response = fetch_devices({'queryStringParameters': {'type': 'TestDevice', 'limit': '2',
+                                                        'nextToken': body['nextToken']}}, None)
+    assert json.loads(response['body']) == {'devices': [{'name': 'TestThing4', 'version': 1, 'type': 'TestDevice'}]}
+
+    response = fetch_devices({'queryStringParameters': {'prefix': 'Other'}}, None)
+    assert json.loads(response['body']) == {'devices': [{'name': 'OtherThing', 'version': 1, 'type': 'OtherDevice'}]}
+
+    response = fetch_devices({'queryStringParameters': {'limit': '0'}}, None)
+    assert response['statusCode'] == 400
+    assert json.loads(response['body']) == {'message': 'Invalid limit parameter'}
+
+    # A new container is served from the S3 snapshot rather than listing things again
+    device_registry.clear_cache()
+    iot.delete_thing(thingName='OtherThing')
+    response = fetch_devices({'queryStringParameters': {'prefix': 'Other'}}, None)
+    assert len(json.loads(response['body'])['devices']) == 1
+
+
+@mock_aws
+def test_fetch_current_conditions(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    response = fetch_current_conditions({'pathParameters': None}, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {'devices': {}}
+    _assert_cors(response)
+
+    response = fetch_current_conditions({'pathParameters': {'deviceId': 'TestThing'}}, None)
+    assert response['statusCode'] == 404
+
+    batch = {'device': 'TestThing', 'entries': [{'t': 2000, 'tmp': 24.5, 'hum': 50.0, 'pr': 1013.2},
+                                                {'t': 3000, 'hum': 52.0}]}
+    data_appender({'Records': [{'body': json.dumps(batch)}, {'body': json.dumps({'t': 1000, 'tmp': 20.0})}]}, None)
+    # Older readings (e.g. from a drained backlog) don't replace the latest one
+    data_appender({'Records': [{'body': json.dumps(dict(batch, entries=[{'t': 2500, 'tmp': 10.0}]))}]}, None)
+
+    latest_reading = {'t': 3000, 'tmp': 24.5, 'hum': 52.0, 'pr': 1013.2, 'device': 'TestThing'}
+    response = fetch_current_conditions({'pathParameters': {'deviceId': 'TestThing'}}, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {'device': 'TestThing', 'reading': latest_reading}
+    _assert_cors(response)
+
+    response = fetch_current_conditions({'pathParameters': {}}, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {'devices': {
+        'TestThing': latest_reading,
+        'RPi3BHome': {'t': 1000, 'tmp': 20.0}
+    }}
+
+
+def test_latest_readings_kept_when_fleet_summary_fails_to_load(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import data_store
+    backend = aws_helper.FlakyBackend()
+    data_store.set_backend(backend)
+    try:
+        data_appender({'Records': [{'body': json.dumps({'device': 'A', 'entries': [{'t': 1000, 'tmp': 20.0}]})}]},
+                      None)
+        backend.failing_keys.add('latest/fleet.json')
+        data_appender({'Records': [{'body': json.dumps({'device': 'B', 'entries': [{'t': 2000, 'tmp': 21.0}]})}]},
+                      None)
+
+        backend.failing_keys.clear()
+        response = fetch_current_conditions({'pathParameters': {}}, None)
+        assert list(json.loads(response['body'])['devices']) == ['A']
+    finally:
+        data_store.set_backend(None)
+
+
 @mock_aws
 def test_fetch_metrics(monkeypatch):
     aws_helper.setup_aws(monkeypatch)
@@ -78,6 +182,80 @@ def test_fetch_metrics(monkeypatch):
     _assert_cors(response)
 
 
+@mock_aws
+def test_fetch_metrics_reduced_readings(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    date_today = datetime.now().strftime("%Y-%m-%d")
+    summary = {'t': 30000, 'w': 60000, 'n': 60, 'tmp': 24.5, 'tmp_min': 24.1, 'tmp_max': 24.9, 'hum': 50.0,
+               'hum_min': 50.0, 'hum_max': 50.0, 'pr': 1013.2, 'pr_min': 1013.1, 'pr_max': 1013.3}
+    append_data_as_json([summary, {'t': 90000, 'w': 60000, 'n': 60, 'hum': 52.0, 'hum_min': 51.0, 'hum_max': 53.0},
+                         {'t': 95000, 'tmp': 30.0, 'device': 'OtherThing'}], date_today)
+
+    response = fetch_metrics({'queryStringParameters': {'date': date_today}}, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {"entries": [
+        summary,
+        {'t': 90000, 'w': 60000, 'n': 60, 'tmp': 24.5, 'hum': 52.0, 'hum_min': 51.0, 'hum_max': 53.0, 'pr': 1013.2},
+        {'t': 95000, 'tmp': 30.0, 'device': 'OtherThing'}
+    ]}
+
+    # Projected summary readings keep their window and count
+    response = fetch_metrics({'queryStringParameters': {'date': date_today, 'fields': 'hum'}}, None)
+    assert json.loads(response['body'])['entries'][:2] == [
+        {'t': 30000, 'w': 60000, 'n': 60, 'hum': 50.0, 'hum_min': 50.0, 'hum_max': 50.0},
+        {'t': 90000, 'w': 60000, 'n': 60, 'hum': 52.0, 'hum_min': 51.0, 'hum_max': 53.0}
+    ]
+
+
+@mock_aws
+def test_fetch_metrics_projection_and_paging(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    date_today = datetime.now().strftime("%Y-%m-%d")
+    entries = [{'t': t, 'tmp': 20.0 + i, 'hum': 50.0, 'pr': 1013.0, 'device': device}
+               for i, (t, device) in enumerate([(1000, 'A'), (2000, 'A'), (2000, 'B'), (2000, 'C'), (3000, 'A')])]
+    # Out of order readings (e.g. a drained backlog) are merged in time order
+    append_data_as_json(entries[2:], date_today, sort_key='t')
+    append_data_as_json(entries[:2], date_today, sort_key='t')
+
+    params = {'date': date_today, 'fields': 'tmp', 'limit': '2'}
+    response = fetch_metrics({'queryStringParameters': params}, None)
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert body == {'entries': [{'t': 1000, 'tmp': 20.0, 'device': 'A'}, {'t': 2000, 'tmp': 22.0, 'device': 'B'}],
+                    'nextCursor': '2000.1'}
+
+    # The following pages are served from the entries loaded for the first page, without loading the day again, so
+    # readings that come in meanwhile don't shift the pages
+    import api
+    loaded_keys = []
+    load_daily_file = api.load_daily_file
+    monkeypatch.setattr(api, 'load_daily_file', lambda file_key: loaded_keys.append(file_key) or
+                        load_daily_file(file_key))
+    append_data_as_json([{'t': 1500, 'tmp': 30.0, 'device': 'D'}], date_today, sort_key='t')
+    response = fetch_metrics({'queryStringParameters': dict(params, cursor=body['nextCursor'])}, None)
+    body = json.loads(response['body'])
+    assert body == {'entries': [{'t': 2000, 'tmp': 23.0, 'device': 'C'}, {'t': 2000, 'tmp': 21.0, 'device': 'A'}],
+                    'nextCursor': '2000.3'}
+
+    response = fetch_metrics({'queryStringParameters': dict(params, cursor=body['nextCursor'])}, None)
+    assert json.loads(response['body']) == {'entries': [{'t': 3000, 'tmp': 24.0, 'device': 'A'}]}
+    assert loaded_keys == []
+
+    response = fetch_metrics({'queryStringParameters': {'date': date_today, 'fields': 'tmp,pr', 'cursor': '2000.3'}},
+                             None)
+    assert json.loads(response['body']) == {'entries': [{'t': 3000, 'tmp': 24.0, 'pr': 1013.0, 'device': 'A'}]}
+
+    for invalid_params in [{'fields': 'tmp,wind'}, {'limit': 'ten'}, {'cursor': 'abc'}]:
+        response = fetch_metrics({'queryStringParameters': dict(invalid_params, date=date_today)}, None)
+        assert response['statusCode'] == 400
+
+
 @mock_aws
 def test_fetch_predictions(monkeypatch):
     aws_helper.setup_aws(monkeypatch)
@@ -105,6 +283,216 @@ def test_fetch_predictions(monkeypatch):
     assert json.loads(response['body']) == {"entries": []}
     _assert_cors(response)
 
+    # Per device predictions of a model bundle, only those of the requested device are returned
+    append_data_as_json([{'t': 1000, 'tmp': 20.0, 'device': 'A'}, {'t': 1000, 'tmp': 25.0, 'device': 'B'},
+                         {'t': 2000, 'tmp': 21.0, 'device': 'A'}, {'t': 2000, 'tmp': 26.0, 'device': 'B'}],
+                        '2023-05-04-predictions')
+    response = fetch_predictions({'queryStringParameters': {'date': '2023-05-04', 'limit': '1'},
+                                  'pathParameters': {'deviceId': 'B'}}, None)
+    page = json.loads(response['body'])
+    assert page['entries'] == [{'t': 1000, 'tmp': 25.0, 'device': 'B'}]
+    response = fetch_predictions({'queryStringParameters': {'date': '2023-05-04', 'cursor': page['nextCursor']},
+                                  'pathParameters': {'deviceId': 'B'}}, None)
+    assert json.loads(response['body']) == {'entries': [{'t': 2000, 'tmp': 26.0, 'device': 'B'}]}
+
+    # Fleet-wide predictions apply to every device
+    response = fetch_predictions({'queryStringParameters': {'date': date_today}, 'pathParameters': {'deviceId': 'B'}},
+                                 None)
+    assert json.loads(response['body']) == {"entries": [{"t": 234234234, "tmp": 24.5}]}
+    response = fetch_predictions({'queryStringParameters': {'date': '2023-05-04'}, 'pathParameters': {'deviceId': 'C'}},
+                                 None)
+    assert json.loads(response['body']) == {'entries': []}
+
+
+@mock_aws
+def test_fetch_stats(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    metrics_index.clear_cache()
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    day_millis = 24 * 60 * 60 * 1000
+    first_day = int(datetime(2023, 5, 1).timestamp() * 1000) // day_millis * day_millis
+    append_data_as_json([{'t': first_day + 1000, 'tmp': 20.0, 'hum': 50.0, 'pr': 1010.0, 'device': 'A'},
+                         {'t': first_day + 2000, 'tmp': 22.0, 'device': 'A'},
+                         {'t': first_day + 2000, 'tmp': 30.0, 'hum': 40.0, 'pr': 1000.0, 'device': 'B'}],
+                        '2023-05-01')
+    append_data_as_json([{'t': first_day + day_millis + 30000, 'w': 60000, 'n': 60, 'tmp': 24.0, 'tmp_min': 18.0,
+                          'tmp_max': 26.0, 'hum': 52.0, 'pr': 1012.0, 'device': 'A'}], '2023-05-02')
+    append_data_as_json([{'t': first_day, 'tmp': 21.0, 'hum': 50.0, 'pr': 1010.0}], '2023-05-01-predictions')
+
+    params = {'start': '2023-05-01', 'end': '2023-05-02', 'percentiles': '50', 'daily': 'true',
+              'compare': 'predictions'}
+    response = fetch_stats({'queryStringParameters': params, 'pathParameters': {'deviceId': 'A'}}, None)
+    assert response['statusCode'] == 200
+    _assert_cors(response)
+    body = json.loads(response['body'])
+    assert body['start'] == '2023-05-01' and body['end'] == '2023-05-02'
+    assert body['count'] == 3
+    # The missing metrics of deadband readings are filled in and summary readings contribute their min and max
+    assert body['metrics']['tmp'] == {'count': 3, 'min': 18.0, 'max': 26.0, 'mean': 22.0, 'std': 1.63, 'p50': 22.0}
+    assert body['metrics']['hum']['mean'] == 50.67
+    assert body['daily']['2023-05-01'] == {'tmp': 21.0, 'hum': 50.0, 'pr': 1010.0}
+    assert body['daily']['2023-05-02'] == {'tmp': 24.0, 'hum': 52.0, 'pr': 1012.0}
+    # The reading of the second day has no prediction near it so it isn't compared
+    assert body['predictionErrors']['tmp'] == {'count': 2, 'mae': 1.0, 'rmse': 1.0, 'bias': 0.0}
+
+    response = fetch_stats({'queryStringParameters': {'start': '2023-05-01', 'fields': 'pr', 'devices': 'B,C'}}, None)
+    assert json.loads(response['body']) == {'start': '2023-05-01', 'end': '2023-05-01', 'count': 1, 'metrics': {
+        'pr': {'count': 1, 'min': 1000.0, 'max': 1000.0, 'mean': 1000.0, 'std': 0.0}
+    }}
+
+    # Devices with predictions of their own are compared with those rather than the fleet wide ones
+    append_data_as_json([{'t': first_day + 2000, 'tmp': 29.0, 'hum': 41.0, 'pr': 1001.0, 'device': 'B'}],
+                        '2023-05-01-predictions')
+    metrics_index.clear_cache()
+    response = fetch_stats({'queryStringParameters': {'start': '2023-05-01', 'fields': 'tmp', 'devices': 'B',
+                                                      'compare': 'predictions'}}, None)
+    assert json.loads(response['body'])['predictionErrors'] == {'tmp': {'count': 1, 'mae': 1.0, 'rmse': 1.0,
+                                                                        'bias': -1.0}}
+
+    for invalid_params in [{'start': 'yesterday'}, {'start': '2023-05-02', 'end': '2023-05-01'},
+                           {'start': '2023-01-01', 'end': '2023-12-31'}, {'percentiles': '101'},
+                           {'fields': 'wind'}]:
+        response = fetch_stats({'queryStringParameters': invalid_params}, None)
+        assert response['statusCode'] == 400
+
+
+@mock_aws
+def test_fetch_anomalies(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    # Steady readings, then a single wild pressure reading and a temperature that keeps climbing
+    readings = [{'t': i * 60000, 'tmp': 21.0 + 0.4 * (i % 2), 'pr': 1010.0 + 0.4 * (i % 2)} for i in range(100)]
+    readings.append({'t': 100 * 60000, 'pr': 1030.0})
+    readings += [{'t': (101 + i) * 60000, 'tmp': round(21.2 + 0.1 * i, 1)} for i in range(20)]
+    for i in range(0, len(readings), 10):
+        batch = {'device': 'TestThing', 'entries': readings[i:i + 10]}
+        data_appender({'Records': [{'messageId': str(i), 'body': json.dumps(batch)}]}, None)
+
+    date_today = datetime.now().strftime('%Y-%m-%d')
+    response = fetch_anomalies({'queryStringParameters': {'date': date_today}}, None)
+    assert response['statusCode'] == 200
+    _assert_cors(response)
+    anomalies = json.loads(response['body'])['entries']
+    assert anomalies[0] == {'v': 1030.0, 'z': 99.0, 'k': 'spike', 't': 100 * 60000, 'device': 'TestThing', 'm': 'pr'}
+    assert all(anomaly['m'] == 'tmp' and anomaly['v'] > 22 for anomaly in anomalies[1:])
+
+    response = fetch_anomalies({'queryStringParameters': {'kind': 'shift'},
+                                'pathParameters': {'deviceId': 'TestThing'}}, None)
+    shifts = json.loads(response['body'])['entries']
+    assert len(shifts) == 1 and shifts[0]['m'] == 'tmp'
+
+    response = fetch_anomalies({'queryStringParameters': {'fields': 'hum'}, 'pathParameters': {'deviceId': 'Other'}},
+                               None)
+    assert json.loads(response['body']) == {'entries': []}
+
+    for invalid_params in [{'date': 'today'}, {'kind': 'drift'}, {'fields': 'wind'}]:
+        response = fetch_anomalies({'queryStringParameters': invalid_params}, None)
+        assert response['statusCode'] == 400
+
+
+@mock_aws
+def test_anomaly_state_kept_when_it_fails_to_load(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import data_store
+    backend = aws_helper.FlakyBackend()
+    data_store.set_backend(backend)
+
+    def append(device, readings):
+        data_appender({'Records': [{'body': json.dumps({'device': device, 'entries': readings})}]}, None)
+
+    try:
+        append('A', [{'t': i * 60000, 'pr': 1010.0 + 0.4 * (i % 2)} for i in range(40)])
+        backend.failing_keys.add('anomalies/state/A.json')
+        append('A', [{'t': 40 * 60000, 'pr': 1030.0}])
+        # The state of each device is kept apart, so the other devices are unaffected
+        append('B', [{'t': i * 60000, 'pr': 1010.0} for i in range(40)] + [{'t': 40 * 60000, 'pr': 1030.0}])
+
+        # A's state wasn't reset, so its next wild reading is still flagged
+        backend.failing_keys.clear()
+        append('A', [{'t': 41 * 60000, 'pr': 1030.0}])
+        date_today = datetime.now().strftime('%Y-%m-%d')
+        response = fetch_anomalies({'queryStringParameters': {'date': date_today, 'kind': 'spike'}}, None)
+        assert [(anomaly['device'], anomaly['t']) for anomaly in json.loads(response['body'])['entries']] == \
+            [('B', 40 * 60000), ('A', 41 * 60000)]
+    finally:
+        data_store.set_backend(None)
+
+
+@mock_aws
+def test_fetch_forecast_accuracy(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    forecast_accuracy.clear_cache()
+
+    response = fetch_forecast_accuracy({}, None)
+    assert json.loads(response['body']) == {'versions': {}}
+
+    # TestThing has predictions of its own, other devices are scored against the fleet wide ones
+    first_day = int(datetime(2023, 5, 1).timestamp() // 86400 * 86400 * 1000)
+    store_json_file('2023-05-01-predictions', {'h': 2, 'v': '2023-04-29-forecast-models', 'r': 600, 'entries': [
+        {'t': first_day, 'tmp': 20.0, 'hum': 50.0},
+        {'t': first_day, 'tmp': 21.0, 'hum': 40.0, 'device': 'TestThing'},
+        {'t': first_day + 600000, 'tmp': 22.0, 'hum': 40.0, 'device': 'TestThing'}
+    ]})
+    # Readings are matched with the closest prediction, redelivered ones aren't scored
+    batches = [{'device': 'TestThing', 'entries': [{'t': first_day + 60000, 'tmp': 20.0, 'hum': 43.0},
+                                                   {'t': first_day + 540000, 'tmp': 23.0}]},
+               {'device': 'OtherThing', 'entries': [{'t': first_day + 120000, 'tmp': 21.0}]},
+               {'device': 'OtherThing', 'entries': [{'t': first_day + 120000, 'tmp': 21.0}]}]
+    for i, batch in enumerate(batches):
+        data_appender({'Records': [{'messageId': str(i), 'body': json.dumps(batch)}]}, None)
+
+    response = fetch_forecast_accuracy({}, None)
+    assert response['statusCode'] == 200
+    _assert_cors(response)
+    assert json.loads(response['body']) == {'versions': {'2023-04-29-forecast-models': {'2': {
+        'tmp': {'count': 3, 'mae': 1.0, 'rmse': 1.0, 'bias': -0.333},
+        'hum': {'count': 1, 'mae': 3.0, 'rmse': 3.0, 'bias': -3.0}
+    }}}}
+
+    response = fetch_forecast_accuracy({'pathParameters': {'deviceId': 'TestThing'}}, None)
+    assert json.loads(response['body']) == {'versions': {'2023-04-29-forecast-models': {'2': {
+        'tmp': {'count': 2, 'mae': 1.0, 'rmse': 1.0, 'bias': 0.0},
+        'hum': {'count': 1, 'mae': 3.0, 'rmse': 3.0, 'bias': -3.0}
+    }}}}
+    response = fetch_forecast_accuracy({'queryStringParameters': {'versions': 'other', 'fields': 'tmp'}}, None)
+    assert json.loads(response['body']) == {'versions': {}}
+    response = fetch_forecast_accuracy({'queryStringParameters': {'fields': 'wind'}}, None)
+    assert response['statusCode'] == 400
+
+
+@mock_aws
+def test_forecast_accuracy_kept_when_it_fails_to_load(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import data_store
+    backend = aws_helper.FlakyBackend()
+    data_store.set_backend(backend)
+    forecast_accuracy.clear_cache()
+
+    def append(readings):
+        data_appender({'Records': [{'body': json.dumps({'device': 'A', 'entries': readings})}]}, None)
+
+    try:
+        first_day = int(datetime(2023, 5, 1).timestamp() // 86400 * 86400 * 1000)
+        store_json_file('2023-05-01-predictions', {'h': 0, 'v': 'models', 'r': 600, 'entries': [
+            {'t': first_day + i * 600000, 'tmp': 20.0} for i in range(3)]})
+        append([{'t': first_day, 'tmp': 21.0}])
+        backend.failing_keys.add('accuracy/A.json')
+        append([{'t': first_day + 600000, 'tmp': 21.0}])
+        backend.failing_keys.clear()
+        append([{'t': first_day + 1200000, 'tmp': 21.0}])
+
+        # The readings scored before the failed load are still counted
+        response = fetch_forecast_accuracy({}, None)
+        assert json.loads(response['body'])['versions']['models']['0']['tmp']['count'] == 2
+    finally:
+        data_store.set_backend(None)
+
 
 def _assert_cors(response):
     assert 'Access-Control-Allow-Origin' in response['headers']
@@ -0,0 +1,128 @@
+import boto3
+import json
+from datetime import datetime, timezone, date
+from moto import mock_aws
+
+import archive
+import aws_helper
+from api import fetch_metrics
+from aws_helper import S3_BUCKET, AWS_REGION
+from data_store import append_data_as_json, store_file_stream
+
+HOUR_MILLIS = 60 * 60 * 1000
+MAY_1 = int(datetime(2023, 5, 1, tzinfo=timezone.utc).timestamp() * 1000)
+MAY_2 = MAY_1 + 24 * HOUR_MILLIS
+
+
+@mock_aws
+def test_compact_daily_files(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    may_1_entries = [{'t': MAY_1 + i * HOUR_MILLIS // 2, 'tmp': 20.0 + i, 'device': device}
+                     for i in range(48) for device in ('A', 'B')]
+    may_2_entries = [{'t': MAY_2 + 1000, 'tmp': 30.0}]
+    predictions = [{'t': MAY_1 + i * HOUR_MILLIS, 'tmp': 21.0, 'hum': 50.0, 'pr': 1010.0} for i in range(24)]
+    append_data_as_json(may_1_entries, '2023-05-01')
+    append_data_as_json(may_2_entries, '2023-05-02')
+    append_data_as_json(predictions, '2023-05-01-predictions')
+    store_file_stream('2023-05-01-keys', b'\x00' * 8)
+    current_day = datetime.now().strftime('%Y-%m-%d')
+    append_data_as_json([{'t': 1000, 'tmp': 25.0}], current_day)
+
+    assert archive.compact_daily_files({}, None) == ['2023-05']
+    remaining_keys = [file_obj['Key'] for file_obj in s3.list_objects_v2(Bucket=S3_BUCKET)['Contents']]
+    assert current_day in remaining_keys
+    assert not [key for key in remaining_keys if key.startswith('2023-05')]
+
+    index = archive.load_archive_index('2023-05')
+    assert sorted(index['series']) == ['predictions', 'readings/A', 'readings/B', 'readings/RPi3BHome']
+    assert len(index['series']['readings/A']['hours']) == 24
+
+    assert archive.load_daily_file('2023-05-01') == {'entries': may_1_entries}
+    assert archive.load_daily_file('2023-05-02') == {'entries': may_2_entries}
+    assert archive.load_daily_file('2023-05-01-predictions') == {'entries': predictions}
+    assert archive.load_daily_file('2023-05-03') is None
+    assert archive.load_archived_entries(date(2023, 4, 1), date(2023, 5, 31)) == may_1_entries + may_2_entries
+
+    response = fetch_metrics({'queryStringParameters': {'date': '2023-05-02'}}, None)
+    assert json.loads(response['body']) == {'entries': may_2_entries}
+
+    # A late reading is merged into the existing archive and the replaced archive objects are deleted
+    late_entry = {'t': MAY_2 + 2000, 'tmp': 31.0}
+    append_data_as_json([late_entry], '2023-05-31')
+    assert archive.compact_daily_files({}, None) == ['2023-05']
+    assert archive.load_archived_entries(date(2023, 5, 2), date(2023, 5, 2)) == may_2_entries + [late_entry]
+    archive_keys = [file_obj['Key'] for file_obj in
+                    s3.list_objects_v2(Bucket=S3_BUCKET, Prefix='archive/2023-05/')['Contents']]
+    assert [key for key in archive_keys if '/days/' in key] == \
+        ['archive/2023-05/days/2023-05-01.json', 'archive/2023-05/days/2023-05-02.json']
+    assert len(archive_keys) == 7
+
+
+@mock_aws
+def test_compact_predictions_of_several_devices(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    # The predictions of a model bundle have an entry per device at each time
+    predictions = [{'t': MAY_1 + i * HOUR_MILLIS, 'tmp': 21.0 + i, 'device': device}
+                   for i in range(24) for device in ('A', 'B')]
+    append_data_as_json(predictions, '2023-05-01-predictions')
+    assert archive.compact_daily_files({}, None) == ['2023-05']
+    assert archive.load_daily_file('2023-05-01-predictions') == {'entries': predictions}
+
+    # Predictions archived again are stored once
+    append_data_as_json(predictions[:4], '2023-05-01-predictions')
+    assert archive.compact_daily_files({}, None) == ['2023-05']
+    assert archive.load_daily_file('2023-05-01-predictions') == {'entries': predictions}
+
+
+@mock_aws
+def test_load_archived_entries_of_the_following_month(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    # A reading taken just before midnight at the end of the month arrives in the next month's daily file
+    june_1 = int(datetime(2023, 6, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    may_31_entries = [{'t': june_1 - HOUR_MILLIS, 'tmp': 20.0}, {'t': june_1 - 1000, 'tmp': 21.0}]
+    june_1_entries = [{'t': june_1 + 1000, 'tmp': 22.0}]
+    append_data_as_json(may_31_entries[:1], '2023-05-31')
+    append_data_as_json(may_31_entries[1:] + june_1_entries, '2023-06-01')
+    assert archive.compact_daily_files({}, None) == ['2023-05', '2023-06']
+
+    assert archive.load_daily_file('2023-05-31') == {'entries': may_31_entries}
+    assert archive.load_daily_file('2023-06-01') == {'entries': june_1_entries}
+    assert archive.load_archived_entries(date(2023, 5, 1), date(2023, 5, 31)) == may_31_entries
+    assert archive.load_archived_entries(date(2023, 5, 31), date(2023, 6, 1)) == may_31_entries + june_1_entries
+
+
+@mock_aws
+def test_load_archived_entries_reads_only_requested_hours(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    entries = [{'t': MAY_1 + i * 60000, 'tmp': 20.0 + i % 7, 'hum': 50.0, 'pr': 1010.0} for i in range(31 * 24 * 60)]
+    append_data_as_json(entries, '2023-05-01')
+    archive.compact_daily_files({}, None)
+    archive_size = s3.head_object(Bucket=S3_BUCKET, Key=archive.load_archive_index('2023-05')['series']
+                                  ['readings/RPi3BHome']['key'])['ContentLength']
+
+    range_lengths = []
+    load_file_range = archive.load_file_range
+    monkeypatch.setattr(archive, 'load_file_range', lambda file_key, offset, length:
+                        range_lengths.append(length) or load_file_range(file_key, offset, length))
+    loaded_keys = []
+    load_file_as_json = archive.load_file_as_json
+    monkeypatch.setattr(archive, 'load_file_as_json', lambda file_key, raise_errors=False:
+                        loaded_keys.append(file_key) or load_file_as_json(file_key, raise_errors))
+
+    assert archive.load_daily_file('2023-05-10') == {'entries': entries[9 * 24 * 60:10 * 24 * 60]}
+    # Only the day's indexes are loaded, not the month's
+    assert loaded_keys == ['2023-05-10', 'archive/2023-05/days/2023-05-10.json', 'archive/2023-06/days/2023-05-10.json']
+    assert len(range_lengths) == 1
+    assert range_lengths[0] < archive_size / 20
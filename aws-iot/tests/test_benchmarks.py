@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+# Runs a tiny pipeline benchmark so that the benchmark keeps working as the handlers change
+def test_pipeline_benchmark(tmp_path):
+    output_path = tmp_path / 'results.json'
+    subprocess.run([sys.executable, 'benchmarks/pipeline.py', '--devices', '2', '--days', '2', '--interval', '600',
+                    '--output', str(output_path)], cwd=SERVICE_DIR, capture_output=True, check=True)
+
+    results = json.loads(output_path.read_text())
+    assert [stage['stage'] for stage in results['stages']] == ['ingest', 'append', 'prepare', 'fit', 'predict']
+    ingest, append, prepare, fit, predict = results['stages']
+    assert ingest['records'] == append['records'] == prepare['records'] == fit['records'] == 2 * 2 * 144
+    # Every device is forecast with the model bundle
+    assert predict['records'] == 2 * 7 * 144 * 3
+    assert predict['storage']['requests']['store'] == 7
+    assert append['storage']['requests']['store'] > 0
+
+
+def test_pipeline_benchmark_with_endpoints(tmp_path):
+    output_path = tmp_path / 'results.json'
+    subprocess.run([sys.executable, 'benchmarks/pipeline.py', '--devices', '2', '--days', '1', '--interval', '600',
+                    '--models', 'endpoints', '--output', str(output_path)], cwd=SERVICE_DIR, capture_output=True,
+                   check=True)
+
+    predict = json.loads(output_path.read_text())['stages'][-1]
+    assert predict['records'] == 7 * 144 * 3
+
+
+def test_fleet_load_benchmark(tmp_path):
+    output_path = tmp_path / 'results.json'
+    subprocess.run([sys.executable, 'benchmarks/fleet_load.py', '--devices', '5', '--duration', '1800',
+                    '--batch-size', '2', '--wire-format', 'binary', '--outage-rate', '2', '--probe-devices', '2',
+                    '--output', str(output_path)], cwd=SERVICE_DIR, capture_output=True, check=True)
+
+    results = json.loads(output_path.read_text())
+    assert results['published']['readings'] > 0
+    assert results['ingest']['readings_stored'] == results['published']['readings']
+    assert results['ingest']['readings_per_sec'] > 0
+    assert results['delay_secs']['max'] >= results['delay_secs']['p50'] > 0
+    assert results['storage']['write_amplification'] > 1
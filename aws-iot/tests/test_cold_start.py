@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+# Handler modules must not import the heavy dependencies at module level, see benchmarks/cold_start.py
+def test_handler_modules_import_no_heavy_dependencies():
+    output = subprocess.run([sys.executable, '-c', (
+        "import sys, api, archive, finalize, predict, prepare; "
+        "print(','.join(name for name in ('numpy', 'pandas', 'sklearn') if name in sys.modules))"
+    )], cwd=SERVICE_DIR, env=dict(os.environ, AWS_DEFAULT_REGION='us-west-1'), capture_output=True, text=True,
+        check=True).stdout
+    assert output.strip() == ''
@@ -1,9 +1,13 @@
 from api import event_receiver, data_appender
+import base64
+import struct
 from moto import mock_aws
 import json
 import boto3
 from datetime import datetime
+from types import SimpleNamespace
 import aws_helper
+import data_store
 
 S3_BUCKET = 'test-bucket'
 AWS_REGION = 'us-west-1'
@@ -32,6 +36,68 @@ def test_event_receiver(monkeypatch):
     assert message['Body'] == json.dumps(event)
 
 
+@mock_aws
+def test_event_receiver_batched_events(monkeypatch):
+    sqs = boto3.client('sqs')
+    mock_queue = _create_mock_queue(sqs)
+    aws_helper.setup_aws(monkeypatch, {
+        'QUEUE_URL': mock_queue['QueueUrl']
+    })
+    import api
+    send_message_batch_calls = []
+    send_message_batch = api._sqs().send_message_batch
+    monkeypatch.setattr(api._sqs(), 'send_message_batch',
+                        lambda **kwargs: send_message_batch_calls.append(kwargs) or send_message_batch(**kwargs))
+
+    events = [{"t": i, "tmp": 28, "hum": 54.6, "pr": 1013.25} for i in range(25)]
+    response = event_receiver(events, None)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {"message": "data received"}
+    assert [len(call['Entries']) for call in send_message_batch_calls] == [10, 10, 5]
+    assert sorted(json.loads(body)['t'] for body in _receive_all_message_bodies(sqs, mock_queue)) == list(range(25))
+
+
+@mock_aws
+def test_event_receiver_splits_large_batches(monkeypatch):
+    sqs = boto3.client('sqs')
+    mock_queue = _create_mock_queue(sqs)
+    aws_helper.setup_aws(monkeypatch, {
+        'QUEUE_URL': mock_queue['QueueUrl']
+    })
+
+    batch = {"device": "TestThing", "entries": [{"t": i, "tmp": 28.25, "hum": 54.6, "pr": 1013.25}
+                                                 for i in range(10000)]}
+    assert len(json.dumps(batch)) > 256 * 1024
+    response = event_receiver(batch, None)
+    assert response['statusCode'] == 200
+
+    message_bodies = _receive_all_message_bodies(sqs, mock_queue)
+    assert len(message_bodies) > 1
+    assert all(len(body) <= 256 * 1024 for body in message_bodies)
+    messages = [json.loads(body) for body in message_bodies]
+    assert all(message['device'] == 'TestThing' for message in messages)
+    assert sorted(entry['t'] for message in messages for entry in message['entries']) == list(range(10000))
+
+
+def test_event_receiver_reports_failed_entries(monkeypatch):
+    import api
+    monkeypatch.setattr(api, '_sqs', lambda: SimpleNamespace(send_message_batch=lambda QueueUrl, Entries: {
+        'Successful': [{'Id': entry['Id']} for entry in Entries[1:]],
+        'Failed': [{'Id': Entries[0]['Id'], 'Code': 'InternalError', 'Message': 'try again', 'SenderFault': False}]
+    }))
+
+    response = event_receiver([{"t": 1}, {"t": 2}], None)
+    assert response['statusCode'] == 207
+    assert json.loads(response['body']) == {
+        "message": "Some data could not be queued",
+        "failed": [{"id": "0", "code": "InternalError", "message": "try again"}]
+    }
+
+    response = event_receiver({"t": 1}, None)
+    assert response['statusCode'] == 500
+
+
 @mock_aws
 def test_event_receiver_no_event():
     response = event_receiver(None, None)
@@ -46,6 +112,30 @@ def test_event_receiver_no_event():
         "message": "No event data was found"
     }
 
+    response = event_receiver({"device": "TestThing", "entries": []}, None)
+    assert response['statusCode'] == 400
+    assert json.loads(response['body']) == {
+        "message": "No event data was found"
+    }
+
+    # Malformed binary payloads are dropped rather than failing the invocation
+    for malformed_event in [{'bin': 'AAAA'}, {'bin': 'not base64!'}]:
+        response = event_receiver(malformed_event, None)
+        assert response['statusCode'] == 400
+
+
+@mock_aws
+def test_event_receiver_drops_malformed_events(monkeypatch):
+    sqs = boto3.client('sqs')
+    mock_queue = _create_mock_queue(sqs)
+    aws_helper.setup_aws(monkeypatch, {
+        'QUEUE_URL': mock_queue['QueueUrl']
+    })
+
+    response = event_receiver([{'bin': 'AAAA'}, {"t": 1, "tmp": 28}], None)
+    assert response['statusCode'] == 200
+    assert [json.loads(body) for body in _receive_all_message_bodies(sqs, mock_queue)] == [{"t": 1, "tmp": 28}]
+
 
 @mock_aws
 def test_event_receiver_sqs_send_message_failure():
@@ -97,6 +187,125 @@ def test_data_appender_existing_data_set(monkeypatch):
     assert data == {"entries": all_data_points}
 
 
+@mock_aws
+def test_data_appender_batched_data_points(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    single_data_point = {"t": 12345, "tmp": 28, "hum": 54.6, "pr": 1013.25}
+    batch = {"device": "TestThing", "entries": [
+        {"t": 12346, "tmp": 28.1, "hum": 54.5, "pr": 1013.2},
+        {"t": 12347, "tmp": 28.2, "hum": 54.4, "pr": 1013.1}
+    ]}
+    data_appender({
+        "Records": [{"body": json.dumps(single_data_point)}, {"body": json.dumps(batch)}]
+    }, None)
+
+    date_today = datetime.now().strftime("%Y-%m-%d")
+    data = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=date_today)['Body'].read())
+    assert data == {"entries": [
+        single_data_point,
+        {"t": 12346, "tmp": 28.1, "hum": 54.5, "pr": 1013.2, "device": "TestThing"},
+        {"t": 12347, "tmp": 28.2, "hum": 54.4, "pr": 1013.1, "device": "TestThing"}
+    ]}
+
+
+@mock_aws
+def test_data_appender_binary_data_points(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    # version 1 with a device id, a base time and two readings, the second of which is missing temperature/pressure
+    device_id = b'TestThing'
+    payload = (struct.pack('<BBH', 1, 1, 2) + struct.pack('<B', len(device_id)) + device_id
+               + struct.pack('<q', 1712345678000)
+               + struct.pack('<IhHI', 0, -525, 4020, 101325)
+               + struct.pack('<IhHI', 1000, 0x7FFF, 4100, 0xFFFFFFFF))
+    data_appender({
+        "Records": [{"body": json.dumps({"bin": base64.b64encode(payload).decode('utf-8')})}]
+    }, None)
+
+    date_today = datetime.now().strftime("%Y-%m-%d")
+    data = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=date_today)['Body'].read())
+    assert data == {"entries": [
+        {"t": 1712345678000, "tmp": -5.25, "hum": 40.2, "pr": 1013.25, "device": "TestThing"},
+        {"t": 1712345679000, "hum": 41.0, "device": "TestThing"}
+    ]}
+
+
+@mock_aws
+def test_data_appender_drops_duplicates(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    data_point = {"t": 12345, "tmp": 28, "hum": 54.6, "pr": 1013.25}
+    other_device_data_point = {"t": 12345, "tmp": 20, "hum": 50, "pr": 1010, "device": "OtherThing"}
+    data_appender({"Records": [{"messageId": "1", "body": json.dumps(data_point)},
+                               {"messageId": "2", "body": json.dumps(data_point)}]}, None)
+    response = data_appender({"Records": [{"messageId": "3", "body": json.dumps(data_point)},
+                                          {"messageId": "4", "body": json.dumps(other_device_data_point)}]}, None)
+    assert response == {"batchItemFailures": []}
+
+    date_today = datetime.now().strftime("%Y-%m-%d")
+    data = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=date_today)['Body'].read())
+    assert data == {"entries": [data_point, other_device_data_point]}
+
+    # Readings without a device belong to the default device, as they do everywhere else
+    data_appender({"Records": [{"messageId": "5", "body": json.dumps(dict(data_point, device="RPi3BHome"))}]}, None)
+    data = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=date_today)['Body'].read())
+    assert data == {"entries": [data_point, other_device_data_point]}
+
+
+def test_data_appender_keeps_dedup_index_when_it_fails_to_load(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    backend = aws_helper.FlakyBackend()
+    data_store.set_backend(backend)
+    try:
+        first = {"t": 1, "tmp": 28}
+        second = {"t": 2, "tmp": 29}
+        data_appender({"Records": [{"messageId": "1", "body": json.dumps(first)}]}, None)
+
+        # A failed load of the index fails the batch rather than replacing the index with the batch's keys only
+        date_today = datetime.now().strftime("%Y-%m-%d")
+        backend.failing_keys.add(f'{date_today}-keys')
+        response = data_appender({"Records": [{"messageId": "2", "body": json.dumps(second)}]}, None)
+        assert response == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+
+        backend.failing_keys.clear()
+        data_appender({"Records": [{"messageId": "2", "body": json.dumps(second)},
+                                   {"messageId": "3", "body": json.dumps(first)}]}, None)
+        assert json.loads(backend.load(date_today)) == {"entries": [first, second]}
+    finally:
+        data_store.set_backend(None)
+
+
+@mock_aws
+def test_data_appender_reports_failed_messages(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+
+    data_point = {"t": 12345, "tmp": 28, "hum": 54.6, "pr": 1013.25}
+    response = data_appender({"Records": [{"messageId": "1", "body": "not json"},
+                                          {"messageId": "2", "body": json.dumps(data_point)}]}, None)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "1"}]}
+
+    date_today = datetime.now().strftime("%Y-%m-%d")
+    data = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=date_today)['Body'].read())
+    assert data == {"entries": [data_point]}
+
+    # Storage failing fails every message that had data points so they are retried
+    for file in s3.list_objects_v2(Bucket=S3_BUCKET)['Contents']:
+        s3.delete_object(Bucket=S3_BUCKET, Key=file['Key'])
+    s3.delete_bucket(Bucket=S3_BUCKET)
+    response = data_appender({"Records": [{"messageId": "3", "body": json.dumps(data_point)},
+                                          {"messageId": "4", "body": json.dumps(data_point)}]}, None)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "3"}, {"itemIdentifier": "4"}]}
+
+
 @mock_aws
 def test_data_appender_no_datapoints(monkeypatch):
     aws_helper.setup_aws(monkeypatch)
@@ -115,7 +324,15 @@ def test_data_appender_no_datapoints(monkeypatch):
         assert True, "Data file does not exist"
 
 
+def _receive_all_message_bodies(sqs, queue):
+    message_bodies = []
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue['QueueUrl'], MaxNumberOfMessages=10).get('Messages', [])
+        if not messages:
+            return message_bodies
+        message_bodies.extend(message['Body'] for message in messages)
+
+
 def _create_mock_queue(sqs):
     queue_name = 'my-test-queue'
     return sqs.create_queue(QueueName=queue_name)
-
@@ -0,0 +1,74 @@
+import boto3
+import pytest
+from io import BytesIO
+from moto import mock_aws
+
+import aws_helper
+import data_store
+from aws_helper import S3_BUCKET, AWS_REGION
+from storage_backends import LocalFileBackend, MemoryBackend
+
+
+@pytest.fixture(params=['s3', 'local', 'memory'])
+def backend(request, monkeypatch, tmp_path):
+    if request.param == 's3':
+        with mock_aws():
+            aws_helper.setup_aws(monkeypatch)
+            boto3.client('s3').create_bucket(Bucket=S3_BUCKET,
+                                             CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+            yield request.param
+        return
+
+    aws_helper.setup_aws(monkeypatch, {'STORAGE_BACKEND': request.param, 'STORAGE_ROOT': str(tmp_path)})
+    yield request.param
+
+
+def test_json_files(backend):
+    assert data_store.load_file_as_json('2023-05-01') is None
+
+    data_store.append_data_as_json([{'t': 3000, 'tmp': 21.0}], '2023-05-01', sort_key='t')
+    data_store.append_data_as_json([{'t': 1000, 'tmp': 20.0}, {'t': 2000, 'tmp': 20.5}], '2023-05-01', sort_key='t')
+    assert data_store.load_file_as_json('2023-05-01') == {'entries': [
+        {'t': 1000, 'tmp': 20.0}, {'t': 2000, 'tmp': 20.5}, {'t': 3000, 'tmp': 21.0}
+    ]}
+
+    data_store.store_json_file('2023-05-01-predictions', {'entries': [{'t': 4000, 'tmp': 22.0}]})
+    data_store.store_json_file('2023-05-01-predictions', {'entries': [{'t': 4000, 'tmp': 22.5}]})
+    assert data_store.load_file_as_json('2023-05-01-predictions') == {'entries': [{'t': 4000, 'tmp': 22.5}]}
+
+
+def test_files(backend):
+    data_store.store_file_stream('aggregates/data.csv', 'a,b\n1,2\n')
+    data_store.store_file_stream('models/model.bin', BytesIO(b'\x00\x01\x02\x03'))
+    data_store.store_file('2023-05-01-keys', b'0123456789')
+
+    assert data_store.load_file_as_string('aggregates/data.csv') == 'a,b\n1,2\n'
+    assert data_store.load_file_as_bytes('models/model.bin') == b'\x00\x01\x02\x03'
+    assert data_store.load_file_range('2023-05-01-keys', 2, 5) == b'23456'
+    assert data_store.load_file_as_string('missing') is None
+    assert data_store.load_file_range('missing', 0, 1) is None
+
+    assert data_store.list_files() == ['2023-05-01-keys', 'aggregates/data.csv', 'models/model.bin']
+    assert data_store.list_files(delimiter='/') == ['2023-05-01-keys']
+    assert data_store.list_files(prefix='aggregates/') == ['aggregates/data.csv']
+
+    data_store.delete_file('aggregates/data.csv')
+    assert data_store.delete_files(['models/model.bin', 'missing']) == []
+    assert data_store.list_files() == ['2023-05-01-keys']
+
+
+def test_set_backend(monkeypatch):
+    aws_helper.setup_aws(monkeypatch, {'STORAGE_BACKEND': 'memory'})
+    backend = MemoryBackend()
+    backend.store('preloaded', b'{"entries": []}')
+    data_store.set_backend(backend)
+    try:
+        assert data_store.load_file_as_json('preloaded') == {'entries': []}
+    finally:
+        data_store.set_backend(None)
+    assert data_store.load_file_as_json('preloaded') is None
+
+
+def test_local_backend_rejects_keys_outside_root(tmp_path):
+    with pytest.raises(ValueError):
+        LocalFileBackend(str(tmp_path)).store('../outside', b'')
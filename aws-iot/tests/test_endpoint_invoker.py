@@ -0,0 +1,68 @@
+import io
+import json
+import threading
+import time
+from botocore.exceptions import ClientError
+
+import endpoint_invoker
+from endpoint_invoker import invoke_endpoints
+
+
+class FakeRuntimeClient:
+    def __init__(self, throttle_count=0):
+        self.throttle_count = throttle_count
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def invoke_endpoint(self, EndpointName, ContentType, Body):
+        with self.lock:
+            self.calls += 1
+            if self.throttle_count > 0:
+                self.throttle_count -= 1
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}},
+                                  'InvokeEndpoint')
+
+        features = json.loads(Body)['features']
+        # Finish out of order to make sure results are still returned in request order
+        time.sleep(0.001 * (10 - features[0] % 10))
+        return {'Body': io.BytesIO(json.dumps([features[0] * 2]).encode('utf-8'))}
+
+
+def test_invoke_endpoints_preserves_order(monkeypatch):
+    client = FakeRuntimeClient()
+    monkeypatch.setattr(endpoint_invoker, '_get_runtime_client', lambda concurrency: client)
+
+    requests = [('test-endpoint', [i, 1.0, 2.0]) for i in range(50)]
+    results = invoke_endpoints(requests, max_concurrency=8)
+
+    assert results == [i * 2 for i in range(50)]
+    assert client.calls == 50
+
+
+def test_invoke_endpoints_retries_throttled_requests(monkeypatch):
+    client = FakeRuntimeClient(throttle_count=3)
+    monkeypatch.setattr(endpoint_invoker, '_get_runtime_client', lambda concurrency: client)
+    monkeypatch.setattr(endpoint_invoker, 'PREDICT_RETRY_BASE_DELAY_SECS', 0.001)
+
+    results = invoke_endpoints([('test-endpoint', [i]) for i in range(5)], max_concurrency=2)
+
+    assert results == [0, 2, 4, 6, 8]
+    assert client.calls == 8
+
+
+def test_invoke_endpoints_raises_other_errors(monkeypatch):
+    class FailingClient:
+        def invoke_endpoint(self, **kwargs):
+            raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'bad input'}}, 'InvokeEndpoint')
+
+    monkeypatch.setattr(endpoint_invoker, '_get_runtime_client', lambda concurrency: FailingClient())
+
+    try:
+        invoke_endpoints([('test-endpoint', [1])])
+        assert False, "Expected the validation error to be raised"
+    except ClientError as e:
+        assert e.response['Error']['Code'] == 'ValidationError'
+
+
+def test_invoke_endpoints_no_requests():
+    assert invoke_endpoints([]) == []
@@ -0,0 +1,90 @@
+import boto3
+import json
+import time
+from moto import mock_aws
+import aws_helper
+from run_manifest import create_run_manifest, store_run_manifest
+
+S3_BUCKET = 'test-bucket'
+AWS_REGION = 'us-west-1'
+ROLE_ARN = 'arn:aws:iam::123456789012:role/test-role'
+
+
+@mock_aws
+def test_cleanup_resources(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    from finalize import cleanup_resources
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    sagemaker = boto3.client('sagemaker')
+
+    # The run was deployed the day before cleanup runs and its manifest lists a model that was never created
+    manifest = create_run_manifest('2024-05-05')
+    _deploy(sagemaker, manifest, 'temperature')
+    manifest['models'].append('2024-05-05-humidity-model')
+    manifest['files'] = ['models/2024-05-05-temperature-model.tar.gz', 'prediction-cache/temperature.json']
+    store_run_manifest(manifest)
+    # An earlier run that was never cleaned up, and one that is still in progress
+    stale_manifest = dict(create_run_manifest('2024-04-28'), created=int(time.time()) - 7 * 24 * 60 * 60)
+    _deploy(sagemaker, stale_manifest, 'pressure')
+    store_run_manifest(stale_manifest)
+    in_progress_manifest = create_run_manifest('2024-05-06')
+    _deploy(sagemaker, in_progress_manifest, 'humidity')
+    store_run_manifest(in_progress_manifest)
+
+    for file_key in manifest['files'] + ['models/forecast-models.npz', 'aggregates/2024-04-28-aggregate-data.csv',
+                                         'aggregates/2024-05-05-aggregate-data.csv',
+                                         'aggregates/2024-05-06-aggregate-data.csv']:
+        s3.put_object(Bucket=S3_BUCKET, Key=file_key, Body=b'{}')
+
+    event = {'aggregateFileKey': 'aggregates/2024-05-05-aggregate-data.csv',
+             'modelBundleKey': 'models/forecast-models.npz', 'error': {'Error': 'States.TaskFailed'}}
+    assert cleanup_resources(event, None) == {'runs': ['2024-04-28', '2024-05-05'], 'remaining': 0}
+
+    assert [endpoint['EndpointName'] for endpoint in sagemaker.list_endpoints()['Endpoints']] == \
+        ['2024-05-06-humidity-model-endpoint']
+    assert [model['ModelName'] for model in sagemaker.list_models()['Models']] == ['2024-05-06-humidity-model']
+    file_keys = [file_obj['Key'] for file_obj in s3.list_objects_v2(Bucket=S3_BUCKET)['Contents']]
+    assert file_keys == ['aggregates/2024-05-06-aggregate-data.csv', 'manifests/2024-05-06.json']
+
+    # Cleaning up again is a no-op
+    assert cleanup_resources(event, None) == {'runs': [], 'remaining': 0}
+
+
+@mock_aws
+def test_cleanup_resources_keeps_what_could_not_be_deleted(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import finalize
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    manifest = create_run_manifest('2024-05-05')
+    _deploy(boto3.client('sagemaker'), manifest, 'temperature')
+    store_run_manifest(manifest)
+
+    def fail_delete_model(**kwargs):
+        raise Exception('Throttled')
+
+    sagemaker = finalize.get_client('sagemaker', max_pool_connections=finalize.CLEANUP_MAX_CONCURRENCY)
+    monkeypatch.setattr(sagemaker, 'delete_model', fail_delete_model)
+    # Without a run (i.e. on the schedule) only the resources of manifests old enough to be stale are cleaned up
+    assert finalize.cleanup_resources({}, None) == {'runs': [], 'remaining': 0}
+    monkeypatch.setattr(finalize, 'STALE_RUN_MANIFEST_SECS', 0)
+    assert finalize.cleanup_resources({}, None) == {'runs': ['2024-05-05'], 'remaining': 1}
+
+    manifest = json.loads(s3.get_object(Bucket=S3_BUCKET, Key='manifests/2024-05-05.json')['Body'].read())
+    assert (manifest['endpoints'], manifest['endpointConfigs'], manifest['models']) == \
+        ([], [], ['2024-05-05-temperature-model'])
+
+
+def _deploy(sagemaker, manifest, model_type):
+    model_name = f"{manifest['run']}-{model_type}-model"
+    endpoint_config_name = f"{manifest['run']}-{model_type}-endpoint-config"
+    sagemaker.create_model(ModelName=model_name, ExecutionRoleArn=ROLE_ARN,
+                           PrimaryContainer={'Image': 'image', 'ModelDataUrl': f's3://{S3_BUCKET}/model.tar.gz'})
+    sagemaker.create_endpoint_config(EndpointConfigName=endpoint_config_name, ProductionVariants=[
+        {'VariantName': 'AllTraffic', 'ModelName': model_name, 'InstanceType': 'ml.m5.large',
+         'InitialInstanceCount': 1}])
+    sagemaker.create_endpoint(EndpointName=f'{model_name}-endpoint', EndpointConfigName=endpoint_config_name)
+    manifest['models'].append(model_name)
+    manifest['endpointConfigs'].append(endpoint_config_name)
+    manifest['endpoints'].append(f'{model_name}-endpoint')
@@ -0,0 +1,74 @@
+import datetime
+import numpy as np
+import pytest
+from forecast_features import build_time_of_day_profile, lookup_profile, build_feature_matrix, build_device_profiles, \
+    forecast_with_linear_models
+
+
+def test_build_time_of_day_profile():
+    profile = build_time_of_day_profile([0, 50, 600, 650, 1210],
+                                        [[1, 3, 10, 20, 5], [100, 100, 200, 300, 400]])
+
+    assert profile.slots.tolist() == [0, 600, 1200]
+    assert profile.averages.tolist() == [[2, 100], [15, 250], [5, 400]]
+
+
+def test_lookup_profile_interpolates_and_wraps_around_midnight():
+    profile = build_time_of_day_profile([3600, 7200], [[10, 20]])
+
+    assert lookup_profile(profile, [3600, 5400, 7200], 'interpolate')[:, 0].tolist() == [10, 15, 20]
+    # Before the first slot the value is interpolated from the last slot of the previous day
+    assert lookup_profile(profile, [0], 'interpolate')[0, 0] == pytest.approx(20 - 10 * 79200 / 82800)
+    assert lookup_profile(profile, [5000, 5500, 86000], 'nearest')[:, 0].tolist() == [10, 20, 10]
+
+
+def test_build_feature_matrix():
+    profile = build_time_of_day_profile([0, 43200], [[20, 30], [50, 60], [1000, 1010]])
+    start_date = datetime.date(2024, 4, 7)  # a Sunday
+
+    matrix = build_feature_matrix(profile, ['temperature', 'humidity', 'pressure'], start_date,
+                                  horizon_days=2, resolution_secs=43200)
+
+    assert matrix.features.shape == (3, 4, 10)
+    assert matrix.day_offsets.tolist() == [0, 0, 1, 1]
+    start_of_day = int(datetime.datetime(2024, 4, 7, tzinfo=datetime.timezone.utc).timestamp()) * 1000
+    assert matrix.timestamps.tolist() == [start_of_day + i * 43200 * 1000 for i in range(4)]
+
+    # temperature model is fed humidity and pressure averages, Sunday and then Monday one-hot encoded
+    assert matrix.features[0, 1].tolist() == [43200, 60, 1010, 0, 0, 0, 0, 0, 0, 1]
+    assert matrix.features[0, 2].tolist() == [0, 50, 1000, 1, 0, 0, 0, 0, 0, 0]
+    # humidity model is fed temperature and pressure, pressure model temperature and humidity
+    assert matrix.features[1, 0, :3].tolist() == [0, 20, 1000]
+    assert matrix.features[2, 0, :3].tolist() == [0, 20, 50]
+
+
+def test_build_device_profiles():
+    devices, profiles = build_device_profiles(['b', 'a', 'b', 'b'], [0, 50, 150, 130], [[1, 2, 3, 5], [10, 20, 30, 50]])
+
+    assert devices == ['a', 'b']
+    assert profiles[0].slots.tolist() == [0]
+    assert profiles[0].averages.tolist() == [[2, 20]]
+    assert profiles[1].slots.tolist() == [0, 100]
+    assert profiles[1].averages.tolist() == [[1, 10], [4, 40]]
+
+
+# Scoring the linear models directly must give the same results as applying them to the feature matrix rows
+def test_forecast_with_linear_models_matches_feature_matrix():
+    metric_types = ['temperature', 'humidity', 'pressure']
+    profiles = [build_time_of_day_profile([0, 43200], [[20, 30], [50, 60], [1000, 1010]]),
+                build_time_of_day_profile([0, 21600, 64800], [[10, 15, 12], [70, 65, 60], [990, 995, 1000]])]
+    coefficients = np.random.default_rng(0).normal(size=(2, 3, 11))
+    start_date = datetime.date(2024, 4, 7)
+
+    forecast = list(forecast_with_linear_models(coefficients, profiles, start_date, horizon_days=3,
+                                                resolution_secs=3600))
+
+    assert [day for day, timestamps, predictions in forecast] == [0, 1, 2]
+    for device, profile in enumerate(profiles):
+        matrix = build_feature_matrix(profile, metric_types, start_date, horizon_days=3, resolution_secs=3600)
+        for metric in range(3):
+            expected = matrix.features[metric] @ coefficients[device, metric, :-1] + coefficients[device, metric, -1]
+            predicted = np.concatenate([predictions[device, metric] for day, timestamps, predictions in forecast])
+            assert np.allclose(predicted, expected)
+    assert np.concatenate([timestamps for day, timestamps, predictions in forecast]).tolist() == \
+        matrix.timestamps.tolist()
@@ -0,0 +1,48 @@
+import json
+from datetime import datetime
+
+import aws_helper
+import data_store
+import perf_metrics
+from api import fetch_metrics
+from data_store import append_data_as_json
+from storage_backends import MemoryBackend
+
+
+def test_handler_metrics_are_emitted_as_embedded_metrics(monkeypatch, capsys):
+    aws_helper.setup_aws(monkeypatch)
+    monkeypatch.setattr(perf_metrics, 'PERF_METRICS_ENABLED', True)
+    data_store.set_backend(MemoryBackend())
+    try:
+        date_today = datetime.now().strftime('%Y-%m-%d')
+        append_data_as_json([{'t': 1000, 'tmp': 24.5}, {'t': 2000, 'tmp': 24.6}], date_today)
+        capsys.readouterr()
+
+        response = fetch_metrics({'queryStringParameters': {'date': date_today}}, None)
+        assert response['statusCode'] == 200
+    finally:
+        data_store.set_backend(None)
+
+    metrics = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert metrics['Handler'] == 'api.fetch_metrics'
+    assert metrics['StorageLoadCount'] == 1
+    assert metrics['StorageLoadBytesRead'] > 0
+    assert metrics['EntriesRecords'] == 2
+    assert metrics['HandlerErrors'] == 0
+    assert metrics['HandlerDuration'] >= metrics['StorageLoadDuration']
+    directive = metrics['_aws']['CloudWatchMetrics'][0]
+    assert directive['Dimensions'] == [['Handler']]
+    assert {'Name': 'StorageLoadBytesRead', 'Unit': 'Bytes'} in directive['Metrics']
+
+
+def test_nothing_is_emitted_when_disabled(monkeypatch, capsys):
+    aws_helper.setup_aws(monkeypatch)
+    monkeypatch.setattr(perf_metrics, 'PERF_METRICS_ENABLED', False)
+    data_store.set_backend(MemoryBackend())
+    try:
+        fetch_metrics({'queryStringParameters': {}}, None)
+    finally:
+        data_store.set_backend(None)
+
+    assert capsys.readouterr().out == ''
+    assert perf_metrics.timed('StorageLoad') is perf_metrics.timed('StorageStore')
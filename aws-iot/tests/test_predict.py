@@ -0,0 +1,210 @@
+import boto3
+import datetime
+import io
+import json
+import numpy as np
+import pytest
+from moto import mock_aws
+import aws_helper
+
+S3_BUCKET = 'test-bucket'
+AWS_REGION = 'us-west-1'
+ENDPOINTS = {
+    'temperature-endpoint': 'temperature-endpoint',
+    'humidity-endpoint': 'humidity-endpoint',
+    'pressure-endpoint': 'pressure-endpoint'
+}
+MODEL_IDS = {
+    'temperature-model-id': 'temperature-model-1',
+    'humidity-model-id': 'humidity-model-1',
+    'pressure-model-id': 'pressure-model-1'
+}
+AGGREGATE_CSV = ('day_of_week,time_of_day,temperature,humidity,pressure\n'
+                 'Monday,0,20.0,50.0,1000.0\n'
+                 'Monday,43200,30.0,60.0,1010.0\n')
+
+
+@mock_aws
+def test_predict_daily_atmospheric_metrics(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import predict
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    s3.put_object(Bucket=S3_BUCKET, Key='aggregates/aggregate-data.csv', Body=AGGREGATE_CSV)
+
+    invoked = []
+
+    def fake_invoke_endpoints(requests):
+        invoked.extend(requests)
+        # Predict the time of day so that every stored value can be traced back to its request
+        return [features[0] for endpoint_name, features in requests]
+
+    monkeypatch.setattr(predict, 'invoke_endpoints', fake_invoke_endpoints)
+    predict.predict_daily_atmospheric_metrics({
+        'aggregateFileKey': 'aggregates/aggregate-data.csv',
+        'endpoints': ENDPOINTS
+    }, None)
+
+    assert len(invoked) == 7 * 144 * 3
+    assert {endpoint_name for endpoint_name, features in invoked} == set(ENDPOINTS.values())
+
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    for day in range(7):
+        file_key = (today + datetime.timedelta(days=day)).strftime('%Y-%m-%d') + '-predictions'
+        json_data = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=file_key)['Body'].read())
+        entries = json_data['entries']
+        assert len(entries) == 144
+        assert entries[1]['tmp'] == entries[1]['hum'] == entries[1]['pr'] == 600
+        # The recorded spacing is that of the predictions
+        assert entries[1]['t'] - entries[0]['t'] == json_data['r'] * 1000 == 600 * 1000
+
+    # A day that can't be stored fails the run instead of leaving the day without a forecast
+    def fail_store_file(file_key, file_content):
+        raise Exception('Throttled')
+
+    monkeypatch.setattr(predict, 'store_file', fail_store_file)
+    with pytest.raises(Exception, match='Throttled'):
+        predict.predict_daily_atmospheric_metrics({
+            'aggregateFileKey': 'aggregates/aggregate-data.csv',
+            'endpoints': ENDPOINTS
+        }, None)
+
+
+@mock_aws
+def test_predict_daily_atmospheric_metrics_rerun_only_scores_missing_rows(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import predict
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    s3.put_object(Bucket=S3_BUCKET, Key='aggregates/aggregate-data.csv', Body=AGGREGATE_CSV)
+    monkeypatch.setattr(predict, 'PREDICTION_CACHE_CHUNK_SIZE', 1000)
+
+    invoked = []
+
+    def failing_invoke_endpoints(requests):
+        if invoked:
+            raise Exception('Endpoint went away')
+        invoked.extend(requests)
+        return [features[0] for endpoint_name, features in requests]
+
+    event = {'aggregateFileKey': 'aggregates/aggregate-data.csv', 'endpoints': dict(ENDPOINTS, **MODEL_IDS)}
+    monkeypatch.setattr(predict, 'invoke_endpoints', failing_invoke_endpoints)
+    try:
+        predict.predict_daily_atmospheric_metrics(event, None)
+        assert False, "Expected the second chunk of requests to fail"
+    except Exception as e:
+        assert str(e) == 'Endpoint went away'
+
+    rerun_invoked = []
+
+    def fake_invoke_endpoints(requests):
+        rerun_invoked.extend(requests)
+        return [features[0] for endpoint_name, features in requests]
+
+    monkeypatch.setattr(predict, 'invoke_endpoints', fake_invoke_endpoints)
+    predict.predict_daily_atmospheric_metrics(event, None)
+    assert len(invoked) == 1000
+    assert len(rerun_invoked) == 7 * 144 * 3 - 1000
+
+    # A rerun with everything cached makes no requests and overwrites rather than appends to the prediction files
+    rerun_invoked.clear()
+    predict.predict_daily_atmospheric_metrics(event, None)
+    assert rerun_invoked == []
+
+    # A model retrained and deployed behind the same endpoint doesn't get the predictions of the previous one
+    event['endpoints']['temperature-model-id'] = 'temperature-model-2'
+    predict.predict_daily_atmospheric_metrics(event, None)
+    assert len(rerun_invoked) == 7 * 144
+    assert {endpoint_name for endpoint_name, features in rerun_invoked} == {'temperature-endpoint'}
+
+    file_key = datetime.datetime.now(datetime.timezone.utc).date().strftime('%Y-%m-%d') + '-predictions'
+    entries = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=file_key)['Body'].read())['entries']
+    assert len(entries) == 144
+
+
+@mock_aws
+def test_predict_daily_atmospheric_metrics_with_model_bundle(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import predict
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    aggregate_csv = ('day_of_week,time_of_day,temperature,humidity,pressure,device\n'
+                     'Monday,0,20.0,50.0,1000.0,A\n'
+                     'Monday,0,25.0,40.0,1020.0,B\n')
+    s3.put_object(Bucket=S3_BUCKET, Key='aggregates/aggregate-data.csv', Body=aggregate_csv)
+
+    # The global model predicts the intercept, A's model the humidity (for temperature) and the day of the week
+    coefficients = np.zeros((2, 3, 11))
+    coefficients[0, :, -1] = [1.0, 2.0, 3.0]
+    coefficients[1, 0, 1] = 1.0
+    coefficients[1, 1:, 3:10] = np.arange(7)
+    bundle = io.BytesIO()
+    np.savez_compressed(bundle, metric_types=np.array(['temperature', 'humidity', 'pressure']),
+                        devices=np.array(['A']), coefficients=coefficients, rmse=np.zeros((2, 3)), rows=[2, 1])
+    s3.put_object(Bucket=S3_BUCKET, Key='models/forecast-models.npz', Body=bundle.getvalue())
+
+    monkeypatch.setattr(predict, 'invoke_endpoints', lambda requests: pytest.fail('No endpoint should be invoked'))
+    predict.predict_daily_atmospheric_metrics({
+        'aggregateFileKey': 'aggregates/aggregate-data.csv',
+        'modelBundleKey': 'models/forecast-models.npz'
+    }, None)
+
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    for day in range(7):
+        file_key = (today + datetime.timedelta(days=day)).strftime('%Y-%m-%d') + '-predictions'
+        predictions = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=file_key)['Body'].read())
+        # The horizon day and model version are recorded for tracking the accuracy of the forecasts
+        assert (predictions['h'], predictions['v'], predictions['r']) == (day, 'forecast-models', 600)
+        entries = predictions['entries']
+        assert len(entries) == 144 * 2
+        weekday = (today + datetime.timedelta(days=day)).weekday()
+        assert entries[0] == {'t': entries[0]['t'], 'tmp': 50.0, 'hum': weekday, 'pr': weekday, 'device': 'A'}
+        assert entries[1] == {'t': entries[0]['t'], 'tmp': 1.0, 'hum': 2.0, 'pr': 3.0, 'device': 'B'}
+        assert entries[2]['t'] - entries[0]['t'] == 600 * 1000
+
+
+@mock_aws
+def test_deploy_models_records_resources_in_run_manifest(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import predict
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    monkeypatch.setattr(predict, 'MODELS_PATH', 'models')
+    for model_type in ['temperature', 'humidity', 'pressure']:
+        s3.put_object(Bucket=S3_BUCKET, Key=f'models/2024-05-05-{model_type}-model.tar.gz', Body=model_type.encode())
+
+    # Resources are named after the run rather than the day they are deployed on
+    endpoints = predict.deploy_models({'aggregateFileKey': 'aggregates/2024-05-05-aggregate-data.csv'}, None)
+    assert endpoints['temperature-endpoint'] == '2024-05-05-temperature-model-endpoint'
+    # The model ids change with the content of the artifacts
+    model_id = endpoints['temperature-model-id']
+    assert model_id.startswith('2024-05-05-temperature-model-') and model_id != endpoints['humidity-model-id']
+
+    manifest = json.loads(s3.get_object(Bucket=S3_BUCKET, Key='manifests/2024-05-05.json')['Body'].read())
+    assert manifest['endpoints'] == [endpoints[f'{model_type}-endpoint']
+                                     for model_type in ['temperature', 'humidity', 'pressure']]
+    assert manifest['models'] == ['2024-05-05-temperature-model', '2024-05-05-humidity-model',
+                                  '2024-05-05-pressure-model']
+    assert 'models/2024-05-05-temperature-model.tar.gz' in manifest['files']
+    assert f'prediction-cache/{model_id}.json' in manifest['files']
+
+
+@mock_aws
+def test_deploy_models_aborts_if_run_manifest_is_not_stored(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    import predict
+    import run_manifest
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
+    monkeypatch.setattr(predict, 'MODELS_PATH', 'models')
+    for model_type in ['temperature', 'humidity', 'pressure']:
+        s3.put_object(Bucket=S3_BUCKET, Key=f'models/2024-05-05-{model_type}-model.tar.gz', Body=model_type.encode())
+
+    def fail_store_file(file_key, file_content):
+        raise Exception('Throttled')
+
+    monkeypatch.setattr(run_manifest, 'store_file', fail_store_file)
+    # Nothing is deployed that cleanup wouldn't know about
+    with pytest.raises(Exception, match='Throttled'):
+        predict.deploy_models({'aggregateFileKey': 'aggregates/2024-05-05-aggregate-data.csv'}, None)
+    assert boto3.client('sagemaker').list_models()['Models'] == []
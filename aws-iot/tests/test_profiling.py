@@ -0,0 +1,49 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import aws_helper
+import data_store
+from api import fetch_metrics
+from data_store import append_data_as_json, list_files, load_file_as_string
+from storage_backends import MemoryBackend
+
+
+def test_sampled_invocations_are_profiled(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    monkeypatch.setenv('PROFILE_SAMPLE_RATE', '1')
+    data_store.set_backend(MemoryBackend())
+    try:
+        date_today = datetime.now().strftime('%Y-%m-%d')
+        append_data_as_json([{'t': 1000, 'tmp': 24.5}], date_today)
+
+        response = fetch_metrics({'queryStringParameters': {'date': date_today}},
+                                 SimpleNamespace(aws_request_id='request-1'))
+        assert response['statusCode'] == 200
+
+        reports = list_files('profiles/api.fetch_metrics/')
+        assert sorted(key.rsplit('.', 1)[1] for key in reports) == ['prof', 'txt']
+        assert all(key.rsplit('.', 1)[0].endswith('-request-1') for key in reports)
+        report = load_file_as_string(next(key for key in reports if key.endswith('.txt')))
+        assert 'functions by cumulative time' in report
+        assert 'fetch_metrics' in report
+        assert 'allocations still held' in report
+    finally:
+        data_store.set_backend(None)
+
+
+def test_only_selected_handlers_are_profiled(monkeypatch):
+    aws_helper.setup_aws(monkeypatch)
+    monkeypatch.setenv('PROFILE_SAMPLE_RATE', '1')
+    monkeypatch.setenv('PROFILE_HANDLERS', 'prepare.generate_csv_from_daily_data')
+    data_store.set_backend(MemoryBackend())
+    try:
+        response = fetch_metrics({'queryStringParameters': {'date': '2024-01-01'}}, None)
+        assert response['statusCode'] == 200
+        assert list_files('profiles/') == []
+
+        monkeypatch.setenv('PROFILE_HANDLERS', '')
+        monkeypatch.setenv('PROFILE_SAMPLE_RATE', '0')
+        fetch_metrics({'queryStringParameters': {'date': '2024-01-01'}}, None)
+        assert list_files('profiles/') == []
+    finally:
+        data_store.set_backend(None)
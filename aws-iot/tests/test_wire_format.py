@@ -0,0 +1,79 @@
+import importlib.util
+import os
+import struct
+
+import pytest
+
+import wire_format
+
+# The device's encoder, loaded from its file as it has the same module name as the decoder
+_spec = importlib.util.spec_from_file_location('device_wire_format', os.path.join(
+    os.path.dirname(__file__), '..', '..', 'iot-device', 'wire_format.py'))
+device_wire_format = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(device_wire_format)
+
+MAY_1 = 1682899200000
+
+
+def test_header_round_trip():
+    readings = [{'t': MAY_1, 'tmp': 21.5, 'hum': 45.25, 'pr': 1013.25}]
+    data = device_wire_format.encode_readings(readings, 'RPi3BHome')
+    assert wire_format.HEADER.unpack_from(data) == (wire_format.WIRE_FORMAT_VERSION, wire_format.FLAG_DEVICE, 1)
+    assert wire_format.decode_readings(data) == {'device': 'RPi3BHome', 'entries': readings}
+
+    # Without a device id, the backend tags the readings with the device from the topic
+    data = device_wire_format.encode_readings(readings * 3)
+    assert wire_format.HEADER.unpack_from(data) == (wire_format.WIRE_FORMAT_VERSION, 0, 3)
+    assert wire_format.decode_readings(data) == {'entries': readings * 3}
+
+    device_id = 'é' * 127
+    assert wire_format.decode_readings(device_wire_format.encode_readings(readings, device_id))['device'] == device_id
+    with pytest.raises(ValueError):
+        device_wire_format.encode_readings(readings, 'x' * 256)
+
+
+def test_base_time_round_trip():
+    # The base is the earliest reading whatever the order of the readings, the others are offsets from it
+    readings = [{'t': MAY_1 + 60000, 'tmp': 20.0}, {'t': MAY_1, 'tmp': 21.0},
+                {'t': MAY_1 + 0xFFFFFFFF, 'tmp': 22.0}]
+    data = device_wire_format.encode_readings(readings)
+    assert wire_format.BASE_TIME.unpack_from(data, wire_format.HEADER.size) == (MAY_1,)
+    assert wire_format.decode_readings(data)['entries'] == readings
+
+    with pytest.raises(ValueError):
+        device_wire_format.encode_readings([{'t': MAY_1, 'tmp': 20.0}, {'t': MAY_1 + 0x100000000, 'tmp': 20.0}])
+
+
+def test_readings_round_trip():
+    readings = [
+        {'t': MAY_1, 'tmp': -12.34, 'hum': 0.0, 'pr': 987.65},
+        # Deadband readings are missing some metrics
+        {'t': MAY_1 + 1000, 'hum': 99.99},
+        {'t': MAY_1 + 2000},
+        # The limits of each metric's type, short of the values that mark a metric as missing
+        {'t': MAY_1 + 3000, 'tmp': -327.68, 'hum': 655.34, 'pr': 42949672.94},
+        {'t': MAY_1 + 4000, 'tmp': 327.66, 'hum': 0.01, 'pr': 0.0}
+    ]
+    data = device_wire_format.encode_readings(readings)
+    assert len(data) == wire_format.HEADER.size + wire_format.BASE_TIME.size + len(readings) * 12
+    assert wire_format.decode_readings(data)['entries'] == readings
+    # Values are rounded to hundredths
+    assert wire_format.decode_readings(device_wire_format.encode_readings([{'t': MAY_1, 'tmp': 21.234}])) == \
+        {'entries': [{'t': MAY_1, 'tmp': 21.23}]}
+
+
+@pytest.mark.parametrize('reading', [
+    {'t': MAY_1, 'tmp': -327.69}, {'t': MAY_1, 'tmp': 327.67}, {'t': MAY_1, 'hum': -0.01},
+    {'t': MAY_1, 'hum': 655.35}, {'t': MAY_1, 'pr': 42949672.95}, {'t': MAY_1, 'tmp': 21.0, 'w': 60000, 'n': 60}
+])
+def test_readings_out_of_range(reading):
+    with pytest.raises(ValueError):
+        device_wire_format.encode_readings([reading])
+
+
+def test_truncated_payload():
+    data = device_wire_format.encode_readings([{'t': MAY_1, 'tmp': 21.0}] * 2)
+    with pytest.raises(ValueError):
+        wire_format.decode_readings(data[:-1])
+    with pytest.raises(ValueError):
+        wire_format.decode_readings(struct.pack('<BBH', 2, 0, 0))
@@ -0,0 +1,76 @@
+import base64
+import binascii
+import struct
+
+# Decoder for the compact binary encoding of readings produced by iot-device/wire_format.py. All values are little
+# endian.
+#
+#   header:  version (uint8), flags (uint8), reading count (uint16)
+#   device:  only if flags & FLAG_DEVICE, length (uint8) followed by the utf-8 encoded device id
+#   base:    time of the first reading in epoch millis (int64)
+#   reading: millis since base (uint32), temperature * 100 (int16), humidity * 100 (uint16), pressure * 100 (uint32)
+#
+# Metrics encoded as the maximum value of their type are missing from the reading (deadband readings).
+#
+# Binary payloads are published to their own topic and the IoT rule for that topic base64 encodes them into the "bin"
+# field of the event, e.g. {"bin": "AQABAA..."}.
+WIRE_FORMAT_VERSION = 1
+FLAG_DEVICE = 0x01
+HEADER = struct.Struct('<BBH')
+BASE_TIME = struct.Struct('<q')
+READING = struct.Struct('<IhHI')
+MISSING_VALUES = (0x7FFF, 0xFFFF, 0xFFFFFFFF)
+METRIC_KEYS = ('tmp', 'hum', 'pr')
+
+
+def is_binary_payload(payload):
+    return isinstance(payload, dict) and 'bin' in payload
+
+
+# Decodes a base64 encoded binary payload into a batch payload, i.e. {"device": ..., "entries": [...]}. Raises a
+# ValueError if the payload is malformed.
+def decode_binary_payload(payload):
+    try:
+        data = base64.b64decode(payload['bin'], validate=True)
+    except (binascii.Error, TypeError) as e:
+        raise ValueError(f'The binary payload is not valid base64: {e}')
+    return decode_readings(data)
+
+
+def decode_readings(data):
+    try:
+        return _decode_readings(data)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f'The binary payload is truncated or malformed: {e}')
+
+
+def _decode_readings(data):
+    version, flags, count = HEADER.unpack_from(data, 0)
+    if version != WIRE_FORMAT_VERSION:
+        raise ValueError(f'Unsupported wire format version: {version}')
+
+    offset = HEADER.size
+    device_id = None
+    if flags & FLAG_DEVICE:
+        device_length = data[offset]
+        device_id = data[offset + 1:offset + 1 + device_length].decode('utf-8')
+        offset += 1 + device_length
+
+    base_time, = BASE_TIME.unpack_from(data, offset)
+    offset += BASE_TIME.size
+
+    entries = []
+    for time_offset, *values in READING.iter_unpack(data[offset:offset + count * READING.size]):
+        reading = {'t': base_time + time_offset}
+        for key, value, missing_value in zip(METRIC_KEYS, values, MISSING_VALUES):
+            if value != missing_value:
+                reading[key] = value / 100
+        entries.append(reading)
+
+    if len(entries) != count:
+        raise ValueError(f'Expected {count} readings but the payload only contains {len(entries)}')
+
+    batch = {'entries': entries}
+    if device_id:
+        batch['device'] = device_id
+    return batch
@@ -1,51 +1,114 @@
 import json
+import threading
 # These dependencies are only on the RPi
 from awscrt import io, mqtt, auth, http
 from awsiot import mqtt_connection_builder
 
+from payloads import MAX_BATCH_SIZE, build_batch_payload
+from wire_format import encode_readings
+
 
 class DataEndpoint:
 
-    def __init__(self):
-        # TODO: Put values in a config file or pass them as args (or both)
+    # TODO: Put values in a config file (the daemon passes them as args)
+    def __init__(self,
+                 endpoint='a1ktn0eiegwonn-ats.iot.us-west-1.amazonaws.com',
+                 root_ca_file='../keys/root-CA.crt',
+                 cert_path='../keys/RPi3BHome.cert.pem',
+                 key_path='../keys/RPi3BHome.private.key',
+                 client_id='rpi3bTempHumPress',
+                 topic='rpi/sensor/events',
+                 device_id='RPi3BHome',
+                 batch_size=1,
+                 batch_interval_secs=0,
+                 binary_topic='rpi/sensor/events/bin',
+                 wire_format='json',
+                 connect=True):
         self.mqtt_connection = None
-        self.endpoint = 'a1ktn0eiegwonn-ats.iot.us-west-1.amazonaws.com'
-        self.root_ca_file = '../keys/root-CA.crt'
-        self.cert_path = '../keys/RPi3BHome.cert.pem'
-        self.key_path = '../keys/RPi3BHome.private.key'
-        self.client_id = 'rpi3bTempHumPress'
-        self.topic = 'rpi/sensor/events'
-        self._connect()
-
-    def _connect(self):
-        self.mqtt_connection = mqtt_connection_builder.mtls_from_path(
-            endpoint=self.endpoint,
-            cert_filepath=self.cert_path,
-            pri_key_filepath=self.key_path,
-            ca_filepath=self.root_ca_file,
-            on_connection_interrupted=self.on_connection_interrupted,
-            on_connection_resumed=self.on_connection_resumed,
-            on_puback=self.on_publish,
-            client_id=self.client_id,
-            clean_session=False,
-            keep_alive_secs=6
-        )
-        self.mqtt_connection.on_puback = self.on_publish
+        self.endpoint = endpoint
+        self.root_ca_file = root_ca_file
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self.client_id = client_id
+        self.topic = topic
+        self.device_id = device_id
+        # 'binary' publishes readings in the compact wire format (see wire_format.py) to the binary topic, falling
+        # back to JSON for readings that the format can't represent
+        self.binary_topic = binary_topic
+        self.wire_format = wire_format
+        # Readings are published once batch_size of them have been buffered or the oldest has been buffered for
+        # batch_interval_secs, whichever comes first (see PublishDaemon). A batch size of 1 publishes every reading on
+        # its own.
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.batch_interval_secs = batch_interval_secs
+        self.connected = threading.Event()
+        if connect:
+            self.connect()
+
+    def connect(self):
+        if not self.mqtt_connection:
+            self.mqtt_connection = mqtt_connection_builder.mtls_from_path(
+                endpoint=self.endpoint,
+                cert_filepath=self.cert_path,
+                pri_key_filepath=self.key_path,
+                ca_filepath=self.root_ca_file,
+                on_connection_interrupted=self.on_connection_interrupted,
+                on_connection_resumed=self.on_connection_resumed,
+                on_puback=self.on_publish,
+                client_id=self.client_id,
+                clean_session=False,
+                keep_alive_secs=6
+            )
+            self.mqtt_connection.on_puback = self.on_publish
         connect_future = self.mqtt_connection.connect()
         connect_future.result()
+        self.connected.set()
+
+    def disconnect(self):
+        self.connected.clear()
+        if self.mqtt_connection:
+            disconnect_future = self.mqtt_connection.disconnect()
+            disconnect_future.result()
+
+    # Publishes the data over the open connection and returns a future that completes once the broker has
+    # acknowledged the message. The connection stays open so that subsequent publishes don't pay for a new handshake.
+    def publish(self, data):
+        if self.wire_format == 'binary':
+            try:
+                return self._publish(self.binary_topic, encode_readings([data]))
+            except ValueError as e:
+                print(f"Unable to encode reading in the binary format, sending it as JSON: {e}")
+        return self._publish(self.topic, json.dumps(data))
+
+    # Publishes the readings as a single batch and returns a future that completes once the batch is acknowledged
+    def publish_batch(self, readings):
+        if self.wire_format == 'binary':
+            try:
+                return self._publish(self.binary_topic, encode_readings(readings, self.device_id))
+            except ValueError as e:
+                print(f"Unable to encode readings in the binary format, sending them as JSON: {e}")
+        return self._publish(self.topic, json.dumps(build_batch_payload(self.device_id, readings)))
+
+    def _publish(self, topic, payload):
+        publish_future, packet_id = self.mqtt_connection.publish(topic=topic, payload=payload,
+                                                                 qos=mqtt.QoS.AT_LEAST_ONCE)
+        return publish_future
 
+    # One shot publish of the data which closes the connection afterwards
     def push_data(self, data):
-        self.mqtt_connection.publish(topic=self.topic, payload=json.dumps(data), qos=mqtt.QoS.AT_LEAST_ONCE)
-        disconnect_future = self.mqtt_connection.disconnect()
-        disconnect_future.result()
+        self.publish(data)
+        self.disconnect()
 
-    # Callback when connection is accidentally lost.
-    def on_connection_interrupted(connection, error, **kwargs):
+    # Callback when connection is accidentally lost. The underlying client reconnects automatically.
+    def on_connection_interrupted(self, connection, error, **kwargs):
+        self.connected.clear()
         print("Connection interrupted. error: {}".format(error))
 
     # Callback when an interrupted connection is re-established.
-    def on_connection_resumed(connection, return_code, session_present, **kwargs):
+    def on_connection_resumed(self, connection, return_code, session_present, **kwargs):
+        if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+            self.connected.set()
         print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
 
-    def on_publish(connection, error, **kwargs):
-        print("publish complete")
\ No newline at end of file
+    def on_publish(self, connection, error, **kwargs):
+        print("publish complete")
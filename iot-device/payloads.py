@@ -0,0 +1,10 @@
+# Maximum number of readings in a batch. Keeps the JSON payload well below the 128 KB AWS IoT message size limit.
+MAX_BATCH_SIZE = 1000
+
+
+# Wraps the readings in a single payload. The backend unpacks the entries and tags each one with the device.
+def build_batch_payload(device_id, readings):
+    return {
+        "device": device_id,
+        "entries": list(readings)
+    }
@@ -0,0 +1,208 @@
+import argparse
+import signal
+import threading
+import time
+
+from payloads import MAX_BATCH_SIZE
+from reading_buffer import ReadingBuffer
+from reduction import DeadbandFilter, WindowSummarizer, ReductionPipeline, parse_thresholds
+
+PUBLISH_ACK_TIMEOUT_SECS = 10
+
+
+# Long running alternative to hum_temp_press_push.py. Keeps a single MQTT connection open and samples the sensors on a
+# fixed schedule so that each reading doesn't pay for a new TLS handshake.
+#
+# Every reading goes through a durable buffer. A separate drain thread publishes the buffered readings in batches
+# (using the endpoint's batch size and interval) and only removes them from the buffer once they are acknowledged.
+# After an outage the backlog is drained in batches of up to drain_batch_size readings at no more than
+# drain_rate batches per second, while new samples keep being buffered.
+#
+# Readings can optionally be reduced (see reduction.py) before they are buffered.
+class PublishDaemon:
+
+    def __init__(self, endpoint, sensors, buffer, interval_secs, drain_batch_size=MAX_BATCH_SIZE, drain_rate=2,
+                 max_reconnect_backoff_secs=60, reducer=None):
+        self.endpoint = endpoint
+        self.sensors = sensors
+        self.buffer = buffer
+        self.reducer = reducer or ReductionPipeline([])
+        self.interval_secs = interval_secs
+        self.drain_batch_size = max(endpoint.batch_size, min(drain_batch_size, MAX_BATCH_SIZE))
+        self.min_publish_interval_secs = 1 / drain_rate
+        self.max_reconnect_backoff_secs = max_reconnect_backoff_secs
+        self.reconnect_backoff_secs = 1
+        self.next_reconnect_time = 0
+        self.has_connected = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        drain_thread = threading.Thread(target=self._drain, name='buffer-drain', daemon=True)
+        drain_thread.start()
+
+        next_sample_time = time.monotonic()
+        while not self.stopped.is_set():
+            self._sample()
+
+            # Schedule from the previous sample time rather than from now so that the sample rate doesn't drift
+            next_sample_time += self.interval_secs
+            delay = next_sample_time - time.monotonic()
+            if delay < 0:
+                print(f"Sampling fell behind schedule by {-delay:.3f}s")
+                next_sample_time = time.monotonic()
+                delay = 0
+            self.stopped.wait(delay)
+
+        # Anything not yet published stays in the buffer and is sent on the next start
+        for reading in self.reducer.flush():
+            self.buffer.add(reading)
+        self.buffer.readings_available.set()
+        drain_thread.join()
+        self.endpoint.disconnect()
+        self.buffer.close()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def _sample(self):
+        try:
+            reading = self.sensors.read()
+        except Exception as e:
+            print(f"An error occurred while reading the sensors: {e}")
+            return
+
+        for reduced_reading in self.reducer.process(reading):
+            self.buffer.add(reduced_reading)
+
+    def _drain(self):
+        while not self.stopped.is_set():
+            self.buffer.readings_available.wait()
+            if self.stopped.is_set():
+                break
+
+            wait_secs = self._batch_wait_secs()
+            if wait_secs > 0:
+                self.stopped.wait(wait_secs)
+                continue
+
+            if not self._ensure_connected():
+                self.stopped.wait(1)
+                continue
+
+            started = time.monotonic()
+            self._publish_oldest_batch()
+            self.stopped.wait(max(0, self.min_publish_interval_secs - (time.monotonic() - started)))
+
+    # Returns how long to wait for the current batch to fill up. There is no wait if the batch is already full or the
+    # oldest reading has waited for the endpoint's batch interval.
+    def _batch_wait_secs(self):
+        if len(self.buffer) >= self.endpoint.batch_size:
+            return 0
+
+        oldest = self.buffer.peek(1)
+        if not oldest:
+            return self.min_publish_interval_secs
+        oldest_age_secs = time.time() - oldest[0][1]['t'] / 1000
+        return max(0, self.endpoint.batch_interval_secs - oldest_age_secs)
+
+    def _publish_oldest_batch(self):
+        batch = self.buffer.peek(self.drain_batch_size)
+        if not batch:
+            return
+
+        try:
+            publish_future = self.endpoint.publish_batch([reading for row_id, reading in batch])
+            publish_future.result(timeout=PUBLISH_ACK_TIMEOUT_SECS)
+        except Exception as e:
+            # The readings stay in the buffer and are published again on the next attempt. The connection state is
+            # left to the interrupted/resumed callbacks, the connection may well still be up (e.g. a late puback) and
+            # connecting it again would fail.
+            print(f"An error occurred while publishing {len(batch)} readings: {e}")
+            return
+
+        self.buffer.remove([row_id for row_id, reading in batch])
+        if len(self.buffer) > self.drain_batch_size:
+            print(f"Published {len(batch)} readings, {len(self.buffer)} readings are still buffered")
+
+    # The MQTT client reconnects by itself after an interruption, this only connects explicitly when the connection
+    # couldn't be made in the first place. Once a connection was made, connecting again while the client is
+    # reconnecting would only fail, so this waits for the client instead. Attempts back off exponentially up to a
+    # maximum.
+    def _ensure_connected(self):
+        if self.endpoint.connected.is_set():
+            self.has_connected = True
+            return True
+        if self.has_connected or time.monotonic() < self.next_reconnect_time:
+            return False
+
+        try:
+            self.endpoint.connect()
+            self.has_connected = True
+            self.reconnect_backoff_secs = 1
+            print("Connected")
+            return True
+        except Exception as e:
+            print(f"Unable to connect, retrying in {self.reconnect_backoff_secs}s: {e}")
+            self.next_reconnect_time = time.monotonic() + self.reconnect_backoff_secs
+            self.reconnect_backoff_secs = min(self.reconnect_backoff_secs * 2, self.max_reconnect_backoff_secs)
+            return False
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Continuously samples the sensors and publishes the readings')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between samples, may be fractional')
+    parser.add_argument('--max-reconnect-backoff', type=float, default=60,
+                        help='Maximum number of seconds to wait between reconnect attempts')
+    parser.add_argument('--endpoint', type=str, default='a1ktn0eiegwonn-ats.iot.us-west-1.amazonaws.com')
+    parser.add_argument('--client-id', type=str, default='rpi3bTempHumPress')
+    parser.add_argument('--topic', type=str, default='rpi/sensor/events')
+    parser.add_argument('--device-id', type=str, default='RPi3BHome')
+    parser.add_argument('--wire-format', type=str, default='json', choices=['json', 'binary'],
+                        help='Encoding of published readings, binary is much smaller for cellular connections')
+    parser.add_argument('--binary-topic', type=str, default='rpi/sensor/events/bin')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Number of readings to publish together in a single message')
+    parser.add_argument('--batch-interval', type=float, default=0,
+                        help='Maximum number of seconds a reading waits for its batch to fill before it is published')
+    parser.add_argument('--buffer-path', type=str, default='readings.db',
+                        help='SQLite file that readings are buffered in until they are published')
+    parser.add_argument('--buffer-max-readings', type=int, default=500000,
+                        help='Maximum number of buffered readings, the oldest are evicted once it is reached')
+    parser.add_argument('--drain-batch-size', type=int, default=MAX_BATCH_SIZE,
+                        help='Maximum number of backlogged readings to publish in a single message')
+    parser.add_argument('--drain-rate', type=float, default=2,
+                        help='Maximum number of messages per second to publish while draining a backlog')
+    parser.add_argument('--summary-window', type=float, default=0,
+                        help='Summarize readings into min/mean/max over windows of this many seconds, 0 to disable')
+    parser.add_argument('--deadband', type=str, default='',
+                        help='Only send metrics that change by at least their threshold, e.g. "tmp=0.1,hum=0.5,pr=0.1"')
+    parser.add_argument('--heartbeat', type=float, default=300,
+                        help='Seconds between full readings when the deadband is enabled')
+    return parser.parse_args()
+
+
+def _build_reducer(args):
+    stages = []
+    if args.summary_window:
+        stages.append(WindowSummarizer(args.summary_window))
+    if args.deadband:
+        stages.append(DeadbandFilter(parse_thresholds(args.deadband), args.heartbeat))
+    return ReductionPipeline(stages)
+
+
+if __name__ == "__main__":
+    # These dependencies are only on the RPi
+    from data_endpoint import DataEndpoint
+    from sensors import EnvironmentSensors
+
+    args = _parse_args()
+    iot_endpoint = DataEndpoint(endpoint=args.endpoint, client_id=args.client_id, topic=args.topic,
+                                device_id=args.device_id, batch_size=args.batch_size,
+                                batch_interval_secs=args.batch_interval, binary_topic=args.binary_topic,
+                                wire_format=args.wire_format, connect=False)
+    reading_buffer = ReadingBuffer(args.buffer_path, args.buffer_max_readings)
+    daemon = PublishDaemon(iot_endpoint, EnvironmentSensors(), reading_buffer, args.interval,
+                           args.drain_batch_size, args.drain_rate, args.max_reconnect_backoff, _build_reducer(args))
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
@@ -0,0 +1,66 @@
+import json
+import sqlite3
+import threading
+
+
+# Durable first-in first-out buffer of readings backed by SQLite. Every reading is written here before it is
+# published and only removed once the broker has acknowledged it, so readings survive network outages and restarts.
+# The buffer is bounded: once it holds max_readings, the oldest readings are evicted to make room for new ones.
+class ReadingBuffer:
+
+    def __init__(self, path='readings.db', max_readings=500000):
+        self.max_readings = max_readings
+        self.lock = threading.Lock()
+        self.readings_available = threading.Event()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL with synchronous=NORMAL avoids an fsync for every insert which keeps SD card wear down. A power cut can
+        # lose the last few readings but never corrupts the buffer.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS readings (id INTEGER PRIMARY KEY AUTOINCREMENT, reading TEXT NOT NULL)')
+        self.connection.commit()
+        self.count = self.connection.execute('SELECT COUNT(*) FROM readings').fetchone()[0]
+        if self.count:
+            self.readings_available.set()
+
+    def add(self, reading):
+        with self.lock:
+            self.connection.execute('INSERT INTO readings (reading) VALUES (?)', (json.dumps(reading),))
+            self.count += 1
+            if self.count > self.max_readings:
+                # Evict in chunks of 1% so that a long outage doesn't mean a delete for every new reading
+                self._evict_oldest(max(self.count - self.max_readings, self.max_readings // 100))
+            self.connection.commit()
+        self.readings_available.set()
+
+    # Returns up to limit of the oldest readings as a list of (id, reading) tuples without removing them
+    def peek(self, limit):
+        with self.lock:
+            rows = self.connection.execute('SELECT id, reading FROM readings ORDER BY id LIMIT ?', (limit,)).fetchall()
+        return [(row_id, json.loads(reading)) for row_id, reading in rows]
+
+    # Removes the readings with the given ids, typically once they have been published successfully
+    def remove(self, ids):
+        if not ids:
+            return
+
+        with self.lock:
+            cursor = self.connection.executemany('DELETE FROM readings WHERE id = ?', [(row_id,) for row_id in ids])
+            self.count -= cursor.rowcount
+            self.connection.commit()
+            if not self.count:
+                self.readings_available.clear()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        return self.count
+
+    def _evict_oldest(self, eviction_count):
+        cursor = self.connection.execute(
+            'DELETE FROM readings WHERE id IN (SELECT id FROM readings ORDER BY id LIMIT ?)', (eviction_count,))
+        self.count -= cursor.rowcount
+        print(f"Buffer is full, evicted the {cursor.rowcount} oldest readings")
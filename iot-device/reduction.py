@@ -0,0 +1,104 @@
+METRIC_KEYS = ('tmp', 'hum', 'pr')
+
+
+# Reduces the number of readings sent when the environment isn't changing. Only the metrics that have moved by at
+# least their threshold since they were last sent are included in a reading, and readings with no such metrics are
+# dropped. A full reading is still sent at least every heartbeat_secs so the backend knows the device is alive and
+# can fill in the gaps.
+class DeadbandFilter:
+
+    def __init__(self, thresholds, heartbeat_secs=300):
+        self.thresholds = thresholds
+        self.heartbeat_ms = heartbeat_secs * 1000
+        self.last_sent = {}
+        self.last_heartbeat_time = None
+
+    def process(self, reading):
+        if self.last_heartbeat_time is None or reading['t'] - self.last_heartbeat_time >= self.heartbeat_ms:
+            self.last_heartbeat_time = reading['t']
+            self.last_sent = {key: reading[key] for key in METRIC_KEYS if key in reading}
+            return [reading]
+
+        changed_keys = [key for key in METRIC_KEYS if key in reading and self._changed(key, reading[key])]
+        if not changed_keys:
+            return []
+
+        reduced = {key: value for key, value in reading.items()
+                   if not _metric_of(key) or _metric_of(key) in changed_keys}
+        self.last_sent.update({key: reading[key] for key in changed_keys})
+        return [reduced]
+
+    def flush(self):
+        return []
+
+    def _changed(self, key, value):
+        return key not in self.last_sent or abs(value - self.last_sent[key]) >= self.thresholds.get(key, 0)
+
+
+# Summarizes the readings in each window of window_secs into a single reading holding the mean of each metric at the
+# window's midpoint, along with the window length (w), number of readings (n) and each metric's min and max, e.g.
+# {"t": ..., "w": 60000, "n": 60, "tmp": 21.5, "tmp_min": 21.4, "tmp_max": 21.6, ...}
+class WindowSummarizer:
+
+    def __init__(self, window_secs):
+        self.window_ms = int(window_secs * 1000)
+        self.window_start = None
+        self.readings = []
+
+    def process(self, reading):
+        window_start = reading['t'] - reading['t'] % self.window_ms
+        summaries = []
+        if self.window_start is not None and window_start != self.window_start:
+            summaries = self.flush()
+
+        self.window_start = window_start
+        self.readings.append(reading)
+        return summaries
+
+    def flush(self):
+        if not self.readings:
+            return []
+
+        summary = {"t": self.window_start + self.window_ms // 2, "w": self.window_ms, "n": len(self.readings)}
+        for key in METRIC_KEYS:
+            values = [reading[key] for reading in self.readings if key in reading]
+            if values:
+                summary[key] = round(sum(values) / len(values), 2)
+                summary[f'{key}_min'] = min(values)
+                summary[f'{key}_max'] = max(values)
+
+        self.readings = []
+        return [summary]
+
+
+# Runs readings through each reduction stage in turn
+class ReductionPipeline:
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def process(self, reading):
+        readings = [reading]
+        for stage in self.stages:
+            readings = [output for reading in readings for output in stage.process(reading)]
+        return readings
+
+    def flush(self):
+        readings = []
+        for stage in self.stages:
+            readings = [output for reading in readings for output in stage.process(reading)] + stage.flush()
+        return readings
+
+
+# Parses thresholds in the form "tmp=0.1,hum=0.5,pr=0.1"
+def parse_thresholds(thresholds):
+    parsed = {}
+    for threshold in filter(None, thresholds.split(',')):
+        key, value = threshold.split('=')
+        parsed[key.strip()] = float(value)
+    return parsed
+
+
+def _metric_of(key):
+    metric = key.split('_')[0]
+    return metric if metric in METRIC_KEYS else None
@@ -0,0 +1,3 @@
+cd /home/mike_s/projects/temp_hum_pressure || exit
+source ./.venv/bin/activate
+sudo -E python publish_daemon.py --interval "${SAMPLE_INTERVAL_SECS:-1}"
@@ -0,0 +1,24 @@
+import time
+# These dependencies are only on the RPi
+import board
+import adafruit_sht4x
+import adafruit_lps2x
+
+
+class EnvironmentSensors:
+
+    def __init__(self):
+        i2c = board.I2C()
+        self.sht = adafruit_sht4x.SHT4x(i2c)  # temp + humidity
+        self.lps = adafruit_lps2x.LPS22(i2c)  # pressure + temp
+        self.sht.mode = adafruit_sht4x.Mode.NOHEAT_HIGHPRECISION
+
+    # Reads the sensors and returns a data point in the format expected by the backend
+    def read(self):
+        temperature_c, relative_humidity = self.sht.measurements
+        return {
+            "t": int(round(time.time() * 1000)),
+            "tmp": round(temperature_c, 2),
+            "hum": round(relative_humidity, 2),
+            "pr": round(self.lps.pressure, 2)
+        }
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Add the main project directory to the sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
\ No newline at end of file
@@ -0,0 +1,120 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from publish_daemon import PublishDaemon
+from reading_buffer import ReadingBuffer
+
+
+# Stands in for DataEndpoint, publishes complete immediately unless publish_error is set
+class FakeEndpoint:
+
+    def __init__(self, batch_size=1, batch_interval_secs=0):
+        self.batch_size = batch_size
+        self.batch_interval_secs = batch_interval_secs
+        self.connected = threading.Event()
+        self.connect_error = None
+        self.connect_attempts = 0
+        self.publish_error = None
+        self.published = []
+
+    def connect(self):
+        self.connect_attempts += 1
+        if self.connect_error:
+            raise self.connect_error
+        self.connected.set()
+
+    def publish_batch(self, readings):
+        future = Future()
+        if self.publish_error:
+            future.set_exception(self.publish_error)
+        else:
+            self.published.append(list(readings))
+            future.set_result(None)
+        return future
+
+
+def test_connects_explicitly_only_until_connected(tmp_path):
+    endpoint = FakeEndpoint()
+    daemon = PublishDaemon(endpoint, None, ReadingBuffer(str(tmp_path / 'readings.db')), 60)
+
+    endpoint.connect_error = Exception('Connection refused')
+    assert not daemon._ensure_connected()
+    # Attempts back off
+    assert not daemon._ensure_connected()
+    assert endpoint.connect_attempts == 1 and daemon.reconnect_backoff_secs == 2
+
+    endpoint.connect_error = None
+    daemon.next_reconnect_time = 0
+    assert daemon._ensure_connected()
+    assert endpoint.connect_attempts == 2 and daemon.reconnect_backoff_secs == 1
+
+    # After an interruption the client reconnects by itself, so it isn't connected again
+    endpoint.connected.clear()
+    assert not daemon._ensure_connected()
+    assert endpoint.connect_attempts == 2
+    endpoint.connected.set()
+    assert daemon._ensure_connected()
+
+
+def test_drain_publishes_batches_of_drain_batch_size(tmp_path):
+    endpoint = FakeEndpoint(batch_size=2)
+    buffer = ReadingBuffer(str(tmp_path / 'readings.db'))
+    daemon = PublishDaemon(endpoint, None, buffer, 60, drain_batch_size=3)
+    for i in range(7):
+        buffer.add({'t': i, 'tmp': 20.0})
+
+    # Readings stay buffered until their batch is acknowledged
+    endpoint.publish_error = TimeoutError()
+    daemon._publish_oldest_batch()
+    assert endpoint.published == [] and len(buffer) == 7
+
+    endpoint.publish_error = None
+    daemon._publish_oldest_batch()
+    assert endpoint.published == [[{'t': 0, 'tmp': 20.0}, {'t': 1, 'tmp': 20.0}, {'t': 2, 'tmp': 20.0}]]
+    assert len(buffer) == 4
+    daemon._publish_oldest_batch()
+    daemon._publish_oldest_batch()
+    assert [[reading['t'] for reading in batch] for batch in endpoint.published] == [[0, 1, 2], [3, 4, 5], [6]]
+    assert len(buffer) == 0
+
+    # The drain batch size is never below the endpoint's batch size
+    assert PublishDaemon(FakeEndpoint(batch_size=5), None, buffer, 60, drain_batch_size=3).drain_batch_size == 5
+
+
+def test_drain_waits_for_batch_to_fill(tmp_path):
+    endpoint = FakeEndpoint(batch_size=3, batch_interval_secs=30)
+    buffer = ReadingBuffer(str(tmp_path / 'readings.db'))
+    daemon = PublishDaemon(endpoint, None, buffer, 60, drain_rate=2)
+    assert daemon._batch_wait_secs() == 0.5
+
+    now_ms = int(time.time() * 1000)
+    buffer.add({'t': now_ms - 10000})
+    assert 19 < daemon._batch_wait_secs() <= 20
+    # No wait once the batch is full, or once the oldest reading has waited for the batch interval
+    buffer.add({'t': now_ms})
+    buffer.add({'t': now_ms})
+    assert daemon._batch_wait_secs() == 0
+    buffer.remove([row_id for row_id, reading in buffer.peek(3)])
+    buffer.add({'t': now_ms - 31000})
+    assert daemon._batch_wait_secs() == 0
+
+
+def test_drain_loop_publishes_the_backlog(tmp_path):
+    endpoint = FakeEndpoint()
+    buffer = ReadingBuffer(str(tmp_path / 'readings.db'))
+    daemon = PublishDaemon(endpoint, None, buffer, 60, drain_batch_size=2, drain_rate=100)
+    for i in range(5):
+        buffer.add({'t': i})
+
+    drain_thread = threading.Thread(target=daemon._drain, daemon=True)
+    drain_thread.start()
+    deadline = time.monotonic() + 5
+    while len(buffer) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    daemon.stop()
+    buffer.readings_available.set()
+    drain_thread.join(timeout=5)
+
+    assert [[reading['t'] for reading in batch] for batch in endpoint.published] == [[0, 1], [2, 3], [4]]
+    assert endpoint.connect_attempts == 1
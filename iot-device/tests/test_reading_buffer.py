@@ -0,0 +1,52 @@
+from reading_buffer import ReadingBuffer
+
+
+def test_peek_and_remove_in_order(tmp_path):
+    buffer = ReadingBuffer(str(tmp_path / 'readings.db'))
+    assert len(buffer) == 0 and not buffer.readings_available.is_set()
+
+    for i in range(5):
+        buffer.add({'t': i * 1000, 'tmp': 20.0 + i})
+    assert len(buffer) == 5 and buffer.readings_available.is_set()
+
+    # Peeking doesn't remove anything
+    batch = buffer.peek(3)
+    assert [reading['t'] for row_id, reading in batch] == [0, 1000, 2000]
+    assert buffer.peek(3) == batch
+
+    buffer.remove([row_id for row_id, reading in batch])
+    assert [reading['t'] for row_id, reading in buffer.peek(10)] == [3000, 4000]
+    buffer.remove([row_id for row_id, reading in buffer.peek(10)])
+    assert len(buffer) == 0 and not buffer.readings_available.is_set()
+    buffer.close()
+
+
+def test_oldest_readings_evicted_at_capacity(tmp_path):
+    buffer = ReadingBuffer(str(tmp_path / 'readings.db'), max_readings=200)
+    for i in range(200):
+        buffer.add({'t': i})
+    assert len(buffer) == 200
+
+    # Readings are evicted in chunks of 1% of the capacity
+    buffer.add({'t': 200})
+    assert len(buffer) == 199
+    assert [reading['t'] for row_id, reading in buffer.peek(1)] == [2]
+    assert [reading['t'] for row_id, reading in buffer.peek(200)][-1] == 200
+    buffer.close()
+
+
+def test_readings_persist_across_reopen(tmp_path):
+    path = str(tmp_path / 'readings.db')
+    buffer = ReadingBuffer(path)
+    for i in range(3):
+        buffer.add({'t': i, 'tmp': 21.5})
+    buffer.remove([buffer.peek(1)[0][0]])
+    buffer.close()
+
+    reopened = ReadingBuffer(path)
+    assert len(reopened) == 2 and reopened.readings_available.is_set()
+    assert [reading for row_id, reading in reopened.peek(10)] == [{'t': 1, 'tmp': 21.5}, {'t': 2, 'tmp': 21.5}]
+    # New readings go after the ones that were already buffered
+    reopened.add({'t': 3})
+    assert [reading['t'] for row_id, reading in reopened.peek(10)] == [1, 2, 3]
+    reopened.close()
@@ -0,0 +1,53 @@
+from reduction import DeadbandFilter, WindowSummarizer, ReductionPipeline, parse_thresholds
+
+
+def test_deadband_filter():
+    deadband = DeadbandFilter(parse_thresholds('tmp=0.5,hum=1'), heartbeat_secs=300)
+    # The first reading is always sent in full
+    assert deadband.process({'t': 0, 'tmp': 20.0, 'hum': 50.0}) == [{'t': 0, 'tmp': 20.0, 'hum': 50.0}]
+    # Changes within the deadband are suppressed
+    assert deadband.process({'t': 60000, 'tmp': 20.4, 'hum': 50.9}) == []
+    # Only the metrics that moved past their threshold since they were last sent are included, with their min and max
+    assert deadband.process({'t': 120000, 'tmp': 20.5, 'tmp_min': 20.1, 'hum': 50.5, 'w': 60000}) == \
+        [{'t': 120000, 'tmp': 20.5, 'tmp_min': 20.1, 'w': 60000}]
+    assert deadband.process({'t': 180000, 'tmp': 20.7, 'hum': 49.0}) == [{'t': 180000, 'hum': 49.0}]
+    assert deadband.flush() == []
+
+
+def test_deadband_filter_heartbeat():
+    deadband = DeadbandFilter({'tmp': 0.5, 'pr': 1}, heartbeat_secs=300)
+    deadband.process({'t': 0, 'tmp': 20.0, 'pr': 1010.0})
+    assert deadband.process({'t': 299999, 'tmp': 20.0, 'pr': 1010.0}) == []
+    # A full reading goes out once the heartbeat interval has passed even though nothing changed
+    assert deadband.process({'t': 300000, 'tmp': 20.0, 'pr': 1010.0}) == [{'t': 300000, 'tmp': 20.0, 'pr': 1010.0}]
+    assert deadband.process({'t': 360000, 'tmp': 20.1, 'pr': 1010.0}) == []
+    assert deadband.process({'t': 600000, 'tmp': 20.1, 'pr': 1010.0}) == [{'t': 600000, 'tmp': 20.1, 'pr': 1010.0}]
+    # Metrics without a threshold are sent with every reading
+    deadband = DeadbandFilter({'tmp': 0.5})
+    deadband.process({'t': 0, 'tmp': 20.0, 'hum': 50.0})
+    assert deadband.process({'t': 60000, 'tmp': 20.0, 'hum': 50.0}) == [{'t': 60000, 'hum': 50.0}]
+
+
+def test_window_summarizer():
+    summarizer = WindowSummarizer(60)
+    assert summarizer.process({'t': 60000, 'tmp': 20.0, 'hum': 50.0}) == []
+    assert summarizer.process({'t': 90000, 'tmp': 21.0}) == []
+    assert summarizer.process({'t': 119999, 'tmp': 22.5, 'hum': 52.0}) == []
+    # The first reading of the next window closes the previous one
+    assert summarizer.process({'t': 120000, 'tmp': 23.0}) == [{
+        't': 90000, 'w': 60000, 'n': 3, 'tmp': 21.17, 'tmp_min': 20.0, 'tmp_max': 22.5, 'hum': 51.0, 'hum_min': 50.0,
+        'hum_max': 52.0
+    }]
+    # Windows without readings are skipped
+    assert summarizer.process({'t': 300000, 'tmp': 24.0}) == [
+        {'t': 150000, 'w': 60000, 'n': 1, 'tmp': 23.0, 'tmp_min': 23.0, 'tmp_max': 23.0}]
+    assert summarizer.flush() == [{'t': 330000, 'w': 60000, 'n': 1, 'tmp': 24.0, 'tmp_min': 24.0, 'tmp_max': 24.0}]
+    assert summarizer.flush() == []
+
+
+def test_reduction_pipeline():
+    pipeline = ReductionPipeline([WindowSummarizer(60), DeadbandFilter({'tmp': 1})])
+    outputs = [output for i in range(5) for output in pipeline.process({'t': i * 30000, 'tmp': 20.0})]
+    # The summaries of the first two windows, the second of which is within the deadband of the first
+    assert outputs == [{'t': 30000, 'w': 60000, 'n': 2, 'tmp': 20.0, 'tmp_min': 20.0, 'tmp_max': 20.0}]
+    assert pipeline.flush() == []
@@ -0,0 +1,51 @@
+import struct
+
+# Compact binary encoding of readings, decoded by aws-iot/wire_format.py. All values are little endian.
+#
+#   header:  version (uint8), flags (uint8), reading count (uint16)
+#   device:  only if flags & FLAG_DEVICE, length (uint8) followed by the utf-8 encoded device id
+#   base:    time of the first reading in epoch millis (int64)
+#   reading: millis since base (uint32), temperature * 100 (int16), humidity * 100 (uint16), pressure * 100 (uint32)
+#
+# Each reading takes 12 bytes instead of roughly 60 as JSON. Metrics missing from a (deadband) reading are encoded as
+# the maximum value of their type, which present metrics can't take. Summary readings are not supported by this
+# version of the format.
+WIRE_FORMAT_VERSION = 1
+FLAG_DEVICE = 0x01
+HEADER = struct.Struct('<BBH')
+BASE_TIME = struct.Struct('<q')
+READING = struct.Struct('<IhHI')
+MISSING_VALUES = (0x7FFF, 0xFFFF, 0xFFFFFFFF)
+METRIC_KEYS = ('tmp', 'hum', 'pr')
+
+
+# Encodes the readings, raising a ValueError if they can't be represented in this format
+def encode_readings(readings, device_id=None):
+    if not readings:
+        raise ValueError('There are no readings to encode')
+    if any('w' in reading for reading in readings):
+        raise ValueError('Summary readings are not supported by the binary wire format')
+
+    flags = FLAG_DEVICE if device_id else 0
+    parts = [HEADER.pack(WIRE_FORMAT_VERSION, flags, len(readings))]
+    if device_id:
+        device_bytes = device_id.encode('utf-8')
+        if len(device_bytes) > 255:
+            raise ValueError(f'The device id is {len(device_bytes)} bytes, the binary wire format allows 255')
+        parts.append(struct.pack('<B', len(device_bytes)) + device_bytes)
+
+    base_time = min(reading['t'] for reading in readings)
+    parts.append(BASE_TIME.pack(base_time))
+    try:
+        for reading in readings:
+            values = [int(round(reading[key] * 100)) if key in reading else missing_value
+                      for key, missing_value in zip(METRIC_KEYS, MISSING_VALUES)]
+            # A value that encodes as the missing value of its type would be decoded as a missing metric
+            if any(key in reading and value == missing_value
+                   for key, value, missing_value in zip(METRIC_KEYS, values, MISSING_VALUES)):
+                raise ValueError(f'Reading is out of range for the binary wire format: {reading}')
+            parts.append(READING.pack(reading['t'] - base_time, *values))
+    except struct.error as e:
+        raise ValueError(f'Reading is out of range for the binary wire format: {e}')
+
+    return b''.join(parts)
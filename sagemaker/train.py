@@ -1,28 +1,42 @@
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error
 from io import StringIO
 import numpy as np
 import io
+import os
 import pickle
 import boto3
 import argparse
 import tarfile
+import cProfile
+import pstats
+import random
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+MODEL_TYPES = ['temperature', 'humidity', 'pressure']
+DAYS_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+# Devices are fit in chunks of this many, each chunk on its own thread (NumPy releases the GIL for the matrix products)
+DEVICE_CHUNK_SIZE = 256
+# Keeps the per device fits solvable when a device's data doesn't cover every feature, e.g. a day of the week it
+# hasn't reported on yet (the day of week columns and the intercept are never independent either), while leaving the
+# predictions of well covered devices practically unchanged
+RIDGE = 1e-9
 
 
 def _build_models():
     print("Starting model training")
-    environment_data_df = _prepare_aggregate_data_frame()
+    aggregate_df = pd.read_csv(StringIO(_load_aggregate_env_data(AGGREGATE_FILE_KEY)))
+    print("Loaded aggregate data from s3")
+    environment_data_df = _prepare_aggregate_data_frame(aggregate_df.drop(columns=['device'], errors='ignore'))
     print(environment_data_df.head())
     _build_store_models(environment_data_df)
+    if MODEL_BUNDLE_KEY:
+        _store_model_bundle(fit_device_models(aggregate_df, MIN_DEVICE_ROWS))
 
 
-def _prepare_aggregate_data_frame():
-    env_data_string = _load_aggregate_env_data(AGGREGATE_FILE_KEY)
-    print("Loaded aggregate data from s3")
-
-    env_data_df = pd.read_csv(StringIO(env_data_string))
+def _prepare_aggregate_data_frame(env_data_df):
     # one hot encode the day of week column because linear regression model can only deal with ints
     one_hot_days_of_week = pd.get_dummies(env_data_df, columns=['day_of_week'], prefix='', prefix_sep='')
     # Reorder columns to match the order of the days of the week so prediction code can set the correct day of week
@@ -57,6 +71,12 @@ def _build_store_models(env_data_df):
 
 
 def _build_model(train_features_df, predict_feature_df):
+    # scikit-learn is only needed for the models served by endpoints, so the per device fitting below can be used
+    # without it (e.g. by the pipeline benchmark)
+    from sklearn.model_selection import train_test_split
+    from sklearn.linear_model import LinearRegression
+    from sklearn.metrics import mean_squared_error
+
     x_train, x_test, y_train, y_test = train_test_split(train_features_df, predict_feature_df, test_size=0.2,
                                                         random_state=42)
     model = LinearRegression()
@@ -70,10 +90,10 @@ def _build_model(train_features_df, predict_feature_df):
     return model
 
 
+# The model is named after the run that trained it, which is what the prediction stage deploys it by
 def _store_model_s3(model, model_type):
-    date_today = pd.to_datetime('today').strftime('%Y-%m-%d')
     model_tar_buffer = package_model_with_inf_script(model, model_type)
-    model_tar_filename = f'models/{date_today}-{model_type}-model.tar.gz'
+    model_tar_filename = f'models/{RUN_ID}-{model_type}-model.tar.gz'
 
     s3_client = boto3.client('s3', region_name='us-west-1')
     s3_client.upload_fileobj(model_tar_buffer, S3_BUCKET, model_tar_filename)
@@ -81,15 +101,13 @@ def _store_model_s3(model, model_type):
 
 
 def package_model_with_inf_script(model, model_type):
-    date_today = pd.to_datetime('today').strftime('%Y-%m-%d')
-
     tar_buffer = io.BytesIO()
     with tarfile.open(fileobj=tar_buffer, mode='w:gz') as tar:
         # Add model to the tar.gz file by dumping with pickle
         with io.BytesIO() as f:
             pickle.dump(model, f)
             f.seek(0)
-            tarinfo_model = tarfile.TarInfo(name=f'{date_today}-{model_type}-model.pkl')
+            tarinfo_model = tarfile.TarInfo(name=f'{RUN_ID}-{model_type}-model.pkl')
             tarinfo_model.size = len(f.getvalue())
             tar.addfile(tarinfo_model, fileobj=f)
             print('Added model to tar.gz file')
@@ -113,6 +131,104 @@ def _load_inference_script():
     return inference_script_buffer
 
 
+# Fits a linear model per device and metric, the same model as _build_model but on the device's data alone, along with
+# a global model per metric fit on every device's data that is used for devices with fewer than min_device_rows rows.
+# Instead of fitting every model on its own, the Gram matrix (X^T X) of each device's rows over every column
+# [time_of_day, <metrics in MODEL_TYPES order>, <one-hot day of week>, 1] is computed once. Each metric's normal
+# equations are a slice of it, the global Gram matrix is the sum of the device ones, and all the models are solved in a
+# single batched call. The data is only read once however many devices there are.
+#
+# Returns the model bundle, with the global model first:
+# - metric_types: the metrics, in the order of the models
+# - devices: the devices with models of their own, the model of devices[i] is at i + 1
+# - coefficients: array of shape (model, metric, feature) where the features are [time_of_day, <averages of the other
+#   metrics in metric order>, <one-hot day of week>, intercept], matching the feature rows of
+#   aws-iot/forecast_features.py
+# - rmse: training root mean squared error of each model, array of shape (model, metric)
+# - rows: number of rows each model was fit on
+def fit_device_models(aggregate_df, min_device_rows):
+    started = time.perf_counter()
+    devices = aggregate_df['device'] if 'device' in aggregate_df.columns else pd.Series([''] * len(aggregate_df))
+    device_codes, device_names = pd.factorize(devices.astype(str), sort=True)
+    order = np.argsort(device_codes, kind='stable')
+    boundaries = np.searchsorted(device_codes[order], np.arange(len(device_names) + 1))
+    design = _design_matrix(aggregate_df)[order]
+
+    grams = np.empty((len(device_names), design.shape[1], design.shape[1]))
+
+    def fill_grams(first_device):
+        for device in range(first_device, min(first_device + DEVICE_CHUNK_SIZE, len(device_names))):
+            device_rows = design[boundaries[device]:boundaries[device + 1]]
+            grams[device] = device_rows.T @ device_rows
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(fill_grams, range(0, len(device_names), DEVICE_CHUNK_SIZE)))
+
+    rows = np.diff(boundaries)
+    own_model = rows >= min_device_rows
+    model_grams = np.concatenate([grams.sum(axis=0)[np.newaxis], grams[own_model]])
+    model_rows = np.concatenate([[rows.sum()], rows[own_model]])
+    coefficients, rmse = _solve_models(model_grams, model_rows)
+    print(f"Fit models for {own_model.sum()} of {len(device_names)} devices in {time.perf_counter() - started:.2f}s, "
+          f"global model RMSE: {dict(zip(MODEL_TYPES, np.round(rmse[0], 3).tolist()))}")
+
+    return {
+        'metric_types': np.array(MODEL_TYPES),
+        'devices': np.array(device_names[own_model], dtype=str),
+        'coefficients': coefficients,
+        'rmse': rmse,
+        'rows': model_rows
+    }
+
+
+def _design_matrix(aggregate_df):
+    design = np.zeros((len(aggregate_df), 1 + len(MODEL_TYPES) + len(DAYS_OF_WEEK) + 1))
+    design[:, 0] = aggregate_df['time_of_day'].to_numpy(dtype=np.float64)
+    design[:, 1:1 + len(MODEL_TYPES)] = aggregate_df[MODEL_TYPES].to_numpy(dtype=np.float64)
+    day_codes = pd.Categorical(aggregate_df['day_of_week'], categories=DAYS_OF_WEEK).codes
+    known_days = day_codes >= 0
+    design[np.flatnonzero(known_days), 1 + len(MODEL_TYPES) + day_codes[known_days]] = 1
+    design[:, -1] = 1
+    return design
+
+
+# Solves the normal equations of every model and metric, returns the coefficients along with the training RMSE which
+# also follows from the Gram matrix: SSE = y^T y - 2 b^T X^T y + b^T X^T X b
+def _solve_models(grams, rows):
+    feature_count = grams.shape[1] - 1
+    coefficients = np.empty((len(grams), len(MODEL_TYPES), feature_count))
+    rmse = np.empty((len(grams), len(MODEL_TYPES)))
+    for i, metric_type in enumerate(MODEL_TYPES):
+        target = 1 + i
+        features = [j for j in range(grams.shape[1]) if j != target]
+        xtx = grams[:, features][:, :, features]
+        xty = grams[:, features, target]
+        # The intercept isn't penalized so that it takes the average level of the metric, rather than sharing it with
+        # the day of week columns, which would leave days a device hasn't reported on without it
+        penalties = RIDGE * np.einsum('mii->mi', xtx) + RIDGE
+        penalties[:, -1] = RIDGE
+        regularized = xtx + np.einsum('mi,ij->mij', penalties, np.eye(feature_count))
+        solution = np.linalg.solve(regularized, xty[..., np.newaxis])[..., 0]
+        sse = (grams[:, target, target] - 2 * np.einsum('mi,mi->m', solution, xty)
+               + np.einsum('mi,mij,mj->m', solution, xtx, solution))
+        coefficients[:, i] = solution
+        rmse[:, i] = np.sqrt(np.maximum(sse, 0) / np.maximum(rows, 1))
+    return coefficients, rmse
+
+
+# The bundle is a single compressed NumPy archive so that the prediction stage can load every model with one request
+def build_model_bundle_bytes(bundle):
+    bundle_buffer = io.BytesIO()
+    np.savez_compressed(bundle_buffer, **bundle)
+    return bundle_buffer.getvalue()
+
+
+def _store_model_bundle(bundle):
+    s3_client = boto3.client('s3', region_name='us-west-1')
+    s3_client.put_object(Bucket=S3_BUCKET, Key=MODEL_BUNDLE_KEY, Body=build_model_bundle_bytes(bundle))
+    print(f"Bundle of {len(bundle['devices'])} device models uploaded to {MODEL_BUNDLE_KEY}")
+
+
 def _load_aggregate_env_data(file_key):
     print(f"Loading aggregate data from s3: {file_key}")
     s3 = boto3.client('s3')
@@ -121,13 +237,65 @@ def _load_aggregate_env_data(file_key):
     return env_content
 
 
+# Runs model building under cProfile and tracemalloc and uploads a report of the hottest functions and largest
+# allocations, along with the raw cProfile stats, to profiles/train/ in the bucket
+def _build_models_profiled():
+    tracemalloc.start(5)
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        _build_models()
+    finally:
+        profiler.disable()
+        duration = time.perf_counter() - started
+        snapshot = tracemalloc.take_snapshot()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        _store_profile(profiler, duration, snapshot, peak_memory)
+
+
+def _store_profile(profiler, duration, snapshot, peak_memory):
+    report = io.StringIO()
+    report.write(f'Duration: {duration:.3f}s\nPeak traced memory: {peak_memory / 2 ** 20:.1f} MB\n')
+    report.write('\nTop 40 functions by cumulative time\n')
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(40)
+    report.write('\nTop 25 allocations still held at the end of training\n')
+    for statistic in snapshot.statistics('traceback')[:25]:
+        report.write(f'{statistic.size / 1024:.1f} KiB in {statistic.count} blocks\n')
+        report.writelines(f'    {line}\n' for line in statistic.traceback.format())
+
+    with tempfile.NamedTemporaryFile(suffix='.prof') as stats_file:
+        profiler.dump_stats(stats_file.name)
+        raw_stats = stats_file.read()
+
+    report_key = f"profiles/train/{pd.Timestamp.utcnow().strftime('%Y%m%dT%H%M%S')}"
+    s3_client = boto3.client('s3', region_name='us-west-1')
+    s3_client.put_object(Bucket=S3_BUCKET, Key=f'{report_key}.txt', Body=report.getvalue().encode('utf-8'))
+    s3_client.put_object(Bucket=S3_BUCKET, Key=f'{report_key}.prof', Body=raw_stats)
+    print(f"Profile of model training uploaded to {report_key}.txt")
+
+
 if __name__ == "__main__":
     print("building models")
     parser = argparse.ArgumentParser()
     parser.add_argument('--s3_bucket', type=str, default='')
     parser.add_argument('--aggregate_file_key', type=str, default='')
+    # Id of the run the models are trained for (see aws-iot/run_manifest.py), defaults to today
+    parser.add_argument('--run_id', type=str, default='')
+    # Fraction of training jobs to profile, see _build_models_profiled
+    parser.add_argument('--profile_sample_rate', type=float, default=0)
+    # Where to store the bundle of per device models, see fit_device_models. No bundle is built if it is empty.
+    parser.add_argument('--model_bundle_key', type=str, default='')
+    parser.add_argument('--min_device_rows', type=int, default=2000)
     args = parser.parse_args()
     S3_BUCKET = args.s3_bucket
     AGGREGATE_FILE_KEY = args.aggregate_file_key
-    print(f'Received S3_BUCKET: {S3_BUCKET}, AGGREGATE_FILE_KEY: {AGGREGATE_FILE_KEY}')
-    _build_models()
+    RUN_ID = args.run_id or pd.to_datetime('today').strftime('%Y-%m-%d')
+    MODEL_BUNDLE_KEY = args.model_bundle_key
+    MIN_DEVICE_ROWS = args.min_device_rows
+    print(f'Received S3_BUCKET: {S3_BUCKET}, AGGREGATE_FILE_KEY: {AGGREGATE_FILE_KEY}, RUN_ID: {RUN_ID}')
+    if random.random() < args.profile_sample_rate:
+        _build_models_profiled()
+    else:
+        _build_models()